@@ -1 +1,2 @@
 from .generic_agent import GenericAgent
+from .node import Node
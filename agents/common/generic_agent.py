@@ -28,22 +28,33 @@ import pwd
 import signal
 import socket
 import sys
+import threading
 import pika
 import psutil
 import requests
 import urllib.parse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from http.cookiejar import DefaultCookiePolicy
 from contextlib import suppress
-from hashlib import sha256
+from functools import partial
 from json import loads as json_loads, dumps as json_dumps
 from agents.exceptions import ApiAuthnzError, HttpApiNotResponding, MonitoringFilePermissionError
-from agents.utils.utils import get_settings, load_variables_from_uida_conf_files, get_logger, make_ba_http_header, generate_timestamp
+from agents.common.health import CachedCheck, FileWatch
+from agents.common.metrics import AgentMetrics, HTTP_LATENCY_BUCKETS, SUB_ACTION_DURATION_BUCKETS
+from agents.common.node import Node
+from agents.utils.checksum_cache import ChecksumCache, generate_file_checksum
+from agents.utils.utils import get_settings, load_variables_from_uida_conf_files, get_logger, make_ba_http_header, generate_timestamp, get_checksum_value, get_checksum_uri
 
 
 class GenericAgent():
 
 
     def __init__(self):
+        self._connection = None
         self._channel = None
+        self._connection_thread = None      # Thread which opened the rabbitmq connection, and alone may use it
+        self._connection_error = None       # Error servicing the connection while a worker thread processes a message
         self._uida_conf_vars = load_variables_from_uida_conf_files()
         self._settings = get_settings(self._uida_conf_vars)
         self._ida_api_url = self._uida_conf_vars['IDA_API']
@@ -57,6 +68,12 @@ class GenericAgent():
             self.__class__.__name__,
             self._process_pid
         )
+        self._metrics_file = '%s/%s-%s-%d.prom' % (
+            self._settings.get('metrics_dir') or '%s/metrics' % self._uida_conf_vars['RABBIT_MONITORING_DIR'],
+            self._hostname,
+            self.__class__.__name__,
+            self._process_pid
+        )
         self.name = self._get_name()        # The name of the agent, displayed in logs
 
         # Normal queues
@@ -68,8 +85,20 @@ class GenericAgent():
         self.failed_batch_queue_name = None  # Queue with republished, failed batch actions
 
         self.rabbitmq_message = None        # The message currently being processed from a queue
+        self._prefetched_messages = {}      # Messages pushed by rabbitmq in push consumer mode, per queue
+        self._queue_credits = {}            # Weighted round-robin credits per queue in push consumer mode
+        self._project_last_served = {}      # Sequence number of the batch action last processed per project in push consumer mode
+        self._batch_actions_served = 0      # Number of batch actions processed in push consumer mode
+        self._http_session = None           # Keep-alive HTTP session shared by all requests made by the agent
+        self._http_adapter = None           # Connection pooling transport adapter of the HTTP session
+        self._checksum_cache = None         # Local persistent checksum cache, opened on first use (False if unavailable)
+        self._checksum_cache_lock = threading.Lock()
         self._graceful_shutdown_started = False
-        self.gevent = None
+
+        # Metrics recorded by the agent, periodically written to the metrics file
+        self._metrics = AgentMetrics({ 'agent': self.__class__.__name__ })
+        self._metrics_written = None        # Monotonic time when the metrics file was last written
+        self._sub_action_started = None     # Monotonic time when the current sub-action started
 
         # Diagnostic variables for development and testing
         self.last_completed_sub_action = {}
@@ -84,6 +113,23 @@ class GenericAgent():
         self._logger = get_logger(self.name, self._uida_conf_vars)
         self._logger.info("TZ=%s" % str(time.tzname))
 
+        # Health checks, refreshed in the background while consuming, see _start_health_checks()
+        health_settings = self._settings['health_checks']
+        self._offline_watch = FileWatch(
+            "%s/control/OFFLINE" % self._uida_conf_vars['STORAGE_OC_DATA_ROOT'],
+            health_settings['ttl'],
+            self._logger,
+            use_inotify=health_settings['inotify']
+        )
+        self._dependency_check = CachedCheck(
+            'dependencies',
+            self.dependencies_not_ok,
+            health_settings['interval'],
+            health_settings['ttl'],
+            self._logger,
+            on_error=True
+        )
+
         # Perform initial housekeeping
         self.connect()
         self._cleanup_old_sentinel_monitoring_files()
@@ -127,7 +173,9 @@ class GenericAgent():
                 credentials,
                 heartbeat=self._uida_conf_vars['RABBIT_HEARTBEAT']))
 
+        self._connection = connection
         self._channel = connection.channel()
+        self._connection_thread = threading.current_thread()
         self._logger.info('Connected')
 
 
@@ -164,28 +212,46 @@ class GenericAgent():
             message = json_dumps(message)
 
         self._logger.info('Publishing message: exchange: %s routing_key: %s message: %s properties: %s' % (exchange, routing_key, message, properties))
-        self._channel.basic_publish(body=message, routing_key=routing_key, exchange=exchange, properties=properties)
+        self._run_on_connection_thread(self._channel.basic_publish, body=message, routing_key=routing_key, exchange=exchange, properties=properties)
 
 
     def start(self):
         self._logger.info('%s started' % self.__class__.__name__)
         try:
+            self._start_health_checks()
             self.start_consuming()
         except SystemExit:
             self._logger.info('Stopping due to shutdown signal')
+        finally:
+            self._stop_health_checks()
+            self._remove_metrics_file()
         self._logger.info('%s stopped' % self.__class__.__name__)
 
 
     def start_consuming(self):
         """
         Continuously consume messages from the agent's queues, according to queue priority,
-        until program is aborted. Using loop pattern instead of channel.basic_consume(callback),
-        to properly spread work between different processes working on the same queue.
+        until program is aborted.
+
+        By default the queues are polled, using a loop pattern instead of channel.basic_consume(callback),
+        to properly spread work between different processes working on the same queue. If the setting
+        'consumer_mode' is 'push', messages are instead pushed by rabbitmq to the agent, limited by the
+        configured prefetch count, and picked from the queues by weighted scheduling.
 
         If the IDA service enters offline mode, or any of the agent specific dependencies
         are no longer OK, the agent will sleep until the IDA service is again online and all
         agent dependencies are again OK.
         """
+        if self._settings.get('consumer_mode', 'poll') == 'push':
+            self._consume_pushed_messages()
+        else:
+            self._consume_polled_messages()
+
+
+    def _consume_polled_messages(self):
+        """
+        Poll the agent's queues for messages, consuming at most one message per loop iteration.
+        """
 
         self._logger.info('Started consuming from queues...')
 
@@ -200,31 +266,7 @@ class GenericAgent():
 
             if main_queue_not_empty or failed_queue_not_empty or main_batch_queue_not_empty or failed_batch_queue_not_empty:
 
-                is_offline_logged = False
-
-                # Do not consume messages if the sentinel offline file exists
-                while self._is_offline():
-                    # Log only the first time
-                    if not is_offline_logged:
-                        self._logger.warning('Sentinel offline file present. Sleeping...')
-                        is_offline_logged = True
-                    time.sleep(60)
-
-                if is_offline_logged:
-                    self._logger.info('Sentinel offline file no longer present. Resuming...')
-
-                dependencies_not_ok_logged = False
-
-                # Do not consume messages if any dependencies required by the agent are not met
-                while self.dependencies_not_ok():
-                    # Log only the first time
-                    if not dependencies_not_ok_logged:
-                        self._logger.warning('Dependencies not OK. Sleeping...')
-                        dependencies_not_ok_logged = True
-                    time.sleep(60)
-
-                if dependencies_not_ok_logged:
-                    self._logger.info('Dependencies OK. Resuming...')
+                self._wait_until_online_and_dependencies_ok()
 
                 # On each iteration, a message is consumed from the agent's queues with the following priority:
                 #     failed_queue_name
@@ -244,13 +286,368 @@ class GenericAgent():
                 elif main_batch_queue_not_empty:
                     self.consume_one(self.main_batch_queue_name)
 
-            if self.gevent:
-                # other agents being executed in the same process. the main loop will
-                # sleep when it sees fit.
-                self.gevent.sleep(0)
-            else:
-                # only this agent is being executed in this process
-                time.sleep(self._settings['main_loop_delay'])
+            self._write_metrics_file_if_due()
+
+            time.sleep(self._settings['main_loop_delay'])
+
+
+    def _consume_pushed_messages(self):
+        """
+        Register consumers for all of the agent's queues, and process messages as rabbitmq pushes them
+        to the agent. An idle agent blocks on the connection until a message arrives, and a busy agent
+        proceeds to the next prefetched message without sleeping.
+
+        If the connection or channel fails, any prefetched messages are discarded (rabbitmq will
+        redeliver them) and the agent re-connects and re-registers its consumers.
+        """
+
+        self._logger.info('Started consuming from queues in push mode, prefetch count %d...' % self._settings['prefetch_count'])
+
+        self._start_push_consumers()
+
+        while True:
+
+            if self._graceful_shutdown_started:
+                raise SystemExit
+
+            try:
+                if not self.consume_one_pushed():
+                    self._write_metrics_file_if_due()
+                    # returns as soon as a message is delivered, or when the delay expires
+                    self._connection.process_data_events(time_limit=self._settings['main_loop_delay'])
+
+            except (pika.exceptions.AMQPConnectionError, pika.exceptions.AMQPChannelError) as e:
+                self._logger.warning('Consuming pushed messages encountered an error: %s  Re-connecting...' % str(e))
+                try:
+                    self.connect()
+                    self._start_push_consumers()
+                except Exception as e:
+                    self._logger.warning('Re-connecting encountered an error: %s  Sleeping for a bit and retrying later...' % str(e))
+                    time.sleep(5)
+
+
+    def _start_push_consumers(self):
+        """
+        Limit the number of unacknowledged messages rabbitmq pushes to each consumer, and register a
+        consumer for each of the agent's queues. Pushed messages are buffered per queue until processed.
+
+        More messages are prefetched from the batch queues, so that the agent can interleave the batch
+        actions of different projects, see _next_prefetched_message_index() and
+        _defer_prefetched_messages_of_capped_projects().
+        """
+        self._channel.basic_qos(prefetch_count=self._settings['prefetch_count'])
+
+        weights = self._settings['queue_weights']
+
+        self._prefetched_messages = {}
+        self._queue_credits = {}
+        self._queue_weights = {
+            self.failed_queue_name:       weights['failed'],
+            self.main_queue_name:         weights['main'],
+            self.failed_batch_queue_name: weights['failed_batch'],
+            self.main_batch_queue_name:   weights['main_batch'],
+        }
+
+        for queue in self._queues_by_priority():
+            if queue == self.failed_batch_queue_name:
+                # applies to the consumers registered after this, i.e. the batch queues
+                self._channel.basic_qos(prefetch_count=self._settings['batch_prefetch_count'])
+            self._prefetched_messages[queue] = deque()
+            self._queue_credits[queue] = 0
+            self._channel.basic_consume(queue, partial(self._on_message_pushed, queue))
+
+
+    def _on_message_pushed(self, queue, channel, method, properties, body):
+        """
+        Consumer callback, invoked by pika while the connection processes data events.
+        """
+        self._prefetched_messages[queue].append((method, properties, body))
+
+
+    def _queues_by_priority(self):
+        return [
+            self.failed_queue_name,
+            self.main_queue_name,
+            self.failed_batch_queue_name,
+            self.main_batch_queue_name,
+        ]
+
+
+    def _select_prefetched_queue(self, in_flight=None):
+        """
+        Select the queue from which the next prefetched message is processed, using smooth weighted
+        round-robin over the queues which have prefetched messages. Ties are resolved according to
+        queue priority, so with the default weights, user-initiated actions are processed well ahead
+        of batch actions, while batch actions are still not starved entirely.
+
+        Batch queues whose prefetched messages all belong to projects already at their limit of batch
+        actions in flight are skipped. Parameter 'in_flight' is the number of actions in flight per
+        project, see _get_in_flight_actions_per_project(), retrieved if not given.
+
+        Returns None if no messages have been prefetched.
+        """
+        if in_flight is None:
+            in_flight = self._get_in_flight_actions_per_project()
+
+        candidates = [
+            queue for queue in self._queues_by_priority()
+            if self._next_prefetched_message_index(queue, in_flight) is not None
+        ]
+
+        if not candidates:
+            return None
+
+        total_weight = 0
+        selected_queue = None
+
+        for queue in candidates:
+            self._queue_credits[queue] += self._queue_weights[queue]
+            total_weight += self._queue_weights[queue]
+            if selected_queue is None or self._queue_credits[queue] > self._queue_credits[selected_queue]:
+                selected_queue = queue
+
+        self._queue_credits[selected_queue] -= total_weight
+
+        return selected_queue
+
+
+    def _next_prefetched_message_index(self, queue, in_flight):
+        """
+        Return the index of the prefetched message of queue to be processed next, or None if there is none.
+
+        Messages of the normal queues are processed in order. Messages of the batch queues are interleaved
+        by project: the oldest message of the project whose batch action was processed least recently is
+        selected, skipping projects which already have batch_project_max_in_flight actions in flight, so
+        that many batch actions of a single project cannot starve the batch actions of other projects.
+        """
+        messages = self._prefetched_messages.get(queue)
+
+        if not messages:
+            return None
+
+        if queue not in (self.failed_batch_queue_name, self.main_batch_queue_name):
+            return 0
+
+        selected_index = None
+        selected_last_served = None
+        projects_seen = set()
+
+        for index, message in enumerate(messages):
+            project = self._get_message_project(message)
+            if project in projects_seen:
+                continue
+            projects_seen.add(project)
+            if self._is_project_at_max_in_flight(message, in_flight):
+                continue
+            last_served = self._project_last_served.get(project, -1)
+            if selected_index is None or last_served < selected_last_served:
+                selected_index = index
+                selected_last_served = last_served
+
+        return selected_index
+
+
+    def _take_prefetched_message(self, queue, in_flight):
+        """
+        Remove and return the prefetched message of queue to be processed next, recording when its
+        project was last served if the queue is a batch queue.
+        """
+        index = self._next_prefetched_message_index(queue, in_flight)
+        message = self._prefetched_messages[queue][index]
+        del self._prefetched_messages[queue][index]
+
+        if queue in (self.failed_batch_queue_name, self.main_batch_queue_name):
+            self._project_last_served[self._get_message_project(message)] = self._batch_actions_served
+            self._batch_actions_served += 1
+
+        return message
+
+
+    def _get_message_project(self, message):
+        """
+        Return the project of a prefetched message, or None if it cannot be determined.
+        """
+        try:
+            return json_loads(message[2].decode('utf-8'))['project']
+        except Exception:
+            return None
+
+
+    def _get_in_flight_actions_per_project(self):
+        """
+        Return the number of actions currently being processed per project by the agents of the same type on
+        all hosts, as recorded in their sentinel monitoring files in the shared RABBIT_MONITORING_DIR. Only
+        needed if the number of batch actions in flight per project is limited.
+        """
+        in_flight = {}
+
+        if not self._settings['batch_project_max_in_flight']:
+            return in_flight
+
+        monitoring_files = glob.glob('%s/*-%s-*' % (self._uida_conf_vars['RABBIT_MONITORING_DIR'], self.__class__.__name__))
+
+        for file in monitoring_files:
+            try:
+                with open(file, 'r') as f:
+                    for line in f:
+                        if line.startswith('PROJECT="'):
+                            project = line.strip()[9:-1]
+                            in_flight[project] = in_flight.get(project, 0) + 1
+                            break
+            except OSError:
+                # the action ended meanwhile
+                continue
+
+        return in_flight
+
+
+    def _is_project_at_max_in_flight(self, message, in_flight):
+        """
+        Return True if the project of a batch message already has batch_project_max_in_flight
+        actions in flight.
+        """
+        max_in_flight = self._settings['batch_project_max_in_flight']
+        project = self._get_message_project(message)
+        return bool(project is not None and max_in_flight and in_flight.get(project, 0) >= max_in_flight)
+
+
+    def _defer_batch_message(self, queue, method, body):
+        """
+        Republish a batch message of a project already at its limit of batch actions in flight to the
+        waiting queue <queue>-deferred, from where it is dead-lettered back to the end of queue once
+        batch_project_defer_interval has expired, and ack the original message. This way the message
+        is not held by the agent, and the messages of other projects queued behind it can be processed.
+
+        If republishing fails, the message is rejected back to its original queue.
+        """
+        try:
+            self.publish_message(body, routing_key='%s-deferred' % queue, exchange='batch-actions-deferred')
+        except:
+            self._logger.warning('Deferring message from %s queue failed. Rejecting message back to original queue' % queue)
+            self._reject_message(method, requeue=True)
+            return
+
+        self._ack_message(method)
+        self._logger.info('Deferred message from %s queue, its project is at its limit of batch actions in flight' % queue)
+        self._metrics.inc('ida_agent_batch_messages_deferred_total', labels={ 'queue': queue },
+            help_text='Batch messages deferred since their project was at its limit of batch actions in flight, per queue')
+
+
+    def _defer_prefetched_messages_of_capped_projects(self, in_flight):
+        """
+        Defer the prefetched batch messages of projects already at their limit of batch actions in flight,
+        see _defer_batch_message(), so that they do not occupy the prefetch window of the agent, and
+        rabbitmq can push the next messages of the batch queues in their place.
+        """
+        for queue in (self.failed_batch_queue_name, self.main_batch_queue_name):
+            messages = self._prefetched_messages.get(queue)
+            if not messages:
+                continue
+            retained = deque()
+            for message in messages:
+                if self._is_project_at_max_in_flight(message, in_flight):
+                    method, properties, body = message
+                    self._defer_batch_message(queue, method, body)
+                else:
+                    retained.append(message)
+            self._prefetched_messages[queue] = retained
+
+
+    def consume_one_pushed(self):
+        """
+        Process one message already pushed to the agent by rabbitmq, selected by weighted scheduling
+        from the agent's queues, and by project-fair scheduling within the batch queues. Prefetched
+        batch messages of projects already at their limit of batch actions in flight are deferred.
+        Returns False if there were no prefetched messages which could be processed.
+        """
+        # Collect any messages already delivered by rabbitmq, without blocking
+        self._connection.process_data_events(time_limit=0)
+
+        in_flight = {}
+
+        if self._prefetched_messages.get(self.failed_batch_queue_name) or self._prefetched_messages.get(self.main_batch_queue_name):
+            in_flight = self._get_in_flight_actions_per_project()
+            self._defer_prefetched_messages_of_capped_projects(in_flight)
+
+        queue = self._select_prefetched_queue(in_flight)
+
+        if queue is None:
+            return False
+
+        self._wait_until_online_and_dependencies_ok()
+
+        method, properties, body = self._take_prefetched_message(queue, in_flight)
+
+        self._logger.info('Consuming one pushed message from %s queue' % queue)
+
+        self._process_message(queue, method, properties, body)
+
+        return True
+
+
+    def _start_health_checks(self):
+        """
+        Start watching the sentinel offline file, and checking the dependencies of the agent on a background
+        thread every health_checks.interval seconds, so that checking them before processing each message
+        only reads the cached results.
+        """
+        self._offline_watch.start()
+        self._dependency_check.start()
+
+
+    def _stop_health_checks(self):
+        self._offline_watch.stop()
+        self._dependency_check.stop()
+
+
+    def _wait_until_online_and_dependencies_ok(self):
+        """
+        Sleep until the sentinel offline file no longer exists, and all dependencies required by
+        the agent are met. The cached health check results are re-checked every health_checks.wait_step
+        seconds, so that recovery is noticed as soon as the health checks notice it.
+        """
+
+        wait_step = self._settings['health_checks']['wait_step']
+
+        is_offline_logged = False
+
+        # Do not consume messages if the sentinel offline file exists
+        while self._is_offline():
+            # Log only the first time
+            if not is_offline_logged:
+                self._logger.warning('Sentinel offline file present. Sleeping...')
+                is_offline_logged = True
+            self._sleep(wait_step)
+
+        if is_offline_logged:
+            self._logger.info('Sentinel offline file no longer present. Resuming...')
+
+        dependencies_not_ok_logged = False
+
+        # Do not consume messages if any dependencies required by the agent are not met
+        while self._dependency_check.get():
+            # Log only the first time
+            if not dependencies_not_ok_logged:
+                self._logger.warning('Dependencies not OK. Sleeping...')
+                dependencies_not_ok_logged = True
+            self._sleep(wait_step)
+
+        if dependencies_not_ok_logged:
+            self._logger.info('Dependencies OK. Resuming...')
+
+
+    def _sleep(self, seconds):
+        """
+        In push consumer mode, keep servicing the connection while sleeping, so that heartbeats
+        are answered while prefetched messages are held by the agent.
+        """
+        if self._graceful_shutdown_started:
+            raise SystemExit
+
+        if self._settings.get('consumer_mode', 'poll') == 'push' and self._connection is not None and self._on_connection_thread():
+            self._connection.sleep(seconds)
+        else:
+            time.sleep(seconds)
 
 
     def consume_one(self, queue=None):
@@ -268,22 +665,57 @@ class GenericAgent():
 
         self._logger.info('Consuming one message from %s queue' % queue)
 
-        try:
-            method, properties, body = self._channel.basic_get(queue)
-        except pika.exceptions.ChannelClosed:
-            self._logger.exception('Channel was closed. Retrying later...')
-            return
+        in_flight = None
+        deferrals_left = self._settings['batch_prefetch_count']
 
-        if not body:
-            self._logger.warning('Tried to consume from queue, but message body was None. No messages in queue?')
-            return
+        while True:
+
+            try:
+                method, properties, body = self._channel.basic_get(queue)
+            except pika.exceptions.ChannelClosed:
+                self._logger.exception('Channel was closed. Retrying later...')
+                return
+
+            if not body:
+                self._logger.warning('Tried to consume from queue, but message body was None. No messages in queue?')
+                return
+
+            if queue not in (self.failed_batch_queue_name, self.main_batch_queue_name):
+                break
+
+            if in_flight is None:
+                in_flight = self._get_in_flight_actions_per_project()
+
+            if not self._is_project_at_max_in_flight((method, properties, body), in_flight):
+                break
+
+            # defer batch messages of projects already at their limit of batch actions in flight,
+            # and proceed to the next message, so that the batch actions of other projects queued
+            # behind them are processed meanwhile
+            self._defer_batch_message(queue, method, body)
 
+            deferrals_left -= 1
+            if deferrals_left <= 0:
+                return
+
+        self._process_message(queue, method, properties, body)
+
+
+    def _process_message(self, queue, method, properties, body):
+        """
+        Process a single message received from a queue, either polled or pushed. See consume_one()
+        for the error handling applied.
+        """
+        self._sub_action_started = time.monotonic()
         try:
             action = self._get_action_record(body.decode('utf-8'))
 
             if action:
                 self._logger.info('Started processing action %s' % action)
-                self.process_queue(self._channel, method, properties, action, queue)
+                if self._settings['worker_thread_processing']:
+                    self._process_in_worker_thread(self.process_queue, self._channel, method, properties, action, queue)
+                else:
+                    self.process_queue(self._channel, method, properties, action, queue)
             else:
                 self._logger.warning(
                     'Rabbitmq message did not match an action in IDA. Discarding. Received: %s'
@@ -317,7 +749,94 @@ class GenericAgent():
             self._logger.debug('Message processing ended')
         finally:
             self.rabbitmq_message = None
+            self._sub_action_started = None
             self._remove_sentinel_monitoring_file()
+            self._log_http_connection_stats()
+            self._metrics.inc('ida_agent_messages_processed_total', labels={ 'queue': queue },
+                help_text='Messages processed, per queue')
+            self._write_metrics_file_if_due()
+
+
+    def _process_in_worker_thread(self, function, *args):
+        """
+        Call function with args in a worker thread, while servicing the rabbitmq connection in the current
+        thread, so that heartbeats are answered and the connection is kept open however long the processing
+        takes. Channel operations of the worker are executed by the current thread, see _run_on_connection_thread().
+        Returns the return value of function, or re-raises in the current thread any exception it raised.
+
+        If servicing the connection fails, the worker is allowed to finish, and its subsequent channel operations
+        fail. Its message is then redelivered by rabbitmq, and the sub-action timestamps recorded in IDA let the
+        next agent continue from where the worker got to.
+        """
+        result = {}
+
+        def run():
+            try:
+                result['value'] = function(*args)
+            except BaseException as e:
+                result['error'] = e
+            finally:
+                # wake up the connection thread immediately
+                with suppress(Exception):
+                    self._connection.add_callback_threadsafe(lambda: None)
+
+        self._connection_error = None
+
+        worker = threading.Thread(target=run, name='%s-worker' % self.name, daemon=True)
+        worker.start()
+
+        while worker.is_alive():
+            if self._connection_error is None:
+                try:
+                    self._connection.process_data_events(time_limit=self._settings['main_loop_delay'])
+                except Exception as e:
+                    self._logger.warning('Servicing the connection while processing a message encountered an error: %s' % str(e))
+                    self._connection_error = e
+            else:
+                worker.join(self._settings['main_loop_delay'])
+            self._write_metrics_file_if_due()
+
+        if 'error' in result:
+            raise result['error']
+
+        return result.get('value')
+
+
+    def _on_connection_thread(self):
+        return self._connection_thread is None or threading.current_thread() is self._connection_thread
+
+
+    def _run_on_connection_thread(self, function, *args, **kwargs):
+        """
+        Call function, which uses the rabbitmq connection or channel, in the thread which opened the connection,
+        and return its return value. pika connections are not thread safe, so when called from a worker thread,
+        the call is scheduled with add_callback_threadsafe(), and executed when the connection thread next
+        services the connection, while this thread waits for the result.
+        """
+        if self._on_connection_thread():
+            return function(*args, **kwargs)
+
+        done = threading.Event()
+        result = {}
+
+        def callback():
+            try:
+                result['value'] = function(*args, **kwargs)
+            except Exception as e:
+                result['error'] = e
+            finally:
+                done.set()
+
+        self._connection.add_callback_threadsafe(callback)
+
+        while not done.wait(1):
+            if self._connection_error is not None:
+                raise pika.exceptions.AMQPConnectionError('Connection failed while processing message: %s' % str(self._connection_error))
+
+        if 'error' in result:
+            raise result['error']
+
+        return result.get('value')
 
 
     def messages_in_queue(self, queue=None):
@@ -344,6 +863,8 @@ class GenericAgent():
                 time.sleep(5)
                 return 0
 
+        self._record_queue_depth(queue, queue_state.method.message_count)
+
         if queue_state.method.message_count == 1:
             self._logger.info('1 message in %s queue' % queue)
         elif queue_state.method.message_count > 1:
@@ -399,52 +920,125 @@ class GenericAgent():
 
 
     def _get_nodes_associated_with_action(self, action):
+        nodes = []
+        for page in self._get_node_pages_associated_with_action(action):
+            nodes.extend(page)
+        return nodes
+
+
+    def _get_node_pages_associated_with_action(self, action):
+        """
+        Retrieve the files associated with action in pages of at most action_file_page_size files, yielding
+        each page as a list of nodes once it has been retrieved, so that the nodes of large actions can be
+        processed with bounded memory instead of being loaded into memory all at once.
+        """
         self._logger.info('Retrieving files associated with action %s' % action['pid'])
-        response = self._ida_api_request('get', '/files/action/%s' % action['pid'], action)
-        if response.status_code != 200:
-            raise Exception(
-                'IDA api returned an error. Code: %d. Error: %s' % (response.status_code, response.content)
-            )
-        nodes = response.json()
-        if not isinstance(nodes, list):
-            nodes = [nodes]
+
+        page_size = self._settings['action_file_page_size']
+        after = None
+        total = 0
+
+        while True:
+
+            if self._graceful_shutdown_started:
+                raise SystemExit
+
+            url = '/files/action/%s?limit=%d' % (action['pid'], page_size)
+            if after is not None:
+                url = '%s&after=%d' % (url, after)
+
+            response = self._ida_api_request('get', url, action)
+            if response.status_code != 200:
+                raise Exception(
+                    'IDA api returned an error. Code: %d. Error: %s' % (response.status_code, response.content)
+                )
+
+            records = response.json()
+            if records is None:
+                records = []
+            elif not isinstance(records, list):
+                records = [records]
+
+            nodes = [ Node.from_dict(record) for record in records ]
+            records = None
+
+            total += len(nodes)
+
+            if len(nodes) > 0:
+                self._logger.debug('Retrieved page of %d files associated with action %s' % (len(nodes), action['pid']))
+                after = nodes[-1].id
+                yield nodes
+
+            if len(nodes) < page_size:
+                break
+
         # NOTE: it is possible for a repair action to have no associated files, if after re-scanning
         # the project frozen area there no longer exist any files in the frozen area.
-        self._logger.info('Retrieved %d files associated with action %s' % (len(nodes), action['pid']))
-        return nodes
+        self._logger.info('Retrieved %d files associated with action %s' % (total, action['pid']))
 
 
     def _save_nodes_to_db(self, nodes, fields=[], updated_only=False):
+        """
+        Update the specified fields of the frozen file records of the nodes in IDA, in batches of
+        at most file_update_chunk_size files per request. Files which IDA fails to update are collected
+        over all batches, and reported in a single exception once all batches have been sent.
+        """
         assert len(fields), 'need to specify fields to update for node.'
 
         self._logger.debug('Saving node fields %s to IDA db...' % str(fields))
 
-        for node in nodes:
+        if updated_only:
+            # Only update nodes which are flagged as having been updated
+            nodes = [ node for node in nodes if node._updated ]
 
-            update_node = True
+        chunk_size = self._settings['file_update_chunk_size']
+        failed = []
 
-            if updated_only:
-                # Only update nodes which are flagged as having been updated
-                update_node = node.get('_updated', False)
+        for chunk_first in range(0, len(nodes), chunk_size):
 
-            if update_node:
+            if self._graceful_shutdown_started:
+                raise SystemExit
 
-                # Update IDA frozen file record
-                data = {}
+            chunk = nodes[chunk_first:chunk_first + chunk_size]
+
+            # Update IDA frozen file records
+            files = []
+            for node in chunk:
+                data = { 'pid': node.pid }
                 for field in fields:
-                    data[field] = node[field]
-                response = self._ida_api_request('post', '/files/%s' % node['pid'], data=data)
-                if response.status_code not in (200, 201, 204):
-                    error_msg = 'IDA API returned an error when trying to update frozen file record for pid %s. Error message from API: %s'
-                    raise Exception(error_msg % (node['pid'], str(response.content)))
+                    data[field] = getattr(node, field)
+                files.append(data)
+
+            self._logger.debug('Updating %d frozen file records in IDA db for chunk %d:%d...' % (len(files), chunk_first, chunk_first + len(files)))
+
+            response = self._ida_api_request('post', '/files/batch', data={ 'files': files })
+            if response.status_code not in (200, 201, 204):
+                error_msg = 'IDA API returned an error when trying to update frozen file records. Error message from API: %s'
+                raise Exception(error_msg % str(response.content))
+
+            try:
+                response_json = response.json()
+            except:
+                response_json = {}
 
-                # If a checksum mismatch was reported for a repair action, repair the checksum in the Nextcloud file cache
-                if node.get('_checksum_mismatch', False):
-                    data = { 'pathname': 'frozen%s' % node['pathname'], 'checksum': node['checksum'] }
-                    response = self._ida_api_request('post', '/repairCacheChecksum', data=data)
-                    if response.status_code not in (200, 201, 204):
-                        error_msg = 'IDA API returned an error when trying to update cache checksum for pid %s. Error message from API: %s'
-                        raise Exception(error_msg % (node['pid'], str(response.content)))
+            failed.extend(response_json.get('failed', []))
+
+        if len(failed) > 0:
+            errors = [ str(entry) for entry in failed[:10] ]
+            raise Exception(
+                'IDA API failed to update %d frozen file records, first %d errors: %s'
+                % (len(failed), len(errors), '\n'.join(errors))
+            )
+
+        for node in nodes:
+
+            # If a checksum mismatch was reported for a repair action, repair the checksum in the Nextcloud file cache
+            if node._checksum_mismatch:
+                data = { 'pathname': 'frozen%s' % node.pathname, 'checksum': node.checksum }
+                response = self._ida_api_request('post', '/repairCacheChecksum', data=data)
+                if response.status_code not in (200, 201, 204):
+                    error_msg = 'IDA API returned an error when trying to update cache checksum for pid %s. Error message from API: %s'
+                    raise Exception(error_msg % (node.pid, str(response.content)))
 
 
     def _sub_action_processed(self, action, sub_action_name):
@@ -462,6 +1056,13 @@ class GenericAgent():
         Update the action being processed with a sub-action's completion timestamp,
         and save to db.
         """
+        if sub_action_name != 'completed' and self._sub_action_started is not None:
+            now = time.monotonic()
+            self._metrics.observe('ida_agent_sub_action_duration_seconds', now - self._sub_action_started,
+                SUB_ACTION_DURATION_BUCKETS, labels={ 'sub_action': sub_action_name },
+                help_text='Durations of completed sub-actions, per sub-action')
+            self._sub_action_started = now
+
         self._logger.info('Updating %s timestamp in IDA db for action %s' % (sub_action_name, action['pid']))
 
         # update existing action record in memory with the timestamp as well for convenience,
@@ -588,7 +1189,7 @@ class GenericAgent():
         If parameter requeue=True, the message will be requeued back to its original queue.
         """
         try:
-            self._channel.basic_reject(delivery_tag=method.delivery_tag, requeue=requeue)
+            self._run_on_connection_thread(self._channel.basic_reject, delivery_tag=method.delivery_tag, requeue=requeue)
         except:
             # could not connect? doesnt matter, the next worker knows where to
             # continue based on the placed sub-action timestamps
@@ -601,7 +1202,7 @@ class GenericAgent():
         Ack the message, so the message is removed from the queue.
         """
         try:
-            self._channel.basic_ack(delivery_tag=method.delivery_tag)
+            self._run_on_connection_thread(self._channel.basic_ack, delivery_tag=method.delivery_tag)
         except:
             # could not connect? doesnt matter, all the sub-action timestamps
             # have been placed, so the next worker knows where to continue
@@ -645,20 +1246,30 @@ class GenericAgent():
             data = json_dumps(data)
 
         retry_policy = self._settings['retry_policy']['http_request']
-        self._current_http_request_retry = 0 # make an attribute, so that it can be observed during testing
 
         for i in range(1, retry_policy['max_retries'] + 1):
             try:
                 self._logger.debug('HTTP %s request to %s' % (method.upper(), url))
                 self._logger.debug('Headers: %s' % json_dumps(_headers))
                 self._logger.debug('Data: %s' % data)
-                self._current_http_request_retry += 1
 
-                if url.startswith("https://localhost/"):
-                    self._logger.debug('Verify: False')
-                    response = getattr(requests, method)(url, data=data, headers=_headers, verify=False)
-                else:
-                    response = getattr(requests, method)(url, data=data, headers=_headers)
+                session = self._get_http_session()
+                request_started = time.monotonic()
+
+                try:
+                    if url.startswith("https://localhost/"):
+                        self._logger.debug('Verify: False')
+                        response = getattr(session, method)(url, data=data, headers=_headers, verify=False)
+                    else:
+                        response = getattr(session, method)(url, data=data, headers=_headers)
+                except Exception:
+                    self._metrics.inc('ida_agent_http_request_errors_total', labels={ 'upstream': self._get_upstream_name(url) },
+                        help_text='HTTP requests which failed without a response, per upstream')
+                    raise
+
+                self._metrics.observe('ida_agent_http_request_duration_seconds', time.monotonic() - request_started,
+                    HTTP_LATENCY_BUCKETS, labels={ 'upstream': self._get_upstream_name(url) },
+                    help_text='HTTP request latencies, per upstream')
 
                 self._logger.debug('Response: %d %s' % (response.status_code, response.content))
                 if response.status_code in (401, 403):
@@ -677,6 +1288,11 @@ class GenericAgent():
                 if self._graceful_shutdown_started:
                     raise SystemExit
 
+                # requests are sent concurrently by several threads, so attempts are counted only by the loop
+                # variable of each request, and failed attempts are recorded in the agent metrics
+                self._metrics.inc('ida_agent_http_request_failed_attempts_total', labels={ 'upstream': self._get_upstream_name(url) },
+                    help_text='HTTP request attempts which failed, per upstream')
+
                 # use each retry_interval step, and start repeating the last (longest) step for every exceeding loop
                 retry_index = i - 1 if i - 1 < len(retry_policy['retry_intervals']) else -1
 
@@ -687,7 +1303,120 @@ class GenericAgent():
                 time.sleep(retry_policy['retry_intervals'][retry_index])
 
         raise HttpApiNotResponding('HTTP %s request %s did not respond after %d attempts'
-            % (method, url, self._current_http_request_retry))
+            % (method, url, retry_policy['max_retries']))
+
+
+    def _get_http_session(self):
+        """
+        Return the HTTP session of the agent, creating it on first use. The session keeps connections
+        to each host (IDA, Metax) alive in a connection pool, so that consecutive requests do not each
+        pay for a new TCP and TLS handshake.
+        """
+        if self._http_session is None:
+            pool_settings = self._settings['http_connection_pool']
+            session = requests.Session()
+            # Do not persist cookies between requests. Requests are authenticated per project user, and
+            # a server side session opened for one project user must never be reused for another.
+            session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=pool_settings['pool_connections'],
+                pool_maxsize=pool_settings['pool_maxsize']
+            )
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            self._http_session = session
+            self._http_adapter = adapter
+        return self._http_session
+
+
+    def _get_http_connection_stats(self):
+        """
+        Return per host counts of requests sent and connections opened by the pooled HTTP session.
+        """
+        stats = {}
+        if self._http_adapter is None:
+            return stats
+        pools = self._http_adapter.poolmanager.pools
+        for key in pools.keys():
+            try:
+                pool = pools[key]
+            except KeyError:
+                # evicted from the pool manager meanwhile
+                continue
+            stats[pool.host] = { 'requests': pool.num_requests, 'connections': pool.num_connections }
+        return stats
+
+
+    def _log_http_connection_stats(self):
+        for host, stats in self._get_http_connection_stats().items():
+            self._logger.info('HTTP connection reuse for %s: %d requests over %d connections' % (host, stats['requests'], stats['connections']))
+
+
+    def _get_upstream_name(self, url):
+        """
+        Return the name of the upstream service of a request url, used as a metrics label.
+        """
+        if url.startswith(self._ida_api_url):
+            return 'ida'
+        if getattr(self, '_metax_api_url', None) and url.startswith(self._metax_api_url):
+            return 'metax'
+        return urllib.parse.urlsplit(url).hostname or 'unknown'
+
+
+    def _record_queue_depth(self, queue, message_count):
+        self._metrics.set('ida_agent_queue_messages', message_count, labels={ 'queue': queue },
+            help_text='Messages waiting in queue, as last seen by the agent')
+
+
+    def _record_throughput(self, kind, nbytes, seconds):
+        """
+        Record bytes processed and time spent for a kind of file processing, e.g. 'hashed' or 'copied',
+        and the resulting throughput of the latest batch of files.
+        """
+        self._metrics.inc('ida_agent_%s_bytes_total' % kind, nbytes,
+            help_text='Bytes %s' % kind)
+        self._metrics.inc('ida_agent_%s_seconds_total' % kind, seconds,
+            help_text='Seconds spent on files %s' % kind)
+        if seconds > 0:
+            self._metrics.set('ida_agent_%s_bytes_per_second' % kind, nbytes / seconds,
+                help_text='Throughput of the latest batch of files %s' % kind)
+
+
+    def _write_metrics_file_if_due(self):
+        """
+        Write the metrics of the agent to its metrics file in Prometheus text format, if at least
+        metrics_interval seconds have passed since the file was last written. The file is picked up
+        by the node exporter textfile collector, or any other scraper reading the metrics directory.
+        Failing to write metrics is logged, but never interrupts the agent.
+        """
+        now = time.monotonic()
+
+        if self._metrics_written is not None and now - self._metrics_written < self._settings['metrics_interval']:
+            return
+
+        self._metrics_written = now
+
+        if self._settings.get('consumer_mode', 'poll') == 'push':
+            # in push consumer mode the queues are not polled, so refresh queue depths explicitly
+            for queue in (self.failed_queue_name, self.main_queue_name, self.failed_batch_queue_name, self.main_batch_queue_name):
+                with suppress(Exception):
+                    queue_state = self._channel.queue_declare(queue, durable=True, passive=True)
+                    self._record_queue_depth(queue, queue_state.method.message_count)
+
+        tmp_file = '%s.tmp' % self._metrics_file
+        try:
+            os.makedirs(os.path.dirname(self._metrics_file), exist_ok=True)
+            with open(tmp_file, 'w') as f:
+                f.write(self._metrics.render())
+            # replace atomically, so that a scraper never reads a partially written file
+            os.replace(tmp_file, self._metrics_file)
+        except Exception as e:
+            self._logger.warning('Unable to write metrics file %s: %s' % (self._metrics_file, str(e)))
+
+
+    def _remove_metrics_file(self):
+        with suppress(FileNotFoundError, PermissionError):
+            os.remove(self._metrics_file)
 
 
     def _get_cache_checksum(self, pathname):
@@ -705,31 +1434,122 @@ class GenericAgent():
         return None
 
 
+    def _get_cache_checksums(self, pathname):
+        """
+        Retrieve Nextcloud cache checksums for all frozen files within the specified relative pathname scope,
+        which may be either a file or a folder, with a single request. Returns a dict with relative pathnames
+        as keys and lowercased checksums as values, or None if the checksums could not be retrieved.
+        """
+
+        response = self._ida_api_request('get', '/retrieveCacheChecksums?pathname=%s' % urllib.parse.quote('frozen%s' % pathname))
+        if response.status_code not in (200, 201, 204):
+            return None
+        checksums = response.json().get('checksums', None)
+        if not isinstance(checksums, dict):
+            return None
+        return dict(
+            (node_pathname, checksum.lower()) for node_pathname, checksum in checksums.items()
+            if checksum is not None and isinstance(checksum, str) and checksum.strip() != ''
+        )
+
+
+    def _generate_checksums(self, files):
+        """
+        Generate SHA-256 checksums for multiple files concurrently, using at most checksum_workers threads.
+        Hashing releases the GIL, so the threads hash and read in parallel.
+
+        Parameter 'files' is a list of (node, file_path, file_size) tuples. The largest files are started
+        first, so that a single huge file does not end up being hashed alone after all other files are done.
+
+        Yields (node, file_path, file_size, checksum) tuples in order of completion, as soon as each checksum
+        is generated, so that the caller can record checksums progressively. If generating any checksum fails,
+        or the generator is closed before all checksums are generated, the files not yet started are cancelled,
+        and in the former case an exception is raised.
+        """
+        if not files:
+            return
+
+        self._logger.debug('Generating checksums for %d files with %d workers...' % (len(files), self._settings['checksum_workers']))
+
+        ordered_files = sorted(files, key=lambda f: f[2] or 0, reverse=True)
+        hashing_started = time.monotonic()
+        hashed_bytes = 0
+
+        with ThreadPoolExecutor(max_workers=self._settings['checksum_workers']) as executor:
+
+            futures = {}
+            for file in ordered_files:
+                futures[executor.submit(self._get_file_checksum_unless_shutdown, file[1])] = file
+
+            try:
+                for future in as_completed(futures):
+                    node, file_path, file_size = futures[future]
+                    try:
+                        checksum = future.result()
+                    except SystemExit:
+                        raise
+                    except Exception as e:
+                        raise Exception('Error generating checksum for file: %s, pathname: %s, error: %s' % (node.pid, node.pathname, str(e)))
+                    hashed_bytes += file_size or 0
+                    yield (node, file_path, file_size, checksum)
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+            finally:
+                self._record_throughput('hashed', hashed_bytes, time.monotonic() - hashing_started)
+
+
+    def _get_file_checksum_unless_shutdown(self, file_path):
+        """
+        Executed by checksum worker threads; skip files not yet started once a graceful shutdown has begun.
+        """
+        if self._graceful_shutdown_started:
+            raise SystemExit
+        return self._get_file_checksum(file_path)
+
+
     def _get_file_checksum(self, file_path, block_size=65536):
         """
-        Generate an SHA-256 checksum for the specified file
+        Generate an SHA-256 checksum for the specified file. If the checksum cache is configured, and the file
+        has not been modified since its checksum was last generated, the cached checksum is returned.
         """
-        sha = sha256()
-        with open(file_path, 'rb') as f:
-            for block in iter(lambda: f.read(block_size), b''):
-                sha.update(block)
-        checksum = sha.hexdigest()
+        checksum = generate_file_checksum(
+            file_path,
+            cache=self._get_checksum_cache(),
+            strict=self._settings['checksum_cache']['strict'],
+            block_size=block_size
+        )
         if checksum is not None and isinstance(checksum, str) and checksum.strip() != '':
             return checksum.lower()
         return None
 
 
+    def _get_checksum_cache(self):
+        """
+        Return the local persistent checksum cache, opening it on first use, or None if the cache is not
+        configured with CHECKSUM_CACHE or cannot be opened.
+        """
+        if self._checksum_cache is None and self._uida_conf_vars.get('CHECKSUM_CACHE'):
+            with self._checksum_cache_lock:
+                if self._checksum_cache is None:
+                    try:
+                        self._checksum_cache = ChecksumCache(
+                            self._uida_conf_vars['CHECKSUM_CACHE'],
+                            self._settings['checksum_cache']['max_entries']
+                        )
+                    except Exception as e:
+                        self._logger.warning('Unable to open checksum cache %s, generating all checksums: %s' % (self._uida_conf_vars['CHECKSUM_CACHE'], str(e)))
+                        self._checksum_cache = False
+        return self._checksum_cache or None
+
+
     def _get_checksum_value(self, checksum):
         """
         Return a plain checksum value, given either a SHA-256 checksum URI or a plain checksum value
         Normalize returned string to lowercase
         """
-        if checksum is not None and isinstance(checksum, str) and checksum.strip() != '':
-            checksum = checksum.lower()
-            if checksum.startswith('sha256:'):
-                return checksum[7:]
-            return checksum
-        return None
+        return get_checksum_value(checksum)
 
 
     def _get_checksum_uri(self, checksum):
@@ -737,23 +1557,14 @@ class GenericAgent():
         Return an SHA-256 checksum URI, given either a plain SHA-256 checksum value or a SHA-256 checksum URI
         Normalize returned string to lowercase
         """
-        if checksum is not None and isinstance(checksum, str) and checksum.strip() != '':
-            checksum = checksum.lower()
-            if checksum.startswith('sha256:'):
-                return checksum
-            return 'sha256:%s' % checksum
-        return None
+        return get_checksum_uri(checksum)
 
 
     def _is_offline(self):
         """
         Check if the sentinel offline file exists.
         """
-        _sentinel_offline_file = "%s/control/OFFLINE" % self._uida_conf_vars['STORAGE_OC_DATA_ROOT']
-        if os.path.isfile(_sentinel_offline_file):
-            return True
-        else:
-            return False
+        return self._offline_watch.exists()
 
 
     def _set_sentinel_monitoring_file(self, message):
@@ -822,25 +1633,31 @@ class GenericAgent():
         self._logger.info('Cleaning up old sentinel monitoring files from %s...' % self._uida_conf_vars['RABBIT_MONITORING_DIR'])
 
         # recognizes current active processes when the process is started with a
-        # command e.g. python -m agents.metadata.metadata_agent
+        # command e.g. python -m agents.metadata.metadata_agent, or is a worker process
+        # of the agent supervisor started with python -m agents.run_all
         active_agent_processes = [
             p.info['pid'] for p in psutil.process_iter(attrs=['pid', 'name', 'cmdline'])
             if 'python' in p.info['name']
             and 'cmdline' in p.info
             and len(p.info['cmdline']) > 1
             and p.info['cmdline'][-1].startswith('agents.')
-            and p.info['cmdline'][-1].endswith('_agent')
+            and (p.info['cmdline'][-1].endswith('_agent') or p.info['cmdline'][-1] == 'agents.run_all')
         ]
 
         old_monitoring_files = glob.glob(
             '%s/%s-*' % (self._uida_conf_vars['RABBIT_MONITORING_DIR'], self._hostname)
         )
 
+        # metrics files of the agent processes are cleaned up the same way
+        old_monitoring_files.extend(glob.glob(
+            '%s/%s-*.prom' % (os.path.dirname(self._metrics_file), self._hostname)
+        ))
+
         deleted_files_count = 0
 
         for file in old_monitoring_files:
             for active_pid in active_agent_processes:
-                if file.endswith(str(active_pid)):
+                if file.endswith(str(active_pid)) or file.endswith('%d.prom' % active_pid):
                     # monitoring file of an active process. do not remove!
                     break
             else:
@@ -0,0 +1,196 @@
+#--------------------------------------------------------------------------------
+# This file is part of the IDA research data storage service
+#
+# Copyright (C) 2025 Ministry of Education and Culture, Finland
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public
+# License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# @author CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# @license GNU Affero General Public License, version 3
+# @link https://research.csc.fi/
+#--------------------------------------------------------------------------------
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+
+
+class CachedCheck():
+
+    """
+    Run a health check probe periodically on a background thread, and cache its latest result.
+
+    The probe is a function taking no arguments. Its result is considered valid for ttl seconds; if the
+    cached result is older than that, e.g. because the background thread is not running, get() runs the
+    probe synchronously. A probe raising an exception is treated as returning the value of 'on_error'.
+    """
+
+    def __init__(self, name, probe, interval, ttl, logger, on_error=None):
+        self.name = name
+        self._probe = probe
+        self._interval = interval
+        self._ttl = ttl
+        self._logger = logger
+        self._on_error = on_error
+        self._lock = threading.Lock()
+        self._result = None
+        self._checked = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='health-%s' % self.name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self.refresh()
+            self._stopped.wait(self._interval)
+
+    def refresh(self):
+        """
+        Run the probe now, cache and return its result.
+        """
+        try:
+            result = self._probe()
+        except SystemExit:
+            # the agent is shutting down
+            self._stopped.set()
+            result = self._on_error
+        except BaseException as e:
+            self._logger.warning('Health check %s failed: %s' % (self.name, str(e)))
+            result = self._on_error
+        with self._lock:
+            self._result = result
+            self._checked = time.monotonic()
+        return result
+
+    def get(self):
+        with self._lock:
+            if self._checked is not None and time.monotonic() - self._checked <= self._ttl:
+                return self._result
+        return self.refresh()
+
+
+class FileWatch():
+
+    """
+    Track whether a file exists, e.g. the sentinel OFFLINE file.
+
+    If inotify is available, the directory of the file is watched on a background thread, so that the
+    file being created or removed is noticed immediately and exists() does not need to touch the disk.
+    Otherwise, or if the directory does not exist, exists() falls back to checking the file, caching the
+    result for ttl seconds.
+    """
+
+    # inotify event masks, see inotify(7)
+    IN_MOVED_FROM  = 0x00000040
+    IN_MOVED_TO    = 0x00000080
+    IN_CREATE      = 0x00000100
+    IN_DELETE      = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF   = 0x00000800
+    IN_IGNORED     = 0x00008000
+
+    def __init__(self, path, ttl, logger, use_inotify=True):
+        self._path = path
+        self._name = os.fsencode(os.path.basename(path))
+        self._ttl = ttl
+        self._logger = logger
+        self._use_inotify = use_inotify
+        self._lock = threading.Lock()
+        self._exists = None
+        self._checked = None
+        self._watching = False
+        self._fd = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        if not self._use_inotify:
+            return
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+            mask = self.IN_CREATE | self.IN_DELETE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_DELETE_SELF | self.IN_MOVE_SELF
+            if libc.inotify_add_watch(fd, os.fsencode(os.path.dirname(self._path)), mask) < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+        except Exception as e:
+            self._logger.info('Not watching %s with inotify, checking it periodically instead: %s' % (self._path, str(e)))
+            return
+        self._fd = fd
+        with self._lock:
+            # check the state only after the watch is in place, so that no change can be missed
+            self._exists = os.path.isfile(self._path)
+            self._watching = True
+        self._stopped.clear()
+        threading.Thread(target=self._run, name='watch-%s' % os.path.basename(self._path), daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        try:
+            while not self._stopped.is_set():
+                readable, _, _ = select.select([ self._fd ], [], [], 1)
+                if not readable:
+                    continue
+                data = os.read(self._fd, 65536)
+                changed = False
+                unwatched = False
+                offset = 0
+                while offset + 16 <= len(data):
+                    wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+                    name = data[offset + 16:offset + 16 + length].rstrip(b'\0')
+                    offset += 16 + length
+                    if name == self._name:
+                        changed = True
+                    if mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF | self.IN_IGNORED):
+                        unwatched = True
+                if changed or unwatched:
+                    with self._lock:
+                        self._exists = os.path.isfile(self._path)
+                        self._checked = time.monotonic()
+                if unwatched:
+                    # the watched directory is gone, fall back to checking the file
+                    self._logger.warning('Directory of %s no longer watched, checking the file periodically instead' % self._path)
+                    break
+        except Exception as e:
+            self._logger.warning('Watching %s failed, checking it periodically instead: %s' % (self._path, str(e)))
+        finally:
+            with self._lock:
+                self._watching = False
+            os.close(self._fd)
+
+    def exists(self):
+        with self._lock:
+            if self._watching:
+                return self._exists
+            if self._checked is not None and time.monotonic() - self._checked <= self._ttl:
+                return self._exists
+        exists = os.path.isfile(self._path)
+        with self._lock:
+            self._exists = exists
+            self._checked = time.monotonic()
+        return exists
@@ -0,0 +1,120 @@
+#--------------------------------------------------------------------------------
+# This file is part of the IDA research data storage service
+#
+# Copyright (C) 2025 Ministry of Education and Culture, Finland
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public
+# License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# @author CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# @license GNU Affero General Public License, version 3
+# @link https://research.csc.fi/
+#--------------------------------------------------------------------------------
+
+import threading
+
+
+HTTP_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SUB_ACTION_DURATION_BUCKETS = (1, 5, 15, 60, 300, 900, 3600, 14400, 86400)
+
+
+class AgentMetrics(object):
+
+    """
+    Counters, gauges and histograms recorded by an agent, rendered in the Prometheus text exposition format.
+
+    Metrics are identified by name and a dict of labels. Recording is thread-safe, since checksums are
+    generated and files replicated in worker threads.
+    """
+
+    def __init__(self, constant_labels=None):
+        self._constant_labels = constant_labels or {}
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._help = {}
+        self._types = {}
+
+    def _key(self, name, labels):
+        return (name, tuple(sorted((labels or {}).items())))
+
+    def _describe(self, name, metric_type, help_text):
+        self._types.setdefault(name, metric_type)
+        if help_text:
+            self._help.setdefault(name, help_text)
+
+    def inc(self, name, value=1, labels=None, help_text=None):
+        with self._lock:
+            self._describe(name, 'counter', help_text)
+            key = self._key(name, labels)
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, labels=None, help_text=None):
+        with self._lock:
+            self._describe(name, 'gauge', help_text)
+            self._gauges[self._key(name, labels)] = value
+
+    def observe(self, name, value, buckets, labels=None, help_text=None):
+        with self._lock:
+            self._describe(name, 'histogram', help_text)
+            key = self._key(name, labels)
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = { 'buckets': buckets, 'counts': [0] * len(buckets), 'count': 0, 'sum': 0 }
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram['counts'][i] += 1
+            histogram['count'] += 1
+            histogram['sum'] += value
+
+    def get(self, name, labels=None):
+        """
+        Return the current value of a counter or gauge, or the observation count of a histogram
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            if key in self._counters:
+                return self._counters[key]
+            if key in self._gauges:
+                return self._gauges[key]
+            if key in self._histograms:
+                return self._histograms[key]['count']
+        return None
+
+    def _format_labels(self, labels, extra=()):
+        labels = tuple(sorted(self._constant_labels.items())) + labels + extra
+        if not labels:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (label, str(value).replace('\\', '\\\\').replace('"', '\\"')) for label, value in labels)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name in sorted(self._types):
+                if name in self._help:
+                    lines.append('# HELP %s %s' % (name, self._help[name]))
+                lines.append('# TYPE %s %s' % (name, self._types[name]))
+                for values in (self._counters, self._gauges):
+                    for (key_name, labels), value in sorted(values.items()):
+                        if key_name == name:
+                            lines.append('%s%s %s' % (name, self._format_labels(labels), value))
+                for (key_name, labels), histogram in sorted(self._histograms.items()):
+                    if key_name != name:
+                        continue
+                    for bound, count in zip(histogram['buckets'], histogram['counts']):
+                        lines.append('%s_bucket%s %d' % (name, self._format_labels(labels, (('le', bound),)), count))
+                    lines.append('%s_bucket%s %d' % (name, self._format_labels(labels, (('le', '+Inf'),)), histogram['count']))
+                    lines.append('%s_sum%s %s' % (name, self._format_labels(labels), histogram['sum']))
+                    lines.append('%s_count%s %d' % (name, self._format_labels(labels), histogram['count']))
+        return '\n'.join(lines) + '\n'
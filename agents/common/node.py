@@ -0,0 +1,146 @@
+#--------------------------------------------------------------------------------
+# This file is part of the IDA research data storage service
+#
+# Copyright (C) 2025 Ministry of Education and Culture, Finland
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public
+# License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# @author CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# @license GNU Affero General Public License, version 3
+# @link https://research.csc.fi/
+#--------------------------------------------------------------------------------
+
+import os
+
+from agents.utils.utils import get_checksum_value, get_checksum_uri
+
+
+class Node(object):
+
+    """
+    A frozen file associated with an action, as retrieved from the IDA API, along with the flags
+    recorded for the file while it is processed by the agents.
+
+    Nodes are slotted, as large actions have up to hundreds of thousands of them in memory at once.
+    Fields not present in the IDA file record are None, and flags are False until set. Item access
+    and get() are supported for code and tests which handle nodes as dicts.
+    """
+
+    FIELDS = (
+        'id',
+        'pid',
+        'node',
+        'action',
+        'project',
+        'pathname',
+        'size',
+        'checksum',
+        'modified',
+        'frozen',
+        'metadata',
+        'replicated',
+        'removed',
+        'cleared',
+    )
+
+    FLAGS = (
+        '_updated',
+        '_copied',
+        '_checksum_mismatch',
+    )
+
+    __slots__ = FIELDS + FLAGS
+
+    def __init__(self, **fields):
+        for field in self.FIELDS:
+            setattr(self, field, fields.get(field, None))
+        for flag in self.FLAGS:
+            setattr(self, flag, fields.get(flag, False))
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Create a node from an IDA file record. Fields of the record not used by the agents are dropped.
+        """
+        return cls(**data)
+
+    def to_dict(self):
+        return dict((field, getattr(self, field)) for field in self.FIELDS if getattr(self, field) is not None)
+
+    def to_metax_v3(self, user=None):
+        """
+        Return the file metadata of the node in a form accepted by Metax API v3
+        """
+        file_metadata = {
+            'storage_service': 'ida',
+            'storage_identifier': self.pid,
+            'csc_project': self.project,
+            'pathname': self.pathname,
+            'filename': os.path.split(self.pathname)[1],
+            'size': self.size,
+            'checksum': get_checksum_uri(self.checksum),
+            'modified': self.modified,
+            'frozen': self.frozen,
+        }
+        if user:
+            file_metadata['user'] = user
+        return file_metadata
+
+    def to_metax_v1(self, file_storage, checksum_checked, user=None):
+        """
+        Return the file metadata of the node in a form accepted by Metax API v1
+        """
+        file_metadata = {
+            'file_storage': file_storage,
+            'identifier': self.pid,
+            'project_identifier': self.project,
+            'file_path': self.pathname,
+            'file_name': os.path.split(self.pathname)[1],
+            'file_frozen': self.frozen,
+            'file_modified': self.modified,
+            'file_uploaded': self.metadata,
+            'byte_size': self.size,
+            'checksum': {
+                'value': get_checksum_value(self.checksum),
+                'algorithm': 'SHA-256',
+                'checked': checksum_checked,
+            },
+            'open_access': True,
+        }
+        if user:
+            file_metadata['user_created'] = user
+        file_format = os.path.splitext(self.pathname)[1][1:]
+        if file_format:
+            file_metadata['file_format'] = file_format
+        return file_metadata
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None) if key in self.__slots__ else None
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.__slots__ and getattr(self, key) is not None
+
+    def __repr__(self):
+        return 'Node(%s)' % self.to_dict()
@@ -23,9 +23,14 @@
 
 import os
 import json
+import time
 
+from collections import deque
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from agents.common import GenericAgent
-from agents.utils.utils import construct_file_path, make_ba_http_header, generate_timestamp
+from agents.metadata.reconciliation import reconcile
+from agents.utils.utils import construct_file_path, make_ba_http_header, generate_timestamp, get_checksum_value, normalize_timestamp
 
 class MetadataAgent(GenericAgent):
 
@@ -202,13 +207,69 @@ class MetadataAgent(GenericAgent):
 
 
     def _process_checksums(self, action):
+        """
+        Generate and record checksums and sizes for the files of action as needed, processing the files
+        one page at a time. The nodes are returned for use by the following sub-actions only if all files
+        of the action were retrieved in a single page, else None is returned and the following sub-actions
+        retrieve the files again themselves, page by page.
+        """
         self._logger.info('Processing checksums for action %s' % action['pid'])
 
-        nodes = self._get_nodes_associated_with_action(action)
-
         self._logger.debug('Generating checksums...')
 
         checksum_mismatch_pids = []
+        cache_checksums = None
+        cache_checksums_retrieved = False
+        returned_nodes = None
+
+        for page_number, nodes in enumerate(self._get_node_pages_associated_with_action(action)):
+
+            checksum_files = self._get_checksum_files(action, nodes)
+
+            # Retrieve the cache checksums of all files within the scope of the action with a single request
+            # before hashing starts. If the bulk retrieval fails, fall back to retrieving them one file at a time.
+
+            if len(checksum_files) > 0 and not cache_checksums_retrieved:
+                cache_checksums = self._get_cache_checksums(action['pathname'])
+                cache_checksums_retrieved = True
+                if cache_checksums is None:
+                    self._logger.warning('Failed to retrieve cache checksums for action %s, retrieving them per file' % action['pid'])
+
+            self._update_node_checksums(action, checksum_files, cache_checksums, checksum_mismatch_pids)
+
+            # Update db records for all updated nodes of the page. Once a checksum mismatch has been detected
+            # for an action other than repair, the action will fail, so no further checksums are recorded.
+
+            if action['action'] == 'repair' or len(checksum_mismatch_pids) == 0:
+                self._logger.debug('Updating checksum and size values in IDA db for page %d of files associated with action %s' % (page_number, action['pid']))
+                self._save_nodes_to_db(nodes, fields=['checksum', 'size'], updated_only=True)
+
+            returned_nodes = nodes if page_number == 0 else None
+
+        # If there are checksum mismatches and action is not repair, fail the action; else, files with mismatched
+        # checksums have been updated in the cache with the newly generated checksums above
+
+        checksum_mismatch_pid_count = len(checksum_mismatch_pids)
+
+        if checksum_mismatch_pid_count > 0 and action['action'] != 'repair':
+            if checksum_mismatch_pid_count > 500:
+                checksum_mismatch_pids = checksum_mismatch_pids[:500]
+                checksum_mismatch_pids.append("...")
+            raise Exception('Files on disk do not match their Nextcloud cache checksums (total: %d): %s' % (
+                checksum_mismatch_pid_count,
+                json.dumps(checksum_mismatch_pids)
+            ))
+
+        self._save_action_completion_timestamp(action, 'checksums')
+        self._logger.debug('Checksums processing OK')
+        return returned_nodes
+
+
+    def _get_checksum_files(self, action, nodes):
+        """
+        Return the files for which a new checksum must be generated, as (node, file_path, file_size) tuples
+        """
+        checksum_files = []
 
         for node in nodes:
             if self._graceful_shutdown_started:
@@ -225,21 +286,9 @@ class MetadataAgent(GenericAgent):
             #
             # The following logic works efficiently both for freeze and repair actions.
 
-            # Assume no updates to either file size or checksum required
-            node_updated = False
-            checksum_mismatch = False
-
-            # Get reported file size, if defined
-            try:
-                node_size = node['size']
-            except:
-                node_size = None
-
-            # Get reported checksum, if defined
-            try:
-                node_checksum = self._get_checksum_value(node['checksum'])
-            except:
-                node_checksum = None
+            # Get reported file size and checksum, which are None if not defined
+            node_size = node.size
+            node_checksum = self._get_checksum_value(node.checksum)
 
             # If no file size is reported, or we have a repair action, get the actual size on disk
             # Else trust the reported size and avoid the cost of retrieving the size on disk
@@ -251,84 +300,113 @@ class MetadataAgent(GenericAgent):
             # If the reported file size disagrees with the determined file size, record file size
             # on disk and generate and record new checksum
             if node_size != file_size:
-                self._logger.debug('Recording both size and checksum for file %s' % node['pid'])
-                node_size = file_size
-                try:
-                    node_checksum = self._get_file_checksum(file_path)
-                except Exception as e:
-                    raise Exception('Error generating checksum for file: %s, pathname: %s, error: %s' % (node['pid'], node['pathname'], str(e)))
-                node_updated = True
+                self._logger.debug('Recording both size and checksum for file %s' % node.pid)
+                checksum_files.append((node, file_path, file_size))
 
-            # If still no checksum, generate and record new checksum
-            if node_checksum == None:
-                self._logger.debug('Recording checksum for file %s' % node['pid'])
-                try:
-                    node_checksum = self._get_file_checksum(file_path)
-                except Exception as e:
-                    raise Exception('Error generating checksum for file: %s, pathname: %s, error: %s' % (node['pid'], node['pathname'], str(e)))
-                node_updated = True
-
-            # If either new file size or new checksum, update node values and flag node as updated
-            if node_updated:
-
-                # Verify generated checksum matches cache checksum for file, if any; if not, record mismatch
-                cache_checksum = self._get_checksum_value(self._get_cache_checksum(node['pathname']))
-                self._logger.debug('Cache checksum for file %s (%s): %s' % (node['pathname'], node['pid'], cache_checksum))
-                if cache_checksum is not None and cache_checksum != '' and cache_checksum != node_checksum:
-                    self._logger.warn('Checksum mismatch for file %s (%s): cache checksum %s != generated checksum %s' % (
-                        node['pathname'],
-                        node['pid'],
-                        cache_checksum,
-                        node_checksum
-                    ))
-                    checksum_mismatch = True
-                    checksum_mismatch_pids.append(node['pathname'])
-
-                node['size'] = node_size
-                node['checksum'] = node_checksum
-                node['_updated'] = True
-                node['_checksum_mismatch'] = checksum_mismatch
+            # If no checksum, generate and record new checksum
+            elif node_checksum == None:
+                self._logger.debug('Recording checksum for file %s' % node.pid)
+                checksum_files.append((node, file_path, file_size))
 
-        # If there are checksum mismatches and action is not repair, fail the action; else, files with mismatched
-        # checksums will be updated in the cache with the newly generated checksums below
+        return checksum_files
 
-        checksum_mismatch_pid_count = len(checksum_mismatch_pids)
 
-        if checksum_mismatch_pid_count > 0 and action['action'] != 'repair':
-            if checksum_mismatch_pid_count > 500:
-                checksum_mismatch_pids = checksum_mismatch_pids[:500]
-                checksum_mismatch_pids.append("...")
-            raise Exception('Files on disk do not match their Nextcloud cache checksums (total: %d): %s' % (
-                checksum_mismatch_pid_count,
-                json.dumps(checksum_mismatch_pids)
-            ))
+    def _update_node_checksums(self, action, checksum_files, cache_checksums, checksum_mismatch_pids):
+        """
+        Generate new checksums for files concurrently, update node values and flag nodes as updated. The
+        pathnames of files whose generated checksum does not match their Nextcloud cache checksum are appended
+        to the list checksum_mismatch_pids.
 
-        # Update db records for all updated nodes
-        self._logger.info('Updating checksum and size values in IDA db for all files associated with action %s' % action['pid'])
-        self._save_nodes_to_db(nodes, fields=['checksum', 'size'], updated_only=True)
+        The checksums and sizes generated so far are checkpointed to IDA every checksum_checkpoint_files files
+        or checksum_checkpoint_seconds seconds, whichever comes first, so that if processing of the action is
+        interrupted, a retry skips the files already recorded rather than hashing them all again.
+        """
+        checkpoint_files = self._settings['checksum_checkpoint_files']
+        checkpoint_seconds = self._settings['checksum_checkpoint_seconds']
+        checkpoint_started = time.monotonic()
+        uncommitted_nodes = []
 
-        self._save_action_completion_timestamp(action, 'checksums')
-        self._logger.debug('Checksums processing OK')
-        return nodes
+        # Generate all new checksums concurrently, and update node values and flag nodes as updated
+
+        try:
+            with closing(self._generate_checksums(checksum_files)) as checksums:
+                for node, file_path, file_size, node_checksum in checksums:
+
+                    checksum_mismatch = False
+
+                    # Verify generated checksum matches cache checksum for file, if any; if not, record mismatch
+                    if cache_checksums is not None:
+                        cache_checksum = self._get_checksum_value(cache_checksums.get(node.pathname, None))
+                    else:
+                        cache_checksum = self._get_checksum_value(self._get_cache_checksum(node.pathname))
+                    self._logger.debug('Cache checksum for file %s (%s): %s' % (node.pathname, node.pid, cache_checksum))
+                    if cache_checksum is not None and cache_checksum != '' and cache_checksum != node_checksum:
+                        self._logger.warn('Checksum mismatch for file %s (%s): cache checksum %s != generated checksum %s' % (
+                            node.pathname,
+                            node.pid,
+                            cache_checksum,
+                            node_checksum
+                        ))
+                        checksum_mismatch = True
+                        checksum_mismatch_pids.append(node.pathname)
+
+                    node.size = file_size
+                    node.checksum = node_checksum
+                    node._updated = True
+                    node._checksum_mismatch = checksum_mismatch
+                    uncommitted_nodes.append(node)
+
+                    if len(uncommitted_nodes) >= checkpoint_files or time.monotonic() - checkpoint_started >= checkpoint_seconds:
+                        checkpoint_nodes, uncommitted_nodes = uncommitted_nodes, []
+                        self._checkpoint_node_checksums(action, checkpoint_nodes, checksum_mismatch_pids)
+                        checkpoint_started = time.monotonic()
+
+        except Exception:
+            # Preserve the checksums generated before the failure, if possible, so a retry need not regenerate them
+            if len(uncommitted_nodes) > 0:
+                try:
+                    self._checkpoint_node_checksums(action, uncommitted_nodes, checksum_mismatch_pids)
+                except Exception as e:
+                    self._logger.warning('Failed to checkpoint checksums for action %s: %s' % (action['pid'], str(e)))
+            raise
+
+
+    def _checkpoint_node_checksums(self, action, nodes, checksum_mismatch_pids):
+        """
+        Record the checksums and sizes of the given updated nodes in IDA and clear their updated flags, so that
+        they are not recorded again with the rest of their page. Once a checksum mismatch has been detected for an
+        action other than repair, the action will fail, so no further checksums are recorded.
+        """
+        if action['action'] == 'repair' or len(checksum_mismatch_pids) == 0:
+            self._logger.debug('Checkpointing checksum and size values in IDA db for %d files associated with action %s' % (len(nodes), action['pid']))
+            self._save_nodes_to_db(nodes, fields=['checksum', 'size'], updated_only=True)
+        for node in nodes:
+            node._updated = False
 
 
     def _process_metadata_publication(self, action, nodes):
         self._logger.info('Processing metadata publication for action %s' % action['pid'])
 
-        if not nodes:
-            nodes = self._get_nodes_associated_with_action(action)
+        # If the nodes were not retained from checksum processing, retrieve and publish them page by page
+
+        if nodes:
+            pages = [ nodes ]
+        else:
+            pages = self._get_node_pages_associated_with_action(action)
 
         metadata_start_time = generate_timestamp()
 
-        for node in nodes:
-            node['metadata'] = metadata_start_time
+        for nodes in pages:
 
-        technical_metadata = self._aggregate_technical_metadata(action, nodes)
+            for node in nodes:
+                node.metadata = metadata_start_time
 
-        self._publish_metadata(action, technical_metadata)
+            technical_metadata = self._aggregate_technical_metadata(action, nodes)
 
-        self._logger.info('Updating metadata timestamp values in IDA db for all files associated with action %s' % action['pid'])
-        self._save_nodes_to_db(nodes, fields=['metadata'])
+            self._publish_metadata(action, technical_metadata)
+
+            self._logger.info('Updating metadata timestamp values in IDA db for %d files associated with action %s' % (len(nodes), action['pid']))
+            self._save_nodes_to_db(nodes, fields=['metadata'])
 
         self._save_action_completion_timestamp(action, 'metadata')
         self._logger.debug('Metadata publication OK')
@@ -343,7 +421,7 @@ class MetadataAgent(GenericAgent):
         metadata_start_time = generate_timestamp()
 
         for node in nodes:
-            node['metadata'] = metadata_start_time
+            node.metadata = metadata_start_time
 
         technical_metadata = self._aggregate_technical_metadata(action, nodes)
 
@@ -374,49 +452,8 @@ class MetadataAgent(GenericAgent):
         Gather metadata for a single node of type 'file', in a form that is accepted by Metax
         """
         if self._metax_api_version >= 3:
-            file_metadata = {
-                'storage_service': 'ida',
-                'storage_identifier': node['pid'],
-                'csc_project': node['project'],
-                'pathname': node['pathname'],
-                'filename': os.path.split(node['pathname'])[1],
-                'size': node['size'],
-                'checksum': self._get_checksum_uri(node['checksum']),
-                'modified': node['modified'],
-                'frozen': node['frozen'],
-            }
-        else:
-            file_metadata = {
-                'file_storage': self._file_storage,
-                'identifier': node['pid'],
-                'project_identifier': node['project'],
-                'file_path': node['pathname'],
-                'file_name': os.path.split(node['pathname'])[1],
-                'file_frozen': node['frozen'],
-                'file_modified': node['modified'],
-                'file_uploaded': node['metadata'],
-                'byte_size': node['size'],
-                'checksum': {
-                    'value': self._get_checksum_value(node['checksum']),
-                    'algorithm': 'SHA-256',
-                    'checked': action['checksums'],
-                },
-                'open_access': True,
-            }
-
-        user = action.get('user', None)
-        if user:
-            if self._metax_api_version >= 3:
-                file_metadata['user'] = user
-            else:
-                file_metadata['user_created'] = user
-
-        if self._metax_api_version < 3:
-            file_format = os.path.splitext(node['pathname'])[1][1:]
-            if file_format:
-                file_metadata['file_format'] = file_format
-
-        return file_metadata
+            return node.to_metax_v3(user=action.get('user', None))
+        return node.to_metax_v1(self._file_storage, action['checksums'], user=action.get('user', None))
 
 
     def _get_frozen_file_pids(self, project):
@@ -447,17 +484,20 @@ class MetadataAgent(GenericAgent):
 
     def _get_metax_file_pids(self, project):
         """
-        Retrieve exhaustive list of PIDs of all frozen files known to Metax which are associated with project
+        Retrieve exhaustive list of PIDs of all frozen files known to Metax which are associated with project.
+
+        Returns a dict mapping the PIDs, in the order returned by Metax, to the fields of the Metax records
+        compared during repair, see _get_compared_metadata_fields().
         """
 
         self._logger.debug('Retrieving pids from Metax for all frozen files for project %s' % project)
 
-        metax_file_pids = []
+        metax_file_pids = {}
 
         if self._metax_api_version >= 3:
             url_base = "/files?csc_project=%s&storage_service=ida&limit=%d" % (project, self._chunk_size)
         else:
-            url_base = "/files?fields=identifier&file_storage=urn:nbn:fi:att:file-storage-ida&ordering=id&project_identifier=%s&limit=%d" % (project, self._chunk_size)
+            url_base = "/files?fields=identifier,file_path,byte_size,checksum,file_modified,file_frozen&file_storage=urn:nbn:fi:att:file-storage-ida&ordering=id&project_identifier=%s&limit=%d" % (project, self._chunk_size)
 
         offset = 0
         done = False # we are done when Metax returns less than the specified limit of files
@@ -476,9 +516,9 @@ class MetadataAgent(GenericAgent):
 
                 for record in file_data['results']:
                     if self._metax_api_version >= 3:
-                        metax_file_pids.append(record['storage_identifier'])
+                        metax_file_pids[record['storage_identifier']] = self._get_compared_metadata_fields(record)
                     else:
-                        metax_file_pids.append(record['identifier'])
+                        metax_file_pids[record['identifier']] = self._get_compared_metadata_fields(record)
 
             if received_count < self._chunk_size:
                 done = True
@@ -490,6 +530,38 @@ class MetadataAgent(GenericAgent):
         return metax_file_pids
 
 
+    def _get_compared_metadata_fields(self, record):
+        """
+        Return the normalized fields of a file metadata record, either generated from IDA or retrieved from Metax,
+        which are compared during repair to determine whether the Metax record needs to be updated.
+        """
+        if self._metax_api_version >= 3:
+            return (
+                record.get('pathname'),
+                record.get('size'),
+                get_checksum_value(record.get('checksum')),
+                self._normalize_compared_timestamp(record.get('modified')),
+                self._normalize_compared_timestamp(record.get('frozen')),
+            )
+        return (
+            record.get('file_path'),
+            record.get('byte_size'),
+            get_checksum_value((record.get('checksum') or {}).get('value')),
+            self._normalize_compared_timestamp(record.get('file_modified')),
+            self._normalize_compared_timestamp(record.get('file_frozen')),
+        )
+
+
+    def _normalize_compared_timestamp(self, timestamp):
+        if not timestamp:
+            return None
+        try:
+            return normalize_timestamp(timestamp)
+        except Exception:
+            # an unparseable timestamp is compared as is, and so is considered changed
+            return timestamp
+
+
     def _repair_metadata(self, technical_metadata, action):
         """
         Repair file metadata in Metax.
@@ -501,36 +573,29 @@ class MetadataAgent(GenericAgent):
         metax_file_pids  = self._get_metax_file_pids(action['project'])
 
         self._logger.debug('FROZEN FILE PIDS: %s' % json.dumps(frozen_file_pids))
-        self._logger.debug('METAX FILE PIDS: %s' % json.dumps(metax_file_pids))
+        self._logger.debug('METAX FILE PIDS: %s' % json.dumps(list(metax_file_pids)))
 
-        action_file_pids = []  # pids of frozen files associated with action
-        metax_files = []       # frozen files known to Metax
-        new_files = []         # newly frozen files, to be published to Metax
-        removed_file_pids = [] # pids of frozen files removed from IDA, to be removed from Metax
+        # segregate descriptions of all files in technical metadata based on whether they are known to Metax or not,
+        # and identify PIDs of all files known to Metax which are no longer actively frozen in IDA
 
-        # segregate descriptions of all files in technical metadata based on whether they are known to Metax or not
-
-        for record in technical_metadata:
-            if self._metax_api_version >= 3:
-                pid = record['storage_identifier']
-            else:
-                pid = record['identifier']
-            if pid in metax_file_pids:
-                metax_files.append(record)
-            else:
-                new_files.append(record)
-            action_file_pids.append(pid)
+        if self._metax_api_version >= 3:
+            pid_field = 'storage_identifier'
+        else:
+            pid_field = 'identifier'
 
-        # identify PIDs of all files known to Metax which are no longer actively frozen in IDA
+        reconciliation = reconcile(technical_metadata, frozen_file_pids, metax_file_pids, pid_field,
+            compared_fields=self._get_compared_metadata_fields)
 
-        for pid in metax_file_pids:
-            if pid not in frozen_file_pids:
-                removed_file_pids.append(pid)
+        metax_files = reconciliation.existing      # frozen files known to Metax
+        changed_files = reconciliation.changed     # frozen files known to Metax whose metadata differs in Metax
+        new_files = reconciliation.new             # newly frozen files, to be published to Metax
+        removed_file_pids = reconciliation.removed # pids of frozen files removed from IDA, to be removed from Metax
 
         frozen_file_pid_count   = len(frozen_file_pids)
-        action_file_pid_count   = len(action_file_pids)
+        action_file_pid_count   = len(technical_metadata)
         metax_file_pid_count    = len(metax_file_pids)
         metax_file_count        = len(metax_files)
+        changed_file_count      = len(changed_files)
         new_file_count          = len(new_files)
         removed_file_pid_count  = len(removed_file_pids)
 
@@ -538,6 +603,7 @@ class MetadataAgent(GenericAgent):
         self._logger.debug('ACTION FILE PID COUNT:   %d' % action_file_pid_count)
         self._logger.debug('METAX FILE PID COUNT:    %d' % metax_file_pid_count)
         self._logger.debug('METAX FILE COUNT:        %d' % metax_file_count)
+        self._logger.debug('CHANGED FILE COUNT:      %d' % changed_file_count)
         self._logger.debug('NEW FILE COUNT:          %d' % new_file_count)
         self._logger.debug('REMOVED FILE PID COUNT:  %d' % removed_file_pid_count)
 
@@ -546,311 +612,201 @@ class MetadataAgent(GenericAgent):
         # files known only to Metax with the same pathname)
 
         if removed_file_pid_count > 0:
-
-            file_count = removed_file_pid_count
-
-            self._logger.info('Deleting file metadata from Metax for repair action %s for %d removed files in maximum chunk size of %d files...' % (action['pid'], file_count, self._chunk_size))
-
-            chunk_first = 0
-            chunk_last = self._chunk_size
-            if chunk_last > file_count:
-                chunk_last = file_count
-
-            while chunk_first < file_count:
-
-                self._logger.info('Deleting file metadata from Metax for repair action %s for chunk %d:%d...' % (action['pid'], chunk_first, chunk_last))
-
-                chunk = removed_file_pids[chunk_first:chunk_last]
-
-                if self._metax_api_version >= 3:
-                    files = []
-                    for pid in chunk:
-                        files.append({ "storage_service": "ida", "storage_identifier": pid })
-                    response = self._metax_api_request('post', '/files/delete-many', data=files)
-                else:
-                    response = self._metax_api_request('delete', '/files', data=chunk)
-
-                if response.status_code not in (200, 201, 204):
-                    content = str(response.content)
-                    if len(content) > 2000:
-                        content = "%s ..." % content[:2000]
-                    raise Exception(
-                        'Metadata deletion failed for action %s, Metax returned an error, HTTP status code: %d, Response: %s'
-                        % (action['pid'], response.status_code, content)
-                    )
-
-                try:
-                    response_json = response.json()
-                except:
-                    response_json = {}
-
-                if len(response_json.get('failed', [])) > 0:
-                    errors = []
-                    for i, entry in enumerate(response_json['failed']):
-                        if self._metax_api_version >= 3:
-                            errors.append(str({ 'identifier': entry['object']['storage_identifier'], 'errors': entry['errors'] }))
-                        else:
-                            errors.append(str({ 'identifier': entry['object']['identifier'], 'errors': entry['errors'] }))
-                        if i > 10:
-                            break
-
-                    raise Exception(
-                        'Metadata deletion failed for action %s, Metax returned an error, HTTP status code: %d, First %d errors: %s'
-                        % (action['pid'], response.status_code, len(errors), '\n'.join(errors))
-                    )
-
-                chunk_first = chunk_last
-                chunk_last = chunk_last + self._chunk_size
-                if chunk_last > file_count:
-                    chunk_last = file_count
+            self._logger.info('Deleting file metadata from Metax for repair action %s for %d removed files...' % (action['pid'], removed_file_pid_count))
+            if self._metax_api_version >= 3:
+                self._submit_metax_chunks(action, removed_file_pids, 'post', '/files/delete-many', 'deletion',
+                    to_request_data=lambda chunk: [ { "storage_service": "ida", "storage_identifier": pid } for pid in chunk ])
+            else:
+                self._submit_metax_chunks(action, removed_file_pids, 'delete', '/files', 'deletion')
 
         # POST metadata descriptions of all new files
 
         if new_file_count > 0:
+            self._logger.info('Publishing file metadata to Metax for repair action %s for %d new files...' % (action['pid'], new_file_count))
+            if self._metax_api_version >= 3:
+                # Use put-many to PUT file metadata into Metax, as IDA is the authority so it's OK to replace any existing
+                # records for the frozen files in question. Even though we already detect existing and non-existing files
+                # in Metax, using put-many instead of post-many achieves the desired result most reliably.
+                self._submit_metax_chunks(action, new_files, 'post', '/files/put-many', 'publication')
+            else:
+                self._submit_metax_chunks(action, new_files, 'post', '/files', 'publication')
 
-            file_count = new_file_count
-
-            self._logger.info('Publishing file metadata to Metax for repair action %s for %d new files in maximum chunk size of %d files...' % (action['pid'], file_count, self._chunk_size))
-
-            chunk_first = 0
-            chunk_last = self._chunk_size
-            if chunk_last > file_count:
-                chunk_last = file_count
-
-            while chunk_first < file_count:
-
-                self._logger.info('Publishing file metadata to Metax for repair action %s for chunk %d:%d...' % (action['pid'], chunk_first, chunk_last))
-
-                chunk = new_files[chunk_first:chunk_last]
-
-                if self._metax_api_version >= 3:
-                    # Use put-many to PUT file metadata into Metax, as IDA is the authority so it's OK to replace any existing
-                    # records for the frozen files in question. Even though we already detect existing and non-existing files
-                    # in Metax, using put-many instead of post-many achieves the desired result most reliably.
-                    response = self._metax_api_request('post', '/files/put-many', data=chunk)
-                else:
-                    response = self._metax_api_request('post', '/files', data=chunk)
-
-                if response.status_code not in (200, 201, 204):
-                    content = str(response.content)
-                    if len(content) > 2000:
-                        content = "%s ..." % content[:2000]
-                    raise Exception(
-                        'Metadata publication failed for action %s, Metax returned an error, HTTP status code: %d, Response: %s'
-                        % (action['pid'], response.status_code, content)
-                    )
-
-                try:
-                    response_json = response.json()
-                except:
-                    response_json = {}
-
-                if len(response_json.get('failed', [])) > 0:
-                    errors = []
-                    for i, entry in enumerate(response_json['failed']):
-                        if self._metax_api_version >= 3:
-                            errors.append(str({ 'identifier': entry['object']['storage_identifier'], 'errors': entry['errors'] }))
-                        else:
-                            errors.append(str({ 'identifier': entry['object']['identifier'], 'errors': entry['errors'] }))
-                        if i > 10:
-                            break
+        # PATCH metadata descriptions of existing Metax files in action whose metadata differs from IDA metadata
 
-                    raise Exception(
-                        'Metadata publication failed for action %s, Metax returned an error, HTTP status code: %d, First %d errors: %s'
-                        % (action['pid'], response.status_code, len(errors), '\n'.join(errors))
-                    )
+        if changed_file_count > 0:
+            self._logger.info('Patching file metadata to Metax for repair action %s for %d changed files of %d existing files...' % (action['pid'], changed_file_count, metax_file_count))
+            if self._metax_api_version >= 3:
+                self._submit_metax_chunks(action, changed_files, 'post', '/files/patch-many', 'update')
+            else:
+                self._submit_metax_chunks(action, changed_files, 'patch', '/files', 'update')
+        elif metax_file_count > 0:
+            self._logger.info('File metadata in Metax is up to date for all %d existing files of repair action %s' % (metax_file_count, action['pid']))
 
-                chunk_first = chunk_last
-                chunk_last = chunk_last + self._chunk_size
-                if chunk_last > file_count:
-                    chunk_last = file_count
 
-        # PATCH metadata descriptions of all existing Metax files in action based on IDA metadata
+    def _publish_metadata(self, action, technical_metadata):
+        """
+        Publish file metadata to Metax, in chunks of at most the maximum file limit for IDA actions.
+        """
 
-        if metax_file_count > 0:
+        self._logger.info('Publishing file metadata to Metax for action %s for %d files...' % (action['pid'], len(technical_metadata)))
 
-            file_count = metax_file_count
+        if self._metax_api_version >= 3:
+            # Use put-many to PUT file metadata into Metax, as IDA is the authority so it's OK to replace any existing
+            # records for the frozen files in question. It also enables robust re-trying of failed actions if there was
+            # a partial publication of file metadata to Metax.
+            self._submit_metax_chunks(action, technical_metadata, 'post', '/files/put-many', 'publication')
+        else:
+            self._submit_metax_chunks(action, technical_metadata, 'post', '/files?ignore_already_exists_errors=true', 'publication')
 
-            self._logger.info('Patching file metadata to Metax for repair action %s for %d existing files in maximum chunk size of %d files...' % (action['pid'], file_count, self._chunk_size))
 
-            chunk_first = 0
-            chunk_last = self._chunk_size
-            if chunk_last > file_count:
-                chunk_last = file_count
+    def _submit_metax_chunks(self, action, records, method, detail_url, operation, to_request_data=None):
+        """
+        Submit records to Metax in chunks, sending at most metax_chunk_workers chunks concurrently.
+
+        The chunk size starts from the maximum file limit for IDA actions, and adapts to the response times
+        of Metax: when a chunk takes longer than metax_chunk_target_seconds to process, the following chunks
+        are made smaller, and when chunks are processed quickly, larger again, up to the maximum. A chunk
+        rejected as too large (413) or timed out by a proxy (408, 504) is split in half and resubmitted,
+        until metax_chunk_min_size is reached, and chunks are not grown back to the rejected size.
+
+        If 'to_request_data' is given, it is called with each chunk of records to produce the request
+        payload. Entries reported as failed by Metax are collected across all chunks, and reported with
+        a single exception once all chunks have been submitted. Any other error response from Metax
+        raises an exception immediately.
+        """
+        if not records:
+            return
 
-            while chunk_first < file_count:
+        max_size = self._chunk_size
+        min_size = min(self._settings['metax_chunk_min_size'], max_size)
+        workers = self._settings['metax_chunk_workers']
+        chunk_size = max_size
+        position = 0
+        resubmitted = deque()
+        in_flight = {}
+        failed = []
 
-                self._logger.info('Patching file metadata to Metax for repair action %s for chunk %d:%d...' % (action['pid'], chunk_first, chunk_last))
+        self._logger.debug('Submitting %d records to Metax in maximum chunk size of %d with %d workers...' % (len(records), max_size, workers))
 
-                chunk = metax_files[chunk_first:chunk_last]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            try:
+                while position < len(records) or resubmitted or in_flight:
 
+                    while len(in_flight) < workers and (resubmitted or position < len(records)):
+                        if resubmitted:
+                            chunk = resubmitted.popleft()
+                        else:
+                            chunk = records[position:position + chunk_size]
+                            position += len(chunk)
+                        data = to_request_data(chunk) if to_request_data else chunk
+                        self._logger.info('Metadata %s to Metax for action %s for %d files...' % (operation, action['pid'], len(chunk)))
+                        in_flight[executor.submit(self._send_metax_chunk, method, detail_url, data)] = chunk
+
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+
+                    for future in done:
+                        chunk = in_flight.pop(future)
+                        response, elapsed = future.result()
+
+                        if response.status_code in (408, 413, 504):
+                            if len(chunk) <= min_size:
+                                raise Exception(
+                                    'Metadata %s failed for action %s, Metax rejected a chunk of the minimum size of %d files, HTTP status code: %d'
+                                    % (operation, action['pid'], len(chunk), response.status_code)
+                                )
+                            # never grow chunks back to a size which has been rejected
+                            max_size = min(max_size, len(chunk) - 1)
+                            half = len(chunk) // 2
+                            chunk_size = max(min_size, min(chunk_size, half))
+                            self._logger.warning(
+                                'Metax rejected a chunk of %d files with HTTP status code %d. Resubmitting in halves, reducing chunk size to %d'
+                                % (len(chunk), response.status_code, chunk_size)
+                            )
+                            resubmitted.append(chunk[:half])
+                            resubmitted.append(chunk[half:])
+                            continue
+
+                        if response.status_code not in (200, 201, 204):
+                            content = str(response.content)
+                            if len(content) > 2000:
+                                content = "%s ..." % content[:2000]
+                            raise Exception(
+                                'Metadata %s failed for action %s, Metax returned an error, HTTP status code: %d, Response: %s'
+                                % (operation, action['pid'], response.status_code, content)
+                            )
+
+                        try:
+                            response_json = response.json()
+                        except:
+                            response_json = {}
+
+                        failed.extend(response_json.get('failed', []))
+
+                        chunk_size = self._adapt_metax_chunk_size(chunk_size, len(chunk), elapsed, min_size, max_size)
+
+            except BaseException:
+                # do not send any more chunks. requests already in progress are completed before the executor exits.
+                for future in in_flight:
+                    future.cancel()
+                raise
+
+        if failed:
+            errors = []
+            for entry in failed[:12]:
                 if self._metax_api_version >= 3:
-                    response = self._metax_api_request('post', '/files/patch-many', data=chunk)
+                    errors.append(str({ 'identifier': entry['object']['storage_identifier'], 'errors': entry['errors'] }))
                 else:
-                    response = self._metax_api_request('patch', '/files', data=chunk)
-
-                if response.status_code not in (200, 201, 204):
-                    content = str(response.content)
-                    if len(content) > 2000:
-                        content = "%s ..." % content[:2000]
-                    raise Exception(
-                        'Metadata update failed for action %s, Metax returned an error, HTTP status code: %d, Response: %s'
-                        % (action['pid'], response.status_code, content)
-                    )
-
-                try:
-                    response_json = response.json()
-                except:
-                    response_json = {}
-
-                if len(response_json.get('failed', [])) > 0:
-                    errors = []
-                    for i, entry in enumerate(response_json['failed']):
-                        if self._metax_api_version >= 3:
-                            errors.append(str({ 'identifier': entry['object']['storage_identifier'], 'errors': entry['errors'] }))
-                        else:
-                            errors.append(str({ 'identifier': entry['object']['identifier'], 'errors': entry['errors'] }))
-                        if i > 10:
-                            break
-
-                    raise Exception(
-                        'Metadata update failed for action %s, Metax returned an error, HTTP status code: %d, First %d errors: %s'
-                        % (action['pid'], response.status_code, len(errors), '\n'.join(errors))
-                    )
-
-                chunk_first = chunk_last
-                chunk_last = chunk_last + self._chunk_size
-                if chunk_last > file_count:
-                    chunk_last = file_count
+                    errors.append(str({ 'identifier': entry['object']['identifier'], 'errors': entry['errors'] }))
+            raise Exception(
+                'Metadata %s failed for action %s, Metax reported %d failed files, First %d errors: %s'
+                % (operation, action['pid'], len(failed), len(errors), '\n'.join(errors))
+            )
 
 
-    def _publish_metadata(self, action, technical_metadata):
+    def _send_metax_chunk(self, method, detail_url, data):
         """
-        Publish file metadata to Metax, in chunks equal to maximum file limit for IDA actions.
+        Executed by Metax chunk submission worker threads. Returns the response and the seconds it took.
         """
+        started = time.monotonic()
+        response = self._metax_api_request(method, detail_url, data=data)
+        return response, time.monotonic() - started
 
-        self._logger.info('Publishing metadata to Metax for action %s' % action['pid'])
-
-        file_count = len(technical_metadata)
 
-        self._logger.info('Publishing file metadata to Metax for action %s for %d files in maximum chunk size of %d files...' % (action['pid'], file_count, self._chunk_size))
-
-        chunk_first = 0
-        chunk_last = self._chunk_size
-        if chunk_last > file_count:
-            chunk_last = file_count
-
-        while chunk_first < file_count:
-
-            self._logger.info('Publishing file metadata to Metax for action %s for chunk %d:%d...' % (action['pid'], chunk_first, chunk_last))
-
-            chunk = technical_metadata[chunk_first:chunk_last]
-
-            if self._metax_api_version >= 3:
-                # Use put-many to PUT file metadata into Metax, as IDA is the authority so it's OK to replace any existing
-                # records for the frozen files in question. It also enables robust re-trying of failed actions if there was
-                # a partial publication of file metadata to Metax.
-                response = self._metax_api_request('post', '/files/put-many', data=chunk)
-            else:
-                response = self._metax_api_request('post', '/files?ignore_already_exists_errors=true', data=chunk)
-
-            if response.status_code not in (200, 201, 204):
-                content = str(response.content)
-                if len(content) > 2000:
-                    content = "%s ..." % content[:2000]
-                raise Exception(
-                    'Metadata publication failed for action %s, Metax returned an error, HTTP status code: %d, Response: %s'
-                    % (action['pid'], response.status_code, content)
-                )
-
-            try:
-                response_json = response.json()
-            except:
-                response_json = {}
-
-            if len(response_json.get('failed', [])) > 0:
-                errors = []
-                for i, entry in enumerate(response_json['failed']):
-                    if self._metax_api_version >= 3:
-                        errors.append(str({ 'identifier': entry['object']['storage_identifier'], 'errors': entry['errors'] }))
-                    else:
-                        errors.append(str({ 'identifier': entry['object']['identifier'], 'errors': entry['errors'] }))
-                    if i > 10:
-                        break
-
-                raise Exception(
-                    'Metadata publication failed for action %s, Metax returned an error, HTTP status code: %d, First %d errors: %s'
-                    % (action['pid'], response.status_code, len(errors), '\n'.join(errors))
-                )
-
-            chunk_first = chunk_last
-            chunk_last = chunk_last + self._chunk_size
-            if chunk_last > file_count:
-                chunk_last = file_count
+    def _adapt_metax_chunk_size(self, chunk_size, chunk_length, elapsed, min_size, max_size):
+        """
+        Return the chunk size to use for the following chunks, based on how long Metax took to process a chunk
+        of chunk_length records. Chunks are halved when Metax is slow, and grown by half when Metax is fast.
+        """
+        target = self._settings['metax_chunk_target_seconds']
+        if elapsed > target:
+            new_size = max(min_size, min(chunk_size, chunk_length) // 2)
+        elif elapsed < target / 2 and chunk_length >= chunk_size:
+            new_size = min(max_size, chunk_size + chunk_size // 2)
+        else:
+            new_size = chunk_size
+        if new_size != chunk_size:
+            self._logger.debug('Metax processed %d files in %.1f seconds. Adjusting chunk size to %d' % (chunk_length, elapsed, new_size))
+        return new_size
 
 
     def _process_metadata_deletion(self, action):
 
         self._logger.info('Processing metadata deletion for action %s' % action['pid'])
 
-        nodes = self._get_nodes_associated_with_action(action)
-        file_identifiers = [ n['pid'] for n in nodes ]
-        file_count = len(file_identifiers)
-
-        self._logger.info('Deleting files from Metax for action %s for %d files in maximum chunk size of %d files...' % (action['pid'], file_count, self._chunk_size))
-
-        chunk_first = 0
-        chunk_last = self._chunk_size
-        if chunk_last > file_count:
-            chunk_last = file_count
-
-        while chunk_first < file_count:
+        # Only the pids of the files are needed, so retain only them from each page of files
+        file_identifiers = []
+        for nodes in self._get_node_pages_associated_with_action(action):
+            file_identifiers.extend(node.pid for node in nodes)
 
-            self._logger.info('Deleting files from Metax for action %s for chunk %d:%d...' % (action['pid'], chunk_first, chunk_last))
+        self._logger.info('Deleting files from Metax for action %s for %d files...' % (action['pid'], len(file_identifiers)))
 
-            chunk = file_identifiers[chunk_first:chunk_last]
-
-            if self._metax_api_version >= 3:
-                files = []
-                for pid in chunk:
-                    files.append({ "csc_project": action["project"], "storage_service": "ida", "storage_identifier": pid })
-                response = self._metax_api_request('post', '/files/delete-many', data=files)
-            else:
-                response = self._metax_api_request('delete', '/files', data=chunk)
-
-            if response.status_code not in (200, 201, 204):
-                content = str(response.content)
-                if len(content) > 2000:
-                    content = "%s ..." % content[:2000]
-                raise Exception(
-                    'Metadata deletion failed for action %s, Metax returned an error, HTTP status code: %d, Error message: %s'
-                    % (action['pid'], response.status_code, content)
-                )
-
-            try:
-                response_json = response.json()
-            except:
-                response_json = {}
-
-            if len(response_json.get('failed', [])) > 0:
-                errors = []
-                for i, entry in enumerate(response_json['failed']):
-                    if self._metax_api_version >= 3:
-                        errors.append(str({ 'identifier': entry['object']['storage_identifier'], 'errors': entry['errors'] }))
-                    else:
-                        errors.append(str({ 'identifier': entry['object']['identifier'], 'errors': entry['errors'] }))
-                    if i > 10:
-                        break
-
-                raise Exception(
-                    'Metadata deletion failed for action %s, Metax returned an error, HTTP status code: %d, First %d errors: %s'
-                    % (action['pid'], response.status_code, len(errors), '\n'.join(errors))
-                )
-
-            chunk_first = chunk_last
-            chunk_last = chunk_last + self._chunk_size
-            if chunk_last > file_count:
-                chunk_last = file_count
+        if self._metax_api_version >= 3:
+            self._submit_metax_chunks(action, file_identifiers, 'post', '/files/delete-many', 'deletion',
+                to_request_data=lambda chunk: [
+                    { "csc_project": action["project"], "storage_service": "ida", "storage_identifier": pid } for pid in chunk
+                ])
+        else:
+            self._submit_metax_chunks(action, file_identifiers, 'delete', '/files', 'deletion')
 
         self._save_action_completion_timestamp(action, 'metadata')
 
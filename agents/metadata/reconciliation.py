@@ -0,0 +1,68 @@
+#--------------------------------------------------------------------------------
+# This file is part of the IDA research data storage service
+#
+# Copyright (C) 2018 Ministry of Education and Culture, Finland
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public
+# License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# @author CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# @license GNU Affero General Public License, version 3
+# @link https://research.csc.fi/
+#--------------------------------------------------------------------------------
+
+from collections import namedtuple
+
+
+# new:       records of files not known to Metax, to be published
+# existing:  records of files already known to Metax
+# changed:   records of files known to Metax whose metadata in Metax differs, to be updated
+# removed:   pids of files known to Metax which are no longer frozen in IDA, to be deleted
+Reconciliation = namedtuple('Reconciliation', [ 'new', 'existing', 'changed', 'removed' ])
+
+
+def reconcile(records, frozen_file_pids, metax_files, pid_field, compared_fields=None):
+    """
+    Reconcile the technical metadata records of files being repaired with the files known to Metax.
+
+    Membership is tested against sets of pids, so the cost grows linearly with the number of files
+    in the project. The order of the records and the Metax pids is preserved in the results.
+
+    Parameter 'records' is a list of technical metadata records, identified by their field pid_field.
+    Parameter 'frozen_file_pids' is an iterable of the pids of all frozen files of the project in IDA.
+    Parameter 'metax_files' is either an iterable of the pids of all files of the project known to Metax,
+    or a dict mapping those pids to the compared fields of the Metax records, as returned by the function
+    'compared_fields' for a record. An existing record is changed if its compared fields differ from those
+    of the Metax record, or if either is not known.
+    """
+    frozen_file_pids = frozen_file_pids if isinstance(frozen_file_pids, (set, frozenset, dict)) else set(frozen_file_pids)
+    metax_pids = metax_files if isinstance(metax_files, (set, frozenset, dict)) else set(metax_files)
+    metax_fields = metax_files if isinstance(metax_files, dict) else {}
+
+    new = []
+    existing = []
+    changed = []
+
+    for record in records:
+        pid = record[pid_field]
+        if pid in metax_pids:
+            existing.append(record)
+            fields = metax_fields.get(pid)
+            if compared_fields is None or fields is None or compared_fields(record) != fields:
+                changed.append(record)
+        else:
+            new.append(record)
+
+    removed = [ pid for pid in metax_files if pid not in frozen_file_pids ]
+
+    return Reconciliation(new, existing, changed, removed)
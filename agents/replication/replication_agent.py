@@ -24,10 +24,14 @@
 import errno
 import os
 import shutil
+import time
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from hashlib import sha256
 from subprocess import PIPE, run
 from agents.common import GenericAgent
 from agents.exceptions import ReplicationRootNotMounted
+from agents.utils.file_copy import FileCopier
 from agents.utils.utils import construct_file_path, generate_timestamp
 
 
@@ -42,6 +46,11 @@ class ReplicationAgent(GenericAgent):
         self.main_batch_queue_name = 'batch-replication'
         self.failed_batch_queue_name = 'batch-replication-failed'
 
+        self._file_copier = FileCopier(self._settings['replication_block_size'])
+
+        if self._settings['replication_zero_copy'] and self._settings['replication_verification'] != 'readback':
+            self._logger.warning('Setting replication_zero_copy has no effect unless replication_verification is readback')
+
         # diagnostic variables for development and testing
         self.last_number_of_files_replicated = 0
 
@@ -81,7 +90,7 @@ class ReplicationAgent(GenericAgent):
             if not os.access(_dmfstatus, os.X_OK):
                 raise PermissionError("The script %s is not executable!" % _dmfstatus)
 
-            _result = run(_dmfstatus, stdout=PIPE, stderr=PIPE, universal_newlines=True)
+            _result = run(_dmfstatus, stdout=PIPE, stderr=PIPE, universal_newlines=True, timeout=self._settings['health_checks']['probe_timeout'])
 
             if _result.returncode != 0:
                 self._logger.warning("Dependencies not OK: DMF service not available: %s %s" % (_result.stdout, _result.stderr))
@@ -113,48 +122,116 @@ class ReplicationAgent(GenericAgent):
         """
         Process replication for nodes in action.
 
-        Replication basically means just a regular file copy from place a to b.
+        Replication basically means just a regular file copy from place a to b. Files are copied
+        concurrently by at most replication_workers threads, and the replicated timestamps of copied
+        files are saved to IDA db in batches of replication_commit_batch_size files. The files of the
+        action are retrieved and replicated one page at a time.
         """
 
         self._check_replication_root_is_mounted()
-        nodes = self._get_nodes_associated_with_action(action)
         replication_start_time = generate_timestamp()
         files_copied = 0
 
+        for nodes in self._get_node_pages_associated_with_action(action):
+            files_copied += self._replicate_nodes(action, nodes, replication_start_time)
+
+        self.last_number_of_files_replicated = files_copied
+        self._save_action_completion_timestamp(action, 'replication')
+        self._save_action_completion_timestamp(action, 'completed')
+
+        self._logger.debug('Replication processing OK')
+
+    def _replicate_nodes(self, action, nodes, replication_start_time):
+        """
+        Replicate the specified nodes of action, and return the number of files actually copied.
+        """
+        files_copied = 0
+        bytes_copied = 0
+
+        replicated_nodes = []
+
         for node in nodes:
 
-            if not node.get('checksum', None):
-                raise Exception('Node %s did not have checksum generated before starting replication.' % node['pid'])
+            if not node.checksum:
+                raise Exception('Node %s did not have checksum generated before starting replication.' % node.pid)
 
-            if node.get('replicated', None) and action['action'] != 'repair':
-                self._logger.debug('Node %s already copied, skipping...' % node['pid'])
+            if node.replicated and action['action'] != 'repair':
+                self._logger.debug('Node %s already copied, skipping...' % node.pid)
                 continue
 
+            replicated_nodes.append(node)
+
+        self._logger.debug('Replicating %d files with %d workers...' % (len(replicated_nodes), self._settings['replication_workers']))
+
+        commit_batch_size = self._settings['replication_commit_batch_size']
+        uncommitted_nodes = []
+        futures = []
+        consumed_futures = set()
+        copying_started = time.monotonic()
+
+        try:
+            with ThreadPoolExecutor(max_workers=self._settings['replication_workers']) as executor:
+
+                for node in replicated_nodes:
+                    futures.append(executor.submit(self._replicate_node, node, replication_start_time))
+
+                try:
+                    for future in as_completed(futures):
+                        node = future.result()
+                        consumed_futures.add(future)
+                        uncommitted_nodes.append(node)
+                        if node._copied:
+                            files_copied += 1
+                            bytes_copied += node.size or 0
+
+                        # save successfully replicated nodes to IDA db in batches, in case the replication
+                        # process fails later. this way, already replicated files will not be replicated
+                        # again during a retry.
+                        if len(uncommitted_nodes) >= commit_batch_size:
+                            self._save_nodes_to_db(uncommitted_nodes, fields=['replicated'], updated_only=True)
+                            uncommitted_nodes = []
+
+                except BaseException:
+                    # do not start copying any more files. copies already in progress are completed
+                    # before the executor exits.
+                    for future in futures:
+                        future.cancel()
+                    raise
+
+        except Exception:
+            # save also the nodes of copies which completed after the failure
+            for future in futures:
+                if future not in consumed_futures and future.done() and not future.cancelled() and future.exception() is None:
+                    uncommitted_nodes.append(future.result())
             try:
-                self._copy_to_replication_location(node, replication_start_time)
+                self._save_nodes_to_db(uncommitted_nodes, fields=['replicated'], updated_only=True)
             except Exception:
-                # on any error during file copy, check if the error is because the mount
-                # point disappeared. if there is an error, the below method will raise
-                # a ReplicationRootNotMounted exception, and the error will not count
-                # towards retry limits.
-                self._check_replication_root_is_mounted()
-
-                # if code still executes here, the error was because of something else...
-                # send the error down the usual error handling route.
-                raise
+                self._logger.warning('Saving replicated timestamps of %d files after replication failure failed' % len(uncommitted_nodes))
 
-            # save each individual successfully replicated node to IDA db immediately,
-            # in case the replication process fails later. this way, already replicated
-            # files will not be replicated again during a retry.
-            self._save_nodes_to_db([node], fields=['replicated'], updated_only=True)
-            if node.get('_copied', False) == True:
-                files_copied += 1
+            # on any error during file copy, check if the error is because the mount
+            # point disappeared. if there is an error, the below method will raise
+            # a ReplicationRootNotMounted exception, and the error will not count
+            # towards retry limits.
+            self._check_replication_root_is_mounted()
 
-        self.last_number_of_files_replicated = files_copied
-        self._save_action_completion_timestamp(action, 'replication')
-        self._save_action_completion_timestamp(action, 'completed')
+            # if code still executes here, the error was because of something else...
+            # send the error down the usual error handling route.
+            raise
 
-        self._logger.debug('Replication processing OK')
+        self._save_nodes_to_db(uncommitted_nodes, fields=['replicated'], updated_only=True)
+
+        self._record_throughput('copied', bytes_copied, time.monotonic() - copying_started)
+
+        return files_copied
+
+    def _replicate_node(self, node, timestamp):
+        """
+        Executed by replication worker threads. Returns the replicated node.
+        """
+        if self._graceful_shutdown_started:
+            raise SystemExit
+        self._copy_to_replication_location(node, timestamp)
+        return node
 
     def _check_replication_root_is_mounted(self):
         """
@@ -179,8 +256,12 @@ class ReplicationAgent(GenericAgent):
         """
         Copy a single node from frozen location to replication location.
 
-        As an extra precaution, checksums are re-calculated for files after copy,
-        and compared with the checksums of the initial checksum generation phase.
+        As an extra precaution, a checksum is generated from the bytes copied, while copying, and compared
+        with the checksum of the initial checksum generation phase. If the setting replication_verification
+        is 'readback', the copied file is additionally read back from disk, bypassing the page cache, and
+        its checksum likewise compared. In that case, if the setting replication_zero_copy is true, the file
+        is copied without the data passing through user space where supported, and is verified only by
+        reading it back.
 
         Note that for efficiencies sake, during repair of a project, the file will not be re-copied
         if a replication already exists and the file size is the same for both the frozen file and
@@ -194,35 +275,76 @@ class ReplicationAgent(GenericAgent):
             if os.stat(src_path).st_size == os.stat(dest_path).st_size:
                 self._logger.debug('Skipping already replicated file: %s' % dest_path)
                 # If the file has no replicated timestamp defined, set it to the frozen timestamp
-                if not node.get('replicated', None):
-                    self._logger.debug('Fixing missing replicated timestamp: %s' % node['frozen'])
-                    node['replicated'] = node['frozen']
-                    node['_updated'] = True
+                if not node.replicated:
+                    self._logger.debug('Fixing missing replicated timestamp: %s' % node.frozen)
+                    node.replicated = node.frozen
+                    node._updated = True
                 return
 
         try:
-            shutil.copy(src_path, dest_path)
+            copied_checksum = self._copy_file(src_path, dest_path)
         except IOError as e:
             # ENOENT(2): file does not exist, raised also on missing dest parent dir
             if e.errno != errno.ENOENT:
                 raise
             os.makedirs(os.path.dirname(dest_path), exist_ok=True)
-            shutil.copy(src_path, dest_path)
+            copied_checksum = self._copy_file(src_path, dest_path)
 
-        try:
-            replicated_checksum = self._get_file_checksum(dest_path)
-        except Exception as e:
-            raise Exception('Error generating checksum for file: %s, pathname: %s, error: %s' % (node['pid'], node['pathname'], str(e)))
+        replicated_checksums = [ copied_checksum ] if copied_checksum is not None else []
+
+        if self._settings['replication_verification'] == 'readback':
+            try:
+                replicated_checksums.append(self._get_uncached_file_checksum(dest_path))
+            except Exception as e:
+                raise Exception('Error generating checksum for file: %s, pathname: %s, error: %s' % (node.pid, node.pathname, str(e)))
 
         # Remove any sha256: URI prefix
-        node['checksum'] = self._get_checksum_value(node['checksum'])
+        node.checksum = self._get_checksum_value(node.checksum)
+
+        for replicated_checksum in replicated_checksums:
+            if node.checksum != replicated_checksum:
+                raise Exception('Checksum mismatch after replication for file: %s, pathname: %s, frozen_checksum: %s, replicated_checksum: %s' % (node.pid, node.pathname, node.checksum, replicated_checksum))
+
+        node.replicated = timestamp
+        node._updated = True
+        node._copied = True
+
+    def _copy_file(self, src_path, dest_path):
+        """
+        Copy file contents and permission bits from src_path to dest_path, generating an SHA-256
+        checksum of the copied bytes in the same pass. Returns the checksum, or None if the file was
+        copied without the data passing through user space, in which case it is verified by read back.
+        """
+        readback = self._settings['replication_verification'] == 'readback'
+        sha = None if readback and self._settings['replication_zero_copy'] else sha256()
+
+        with open(src_path, 'rb', buffering=0) as src, open(dest_path, 'wb', buffering=0) as dest:
+            method = self._file_copier.copy(src, dest, sha)
+            if readback:
+                # ensure the copy is on disk, so that it can be dropped from the page cache before read back
+                os.fsync(dest.fileno())
+
+        self._logger.debug('Copied file %s using %s' % (dest_path, method))
+
+        shutil.copymode(src_path, dest_path)
+
+        return sha.hexdigest().lower() if sha is not None else None
+
+    def _get_uncached_file_checksum(self, file_path):
+        """
+        Generate an SHA-256 checksum for the specified file, advising the kernel to drop any cached pages
+        of the file first, so that the checksum reflects what was actually written to disk.
+        """
+        block_size = self._settings['replication_block_size']
+        sha = sha256()
 
-        if node['checksum'] != replicated_checksum:
-            raise Exception('Checksum mismatch after replication for file: %s, pathname: %s, frozen_checksum: %s, replicated_checksum: %s' % (node['pid'], node['pathname'], node['checksum'], replicated_checksum))
+        with open(file_path, 'rb') as f:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+            for block in iter(lambda: f.read(block_size), b''):
+                sha.update(block)
 
-        node['replicated'] = timestamp
-        node['_updated'] = True
-        node['_copied'] = True
+        return sha.hexdigest().lower()
 
     def _republish_or_fail_action(self, method, action, sub_action_name, queue, exception):
         """
@@ -21,42 +21,166 @@
 # @link     https://research.csc.fi/
 #--------------------------------------------------------------------------------
 
-from time import sleep
+import multiprocessing
+import os
+import signal
+import sys
+import time
 
-import gevent
+from agents.utils.utils import get_settings, get_logger, load_variables_from_uida_conf_files
 
-from agents.metadata.metadata_agent import MetadataAgent
-from agents.replication.replication_agent import ReplicationAgent
-from agents.utils.utils import get_settings, get_logger
 
+AGENT_TYPES = ('metadata', 'replication')
 
-settings = get_settings()
 
-def sleeper():
-    while True:
-        sleep(settings['main_loop_delay'])
-        gevent.sleep(0)
+def run_agent(agent_type):
+    """
+    Entry point of an agent worker process. Agents are imported only here, so that the supervisor
+    process itself never opens rabbitmq connections which would then be shared by its workers.
+    """
+    # Detach from the process group of the supervisor, so that an interrupt from the terminal is received
+    # only by the supervisor, which then propagates it to all workers exactly once. Until the agent installs
+    # its own signal handlers, default signal handling applies instead of the inherited supervisor handlers.
+    os.setpgrp()
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
 
+    if agent_type == 'metadata':
+        from agents.metadata.metadata_agent import MetadataAgent
+        agent = MetadataAgent()
+    elif agent_type == 'replication':
+        from agents.replication.replication_agent import ReplicationAgent
+        agent = ReplicationAgent()
+    else:
+        raise Exception('Unknown agent type: %s' % agent_type)
+
+    agent.start()
+
+
+class AgentWorker(object):
 
-if __name__ == '__main__':
     """
-    Runs one agent's main loop once, and yields execution to another agent (once added).
-    Repeat.
+    Book-keeping of a single supervised agent worker process slot.
     """
 
-    logger = get_logger('agents.run_all.py')
-    logger.info('---- running all rabbitmq agents ---')
+    def __init__(self, agent_type, slot):
+        self.agent_type = agent_type
+        self.slot = slot
+        self.process = None
+        self.started = None
+        self.failures = 0           # Number of consecutive failures, reset when a worker has run long enough
+        self.restart_after = 0      # Monotonic time after which a failed worker may be restarted
+
+    def __str__(self):
+        return '%s-%d' % (self.agent_type, self.slot)
+
+
+class AgentSupervisor(object):
+
+    """
+    Runs the configured number of worker processes per agent type, so that postprocessing on a single
+    host can use all of its cores. Crashed workers are restarted with an exponentially increasing delay.
+    SIGTERM and SIGINT are propagated to all workers as SIGTERM, triggering their graceful shutdown,
+    and workers which do not exit within supervisor_shutdown_timeout seconds are killed.
+
+    Each worker is an ordinary agent process, and so maintains its own sentinel monitoring file.
+    """
+
+    def __init__(self, settings=None, target=run_agent):
+        uida_conf_vars = load_variables_from_uida_conf_files()
+        self._settings = settings or get_settings(uida_conf_vars)
+        self._target = target
+        self._logger = get_logger('agents.run_all', uida_conf_vars)
+        self._shutdown_started = False
+        self._context = multiprocessing.get_context('fork')
+        self.workers = [
+            AgentWorker(agent_type, slot)
+            for agent_type in AGENT_TYPES
+            for slot in range(self._settings['supervisor_workers'].get(agent_type, 0))
+        ]
+
+    def start(self):
+        signal.signal(signal.SIGTERM, lambda signal, frame: self._signal_shutdown_started())
+        signal.signal(signal.SIGINT, lambda signal, frame: self._signal_shutdown_started())
+
+        self._logger.info('---- starting %d rabbitmq agent workers ---' % len(self.workers))
+
+        while not self._shutdown_started:
+            self.check_workers()
+            time.sleep(1)
+
+        self.stop_workers()
+
+        self._logger.info('---- rabbitmq agents stopped ---')
 
-    MdA = MetadataAgent()
-    MdA.gevent = gevent
-    RA = ReplicationAgent()
-    RA.gevent = gevent
+    def _signal_shutdown_started(self):
+        if not self._shutdown_started:
+            self._logger.info('Caught shutdown signal, stopping all agent workers...')
+        self._shutdown_started = True
 
-    try:
-        gevent.joinall([
-            gevent.spawn(MdA.start),
-            gevent.spawn(RA.start),
-            gevent.spawn(sleeper),
-        ])
-    except KeyboardInterrupt:
-        logger.info('---- rabbitmq agents stopped ---')
+    def check_workers(self):
+        """
+        Start workers which have not yet been started, and restart exited workers once their restart delay
+        has passed.
+        """
+        now = time.monotonic()
+
+        for worker in self.workers:
+
+            if worker.process is not None and not worker.process.is_alive():
+
+                worker.process.join()
+                exitcode = worker.process.exitcode
+                worker.process = None
+
+                if now - worker.started >= self._settings['supervisor_restart_max_delay']:
+                    worker.failures = 0
+
+                worker.failures += 1
+                delay = self.restart_delay(worker.failures)
+                worker.restart_after = now + delay
+
+                self._logger.error('Agent worker %s exited with code %s, restarting in %d seconds' % (worker, exitcode, delay))
+
+            if worker.process is None and now >= worker.restart_after:
+                self._start_worker(worker)
+
+    def restart_delay(self, failures):
+        """
+        Return the delay in seconds before restarting a worker after the given number of consecutive failures
+        """
+        delay = self._settings['supervisor_restart_delay'] * (2 ** (failures - 1))
+        return min(delay, self._settings['supervisor_restart_max_delay'])
+
+    def _start_worker(self, worker):
+        worker.process = self._context.Process(target=self._target, args=(worker.agent_type,), name=str(worker))
+        worker.process.start()
+        worker.started = time.monotonic()
+        self._logger.info('Started agent worker %s with pid %d' % (worker, worker.process.pid))
+
+    def stop_workers(self):
+        """
+        Ask all workers to shut down gracefully, and kill any workers which do not exit in time.
+        """
+        running = [ worker for worker in self.workers if worker.process is not None and worker.process.is_alive() ]
+
+        for worker in running:
+            self._logger.info('Stopping agent worker %s with pid %d' % (worker, worker.process.pid))
+            worker.process.terminate()
+
+        deadline = time.monotonic() + self._settings['supervisor_shutdown_timeout']
+
+        for worker in running:
+            worker.process.join(max(0, deadline - time.monotonic()))
+            if worker.process.is_alive():
+                self._logger.warning('Agent worker %s did not stop in time, killing it' % worker)
+                worker.process.kill()
+                worker.process.join()
+
+
+if __name__ == '__main__':
+    """
+    Runs the configured number of processes of each agent, restarting any which crash.
+    """
+    AgentSupervisor().start()
+    sys.exit(0)
@@ -42,6 +42,43 @@ production = {
     # when continuously consuming queues, sleep how many seconds between messages
     "main_loop_delay": 10,
 
+    # how messages are consumed from the queues. 'poll' checks the queues for messages once
+    # every main_loop_delay seconds. 'push' registers consumers on all queues, so that rabbitmq
+    # delivers messages to the agent as soon as they are published; an idle agent then waits at most
+    # main_loop_delay seconds on the connection, and is woken up immediately by a new message.
+    "consumer_mode": "poll",
+
+    # if true, each message is processed in a worker thread, while the main thread keeps servicing the
+    # rabbitmq connection, so that heartbeats are answered during long running checksum generation and
+    # replication, and the broker does not close the connection and redeliver the message
+    "worker_thread_processing": True,
+
+    # in push mode, the max number of unacknowledged messages rabbitmq delivers to the agent per queue
+    "prefetch_count": 1,
+
+    # in push mode, the max number of unacknowledged messages rabbitmq delivers to the agent per batch queue,
+    # and the max number of batch actions of a single project processed concurrently by the agents of the
+    # same type on all hosts (0 for no limit), as counted from the shared RABBIT_MONITORING_DIR. batch actions
+    # of projects already at the limit are not held by the agent, but deferred to the <batch queue>-deferred
+    # waiting queues, from where they are dead-lettered back to the end of their batch queue after
+    # batch_project_defer_interval seconds, so that a project with many queued batch actions does not delay
+    # the batch actions of other projects. in poll mode, at most batch_prefetch_count batch actions are
+    # deferred per polled message. the remaining prefetched batch actions are interleaved by project.
+    # note that deferring may reorder the batch actions of a project.
+    "batch_prefetch_count": 20,
+    "batch_project_max_in_flight": 1,
+    "batch_project_defer_interval": 300,
+
+    # in push mode, the relative weights by which prefetched messages are picked from the queues.
+    # higher weight wins ties, so the priority order failed -> main -> failed_batch -> main_batch
+    # is retained, but batch actions are not starved entirely when user-initiated actions are queued.
+    "queue_weights": {
+        "failed": 8,
+        "main": 4,
+        "failed_batch": 2,
+        "main_batch": 1,
+    },
+
     # retry policies for various actions made by the agents during rabbitmq
     # message processing.
     "retry_policy": {
@@ -100,6 +137,99 @@ production = {
             ],
         }
     },
+
+    # number of threads generating checksums concurrently for the files of an action
+    "checksum_workers": 4,
+
+    # the checksums generated for the files of an action are recorded in IDA every checksum_checkpoint_files
+    # files or checksum_checkpoint_seconds seconds, whichever comes first, so that an interrupted action
+    # does not need to regenerate them when retried
+    "checksum_checkpoint_files": 1000,
+    "checksum_checkpoint_seconds": 300,
+
+    # verification of replicated files. the checksum of the bytes copied is generated while copying, and
+    # compared with the checksum recorded for the frozen file. if 'readback', the replicated file is also
+    # read back from disk, bypassing the page cache, and its checksum compared with the frozen checksum.
+    # if 'frozen_checksum', only the checksum generated while copying is compared.
+    "replication_verification": "frozen_checksum",
+
+    # if true, and replication_verification is 'readback', files are copied with copy_file_range or sendfile
+    # where supported, without the data passing through user space, and are verified only by read back.
+    # this has no effect with 'frozen_checksum', as the bytes copied must then pass through user space to be
+    # hashed. enabling it with 'readback' trades the cpu spent copying and hashing in user space for reading
+    # each replicated file back from disk
+    "replication_zero_copy": False,
+
+    # size of the blocks in which files are read and written during replication
+    "replication_block_size": 1048576,
+
+    # number of threads copying files concurrently to the replication location, and the number of
+    # replicated files whose replicated timestamps are saved to IDA db with a single request
+    "replication_workers": 4,
+    "replication_commit_batch_size": 100,
+
+    # max number of files associated with an action retrieved from IDA with a single request. the
+    # checksum, metadata publication and replication stages process the files of an action page by page
+    "action_file_page_size": 10000,
+
+    # max number of frozen file records updated in IDA with a single request
+    "file_update_chunk_size": 1000,
+
+    # number of chunks of file metadata sent to Metax concurrently, the time in seconds within which Metax
+    # should process a single chunk, and the smallest chunk size used. the chunk size starts from the
+    # maximum file limit for IDA actions (MAX_FILE_COUNT), and is reduced while Metax responds slower
+    # than the target time, or rejects chunks as too large, and grown again while Metax responds fast
+    "metax_chunk_workers": 4,
+    "metax_chunk_target_seconds": 30,
+    "metax_chunk_min_size": 100,
+
+    # number of worker processes per agent type run by the agent supervisor (python -m agents.run_all),
+    # the initial and maximum delay in seconds before restarting a crashed worker, with the delay doubling
+    # on each consecutive crash, and the time in seconds workers are given to shut down gracefully
+    "supervisor_workers": {
+        "metadata": 2,
+        "replication": 2
+    },
+    "supervisor_restart_delay": 1,
+    "supervisor_restart_max_delay": 300,
+    "supervisor_shutdown_timeout": 600,
+
+    # directory where each agent process writes its metrics in prometheus text format, e.g. for the node
+    # exporter textfile collector, and the interval in seconds at which the metrics file is rewritten.
+    # if metrics_dir is not set, the metrics subdirectory of RABBIT_MONITORING_DIR is used
+    # "metrics_dir": "/var/lib/node_exporter/textfile",
+    "metrics_interval": 60,
+
+    # local persistent checksum cache, used when CHECKSUM_CACHE is defined in the server configuration. when
+    # the cache grows past max_entries, the least recently stored checksums are evicted. if strict, checksums
+    # are always generated by reading the files, still storing them to the cache. note that a cached checksum
+    # is reused as long as the inode, size and modification time of a file are unchanged, so the cache will
+    # not reveal silent corruption of file contents
+    "checksum_cache": {
+        "max_entries": 10000000,
+        "strict": False
+    },
+
+    # health checks of the sentinel offline file and the dependencies of the agent (Metax, DMF), run on a
+    # background thread every interval seconds. results older than ttl seconds are re-checked on demand.
+    # if inotify is true, the sentinel offline file is watched, and its creation or removal noticed at once.
+    # while offline or dependencies are not ok, the cached results are re-checked every wait_step seconds.
+    # probe_timeout is the max time in seconds the dmfstatus script may take
+    "health_checks": {
+        "interval": 30,
+        "ttl": 60,
+        "inotify": True,
+        "wait_step": 1,
+        "probe_timeout": 60
+    },
+
+    # keep-alive connection pooling for http requests sent to the IDA and Metax apis. pool_connections
+    # is the number of hosts for which a connection pool is kept, and pool_maxsize the max number of
+    # connections kept open to a single host.
+    "http_connection_pool": {
+        "pool_connections": 4,
+        "pool_maxsize": 10,
+    },
 }
 
 """
@@ -116,6 +246,19 @@ development = {
 
     "main_loop_delay": 0.1,
 
+    "consumer_mode": "poll",
+    "worker_thread_processing": True,
+    "prefetch_count": 1,
+    "batch_prefetch_count": 10,
+    "batch_project_max_in_flight": 1,
+    "batch_project_defer_interval": 1,
+    "queue_weights": {
+        "failed": 8,
+        "main": 4,
+        "failed_batch": 2,
+        "main_batch": 1,
+    },
+
     "retry_policy": {
         "checksums": {
             "max_retries": 3,
@@ -146,6 +289,51 @@ development = {
             ],
         }
     },
+
+    "checksum_workers": 2,
+    "checksum_checkpoint_files": 1000,
+    "checksum_checkpoint_seconds": 300,
+
+    "replication_verification": "readback",
+    "replication_zero_copy": True,
+    "replication_block_size": 1048576,
+    "replication_workers": 2,
+    "replication_commit_batch_size": 100,
+
+    "action_file_page_size": 10000,
+    "file_update_chunk_size": 1000,
+
+    "metax_chunk_workers": 2,
+    "metax_chunk_target_seconds": 30,
+    "metax_chunk_min_size": 100,
+
+    "supervisor_workers": {
+        "metadata": 1,
+        "replication": 1
+    },
+    "supervisor_restart_delay": 1,
+    "supervisor_restart_max_delay": 300,
+    "supervisor_shutdown_timeout": 600,
+
+    "metrics_interval": 60,
+
+    "health_checks": {
+        "interval": 30,
+        "ttl": 60,
+        "inotify": True,
+        "wait_step": 1,
+        "probe_timeout": 60
+    },
+
+    "checksum_cache": {
+        "max_entries": 100000,
+        "strict": False
+    },
+
+    "http_connection_pool": {
+        "pool_connections": 4,
+        "pool_maxsize": 10,
+    },
 }
 
 """
@@ -160,6 +348,19 @@ test = {
 
     "main_loop_delay": 5,
 
+    "consumer_mode": "poll",
+    "worker_thread_processing": True,
+    "prefetch_count": 1,
+    "batch_prefetch_count": 10,
+    "batch_project_max_in_flight": 1,
+    "batch_project_defer_interval": 1,
+    "queue_weights": {
+        "failed": 8,
+        "main": 4,
+        "failed_batch": 2,
+        "main_batch": 1,
+    },
+
     "retry_policy": {
         "checksums": {
             "max_retries": 3,
@@ -190,4 +391,49 @@ test = {
             ],
         }
     },
+
+    "checksum_workers": 2,
+    "checksum_checkpoint_files": 1000,
+    "checksum_checkpoint_seconds": 300,
+
+    "replication_verification": "readback",
+    "replication_zero_copy": True,
+    "replication_block_size": 1048576,
+    "replication_workers": 2,
+    "replication_commit_batch_size": 100,
+
+    "action_file_page_size": 10000,
+    "file_update_chunk_size": 1000,
+
+    "metax_chunk_workers": 2,
+    "metax_chunk_target_seconds": 30,
+    "metax_chunk_min_size": 100,
+
+    "supervisor_workers": {
+        "metadata": 1,
+        "replication": 1
+    },
+    "supervisor_restart_delay": 1,
+    "supervisor_restart_max_delay": 300,
+    "supervisor_shutdown_timeout": 600,
+
+    "metrics_interval": 60,
+
+    "health_checks": {
+        "interval": 1,
+        "ttl": 1,
+        "inotify": True,
+        "wait_step": 1,
+        "probe_timeout": 60
+    },
+
+    "checksum_cache": {
+        "max_entries": 100000,
+        "strict": False
+    },
+
+    "http_connection_pool": {
+        "pool_connections": 4,
+        "pool_maxsize": 10,
+    },
 }
@@ -0,0 +1,100 @@
+#--------------------------------------------------------------------------------
+# This file is part of the IDA research data storage service
+#
+# Copyright (C) 2018 Ministry of Education and Culture, Finland
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public
+# License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# @author   CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# @license  GNU Affero General Public License, version 3
+# @link     https://research.csc.fi/
+#--------------------------------------------------------------------------------
+
+from time import sleep
+
+import inspect
+import sys
+import unittest
+
+from agents.run_all import AgentSupervisor
+from agents.utils.utils import get_settings
+
+
+def crashing_agent(agent_type):
+    sys.exit(1)
+
+
+def idle_agent(agent_type):
+    while True:
+        sleep(1)
+
+
+class AgentSupervisorTests(unittest.TestCase):
+
+    """
+    Test supervising agent worker processes, using stand-in worker functions instead of real agents.
+    """
+
+    def setUp(self):
+        self.settings = get_settings()
+        self.settings['supervisor_workers'] = { 'metadata': 2, 'replication': 1 }
+        self.settings['supervisor_restart_delay'] = 1
+        self.settings['supervisor_restart_max_delay'] = 4
+        self.settings['supervisor_shutdown_timeout'] = 5
+
+    def test_configured_workers_are_started_and_stopped(self):
+        """
+        Ensure the configured number of workers per agent type are started, and all of them are stopped.
+        """
+
+        print("   %s" % inspect.currentframe().f_code.co_name)
+
+        supervisor = AgentSupervisor(settings=self.settings, target=idle_agent)
+        supervisor.check_workers()
+
+        self.assertEqual([ str(worker) for worker in supervisor.workers ], [ 'metadata-0', 'metadata-1', 'replication-0' ])
+        self.assertEqual(all(worker.process.is_alive() for worker in supervisor.workers), True)
+
+        supervisor.stop_workers()
+
+        self.assertEqual(any(worker.process.is_alive() for worker in supervisor.workers), False)
+
+    def test_crashed_workers_are_restarted_with_backoff(self):
+        """
+        Ensure a crashed worker is restarted only after its restart delay, and the delay grows with
+        consecutive crashes up to the maximum delay.
+        """
+
+        print("   %s" % inspect.currentframe().f_code.co_name)
+
+        self.settings['supervisor_workers'] = { 'metadata': 1 }
+
+        supervisor = AgentSupervisor(settings=self.settings, target=crashing_agent)
+        worker = supervisor.workers[0]
+
+        supervisor.check_workers()
+        first_process = worker.process
+        first_process.join()
+
+        supervisor.check_workers()
+        self.assertEqual(worker.failures, 1)
+        self.assertEqual(worker.process, None, 'worker should not be restarted before its restart delay')
+
+        sleep(1.1)
+        supervisor.check_workers()
+        self.assertNotEqual(worker.process, None)
+        self.assertNotEqual(worker.process, first_process)
+        worker.process.join()
+
+        self.assertEqual([ supervisor.restart_delay(failures) for failures in range(1, 5) ], [ 1, 2, 4, 4 ])
@@ -3,6 +3,8 @@ from json import dumps as json_dumps, loads as json_loads
 from time import sleep
 import os
 import signal
+import threading
+from urllib.parse import parse_qs, urlparse
 
 from requests.exceptions import ConnectionError
 import responses
@@ -153,6 +155,28 @@ class GenericAgentMonitoringTests(BaseAgentTestCase):
         self.assertEqual(os.path.isfile(self.agent._sentinel_monitoring_file), False,
             'monitoring file should have been removed when message processing ended')
 
+    @responses.activate
+    def test_metrics_file_is_written_after_processing_a_message(self):
+        """
+        Ensure processed messages, sub-action durations and http request latencies are recorded, and
+        written to the metrics file of the agent in prometheus text format.
+        """
+
+        print("   %s" % inspect.currentframe().f_code.co_name)
+
+        self.agent = MetadataAgent()
+        self.agent.consume_one()
+
+        self.assertEqual(os.path.isfile(self.agent._metrics_file), True, 'metrics file should have been written')
+
+        with open(self.agent._metrics_file, 'r') as f:
+            metrics = f.read()
+
+        self.assertIn('# TYPE ida_agent_messages_processed_total counter', metrics)
+        self.assertIn('ida_agent_messages_processed_total{agent="MetadataAgent",queue="%s"} 1' % self.agent.main_queue_name, metrics)
+        self.assertIn('ida_agent_http_request_duration_seconds_count{agent="MetadataAgent",upstream="ida"}', metrics)
+        self.assertIn('ida_agent_sub_action_duration_seconds_count{agent="MetadataAgent",sub_action="checksums"} 1', metrics)
+
 
 class GenericAgentWebRequestTests(BaseAgentTestCase):
 
@@ -200,7 +224,32 @@ class GenericAgentWebRequestTests(BaseAgentTestCase):
         self.agent.consume_one()
         # proceeds up to retrieving nodes from IDA api, then retries a few times since the
         # mocked api only returns an error
-        self.assertEqual(self.agent._current_http_request_retry, 3)
+        self.assertEqual(self.agent._metrics.get('ida_agent_http_request_failed_attempts_total', labels={ 'upstream': 'ida' }), 3)
+
+    @responses.activate
+    def test_http_requests_reuse_pooled_session(self):
+        """
+        Ensure consecutive http requests are sent using the same session, and the connection pool
+        adapter configured according to settings.
+        """
+
+        print("   %s" % inspect.currentframe().f_code.co_name)
+
+        action = ida_test_data['actions'][0]
+        url = '%s/actions/%s' % (self.agent._uida_conf_vars['IDA_API'], action['pid'])
+
+        self.agent._http_request('get', url)
+        session = self.agent._http_session
+        adapter = self.agent._http_adapter
+
+        self.agent._http_request('get', url)
+        self.assertEqual(len(responses.calls), 2)
+        self.assertIs(self.agent._http_session, session)
+        self.assertIs(session.get_adapter(url), adapter)
+
+        pool_settings = self.agent._settings['http_connection_pool']
+        self.assertEqual(adapter._pool_connections, pool_settings['pool_connections'])
+        self.assertEqual(adapter._pool_maxsize, pool_settings['pool_maxsize'])
 
     @responses.activate
     def test_http_requests_fail_does_not_increment_retries(self):
@@ -223,3 +272,260 @@ class GenericAgentWebRequestTests(BaseAgentTestCase):
         msg = json_loads(body.decode('utf-8'))
         self.assertEqual('retry' in msg['checksums_retry_info'], False,
             'retry_info should not contain retry count, since http connection error does not count as retry')
+
+
+class GenericAgentActionFilePagingTests(BaseAgentTestCase):
+
+    """
+    Test retrieving the files associated with an action page by page.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.agent = MetadataAgent()
+
+    @responses.activate
+    def test_action_files_are_retrieved_in_pages(self):
+        """
+        Ensure all files of an action are retrieved, each page beginning after the last file of the
+        previous page, and retrieval stops at the first page which is not full.
+        """
+
+        print("   %s" % inspect.currentframe().f_code.co_name)
+
+        action = ida_test_data['actions'][0]
+        all_nodes = [ { 'id': i, 'pid': 'pid%d' % i, 'action': action['pid'] } for i in range(1, 6) ]
+        requested_afters = []
+
+        def files_callback(request):
+            query = parse_qs(urlparse(request.url).query)
+            limit = int(query['limit'][0])
+            after = int(query['after'][0]) if 'after' in query else 0
+            requested_afters.append(after)
+            page = [ node for node in all_nodes if node['id'] > after ][:limit]
+            return (200, {}, json_dumps(page))
+
+        self.agent.rabbitmq_message = action
+        self.agent._settings['action_file_page_size'] = 2
+
+        with responses.RequestsMock() as files_mock:
+
+            files_mock.add_callback(
+                responses.GET,
+                '%s/files/action/%s' % (self._uida_conf_vars['IDA_API'], action['pid']),
+                callback=files_callback,
+                content_type='application/json'
+            )
+
+            pages = list(self.agent._get_node_pages_associated_with_action(action))
+
+            self.assertEqual([ len(page) for page in pages ], [ 2, 2, 1 ])
+            self.assertEqual(requested_afters, [ 0, 2, 4 ])
+            self.assertEqual(
+                [ node.pid for node in self.agent._get_nodes_associated_with_action(action) ],
+                [ node['pid'] for node in all_nodes ]
+            )
+
+
+class GenericAgentPushConsumerTests(BaseAgentTestCase):
+
+    """
+    Test consuming messages pushed by rabbitmq in push consumer mode.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.agent = MetadataAgent()
+        self.agent._settings['consumer_mode'] = 'push'
+
+    @responses.activate
+    def test_pushed_message_is_processed(self):
+        """
+        Ensure a message published to the actions exchange is pushed to the agent and processed.
+        """
+
+        print("   %s" % inspect.currentframe().f_code.co_name)
+
+        self.agent._start_push_consumers()
+        self._publish_test_messages(index=0)
+
+        self.assertEqual(self.agent.consume_one_pushed(), True)
+        self.assertEqual('metadata' in self.agent.last_completed_sub_action, True)
+        self.assertEqual(self.agent.consume_one_pushed(), False, 'there should be no more messages to process')
+
+    def test_prefetched_queues_are_selected_by_weight(self):
+        """
+        Ensure prefetched messages are picked according to the queue weights, with higher priority
+        queues winning ties, and lower priority queues not being starved.
+        """
+
+        print("   %s" % inspect.currentframe().f_code.co_name)
+
+        self.agent._start_push_consumers()
+
+        for queue in self.agent._queues_by_priority():
+            self.agent._prefetched_messages[queue].extend([ None ] * 20)
+
+        selected_queues = [ self.agent._select_prefetched_queue() for i in range(15) ]
+
+        self.assertEqual(selected_queues[0], self.agent.failed_queue_name)
+        self.assertEqual(selected_queues.count(self.agent.failed_queue_name), 8)
+        self.assertEqual(selected_queues.count(self.agent.main_queue_name), 4)
+        self.assertEqual(selected_queues.count(self.agent.failed_batch_queue_name), 2)
+        self.assertEqual(selected_queues.count(self.agent.main_batch_queue_name), 1)
+
+    def test_prefetched_batch_actions_are_interleaved_by_project(self):
+        """
+        Ensure prefetched batch actions of different projects are processed in turns, and batch actions
+        of projects already at their limit of actions in flight are held back.
+        """
+
+        print("   %s" % inspect.currentframe().f_code.co_name)
+
+        self.agent._start_push_consumers()
+
+        queue = self.agent.main_batch_queue_name
+
+        for i, project in enumerate([ 'A', 'A', 'A', 'A', 'B', 'B', 'C' ]):
+            body = json_dumps({ 'pid': 'action%d' % i, 'project': project }).encode('utf-8')
+            self.agent._prefetched_messages[queue].append((None, None, body))
+
+        served = []
+        while self.agent._prefetched_messages[queue]:
+            method, properties, body = self.agent._take_prefetched_message(queue, {})
+            served.append(json_loads(body.decode('utf-8'))['pid'])
+
+        self.assertEqual(served, [ 'action0', 'action4', 'action6', 'action1', 'action5', 'action2', 'action3' ])
+
+        # with project A at its limit of actions in flight, only project B can be served
+        for project in [ 'A', 'A', 'B' ]:
+            body = json_dumps({ 'pid': 'action', 'project': project }).encode('utf-8')
+            self.agent._prefetched_messages[queue].append((None, None, body))
+
+        self.assertEqual(self.agent._next_prefetched_message_index(queue, { 'A': 1 }), 2)
+        self.assertEqual(self.agent._next_prefetched_message_index(queue, { 'A': 1, 'B': 1 }), None)
+        self.assertEqual(self.agent._select_prefetched_queue({ 'A': 1, 'B': 1 }), None)
+
+
+class GenericAgentBatchDeferralTests(BaseAgentTestCase):
+
+    """
+    Test deferring batch actions of projects already at their limit of batch actions in flight.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.agent = MetadataAgent()
+
+        # action of Project_X in flight on another host
+        os.makedirs(self._uida_conf_vars['RABBIT_MONITORING_DIR'], exist_ok=True)
+        with open('%s/otherhost-MetadataAgent-12345' % self._uida_conf_vars['RABBIT_MONITORING_DIR'], 'w') as f:
+            f.write('PROJECT="Project_X"\n')
+
+        # two actions of Project_X queued ahead of an action of Project_B
+        for index in (0, 2, 1):
+            self._publish_test_messages(index=index, exchange='batch-actions')
+
+    def _get_prefetched_pids(self, queue):
+        return [ json_loads(body.decode('utf-8'))['pid'] for method, properties, body in self.agent._prefetched_messages[queue] ]
+
+    def test_in_flight_actions_are_counted_on_all_hosts(self):
+        """
+        Ensure the actions in flight of the agents of the same type on other hosts are counted.
+        """
+
+        print("   %s" % inspect.currentframe().f_code.co_name)
+
+        self.assertEqual(self.agent._get_in_flight_actions_per_project(), { 'Project_X': 1 })
+
+    def test_pushed_batch_actions_of_capped_projects_are_deferred(self):
+        """
+        Ensure prefetched batch actions of a project at its limit of actions in flight are not held by
+        the agent, but deferred to the end of the batch queue.
+        """
+
+        print("   %s" % inspect.currentframe().f_code.co_name)
+
+        queue = self.agent.main_batch_queue_name
+
+        self.agent._settings['consumer_mode'] = 'push'
+        self.agent._start_push_consumers()
+        self.agent._connection.process_data_events(time_limit=1)
+
+        self.assertEqual(self._get_prefetched_pids(queue), [ ida_test_data['actions'][i]['pid'] for i in (0, 2, 1) ])
+
+        self.agent._defer_prefetched_messages_of_capped_projects(self.agent._get_in_flight_actions_per_project())
+        sleep(0.5)
+
+        self.assertEqual(self._get_prefetched_pids(queue), [ ida_test_data['actions'][1]['pid'] ])
+        self.assertEqual(self.agent.messages_in_queue('%s-deferred' % queue), 2)
+
+        # once the defer interval has expired, the deferred actions return to the end of the batch queue
+        sleep(self._settings['batch_project_defer_interval'] + 1)
+        self.agent._connection.process_data_events(time_limit=1)
+
+        self.assertEqual(self.agent.messages_in_queue('%s-deferred' % queue), 0)
+        self.assertEqual(self._get_prefetched_pids(queue), [ ida_test_data['actions'][i]['pid'] for i in (1, 0, 2) ])
+
+    def test_polled_batch_actions_of_capped_projects_are_deferred(self):
+        """
+        Ensure that in poll mode, batch actions of a project at its limit of actions in flight are deferred,
+        and the next batch action of another project is processed instead.
+        """
+
+        print("   %s" % inspect.currentframe().f_code.co_name)
+
+        queue = self.agent.main_batch_queue_name
+        processed = []
+
+        def process_message(queue, method, properties, body):
+            processed.append(json_loads(body.decode('utf-8'))['pid'])
+            self.agent._ack_message(method)
+
+        self.agent._process_message = process_message
+
+        self.agent.consume_one(queue)
+        sleep(0.5)
+
+        self.assertEqual(processed, [ ida_test_data['actions'][1]['pid'] ])
+        self.assertEqual(self.agent.messages_in_queue(queue), 0)
+        self.assertEqual(self.agent.messages_in_queue('%s-deferred' % queue), 2)
+
+
+class GenericAgentWorkerThreadTests(BaseAgentTestCase):
+
+    """
+    Test processing messages in a worker thread while the connection is serviced by the main thread.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.agent = MetadataAgent()
+
+    def test_worker_thread_channel_operations_run_on_connection_thread(self):
+        """
+        Ensure channel operations requested by the worker thread are executed by the thread which opened
+        the connection, and that the return value or exception of the worker is passed to the caller.
+        """
+
+        print("   %s" % inspect.currentframe().f_code.co_name)
+
+        threads = {}
+
+        def channel_operation():
+            threads['channel_operation'] = threading.current_thread()
+            return 'result'
+
+        def process():
+            threads['process'] = threading.current_thread()
+            return self.agent._run_on_connection_thread(channel_operation)
+
+        def fail():
+            raise Exception('worker failed')
+
+        self.assertEqual(self.agent._process_in_worker_thread(process), 'result')
+        self.assertIsNot(threads['process'], threading.current_thread())
+        self.assertIs(threads['channel_operation'], threading.current_thread())
+
+        with self.assertRaisesRegex(Exception, 'worker failed'):
+            self.agent._process_in_worker_thread(fail)
@@ -0,0 +1,96 @@
+#--------------------------------------------------------------------------------
+# This file is part of the IDA research data storage service
+#
+# Copyright (C) 2018 Ministry of Education and Culture, Finland
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public
+# License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# @author   CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# @license  GNU Affero General Public License, version 3
+# @link     https://research.csc.fi/
+#--------------------------------------------------------------------------------
+
+from time import sleep
+
+import inspect
+import logging
+import os
+import tempfile
+import unittest
+
+from agents.common.health import CachedCheck, FileWatch
+
+
+class HealthCheckTests(unittest.TestCase):
+
+    """
+    Test the cached background health checks used by the agents.
+    """
+
+    def setUp(self):
+        self.logger = logging.getLogger(__name__)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.offline_file = '%s/OFFLINE' % self.tmp_dir.name
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_cached_check_result_is_reused_within_ttl(self):
+        """
+        Ensure the probe is not run again while its cached result is valid, and errors count as not ok.
+        """
+
+        print("   %s" % inspect.currentframe().f_code.co_name)
+
+        calls = []
+
+        def probe():
+            calls.append(True)
+            if len(calls) > 1:
+                raise Exception('probe failed')
+            return False
+
+        check = CachedCheck('test', probe, interval=60, ttl=0.5, logger=self.logger, on_error=True)
+
+        self.assertEqual(check.get(), False)
+        self.assertEqual(check.get(), False)
+        self.assertEqual(len(calls), 1, 'cached result should have been used')
+
+        sleep(0.6)
+
+        self.assertEqual(check.get(), True, 'a failing probe should return on_error')
+        self.assertEqual(len(calls), 2)
+
+    def test_offline_file_changes_are_noticed_immediately(self):
+        """
+        Ensure creating and removing the watched file is noticed without waiting for the ttl to expire.
+        """
+
+        print("   %s" % inspect.currentframe().f_code.co_name)
+
+        watch = FileWatch(self.offline_file, ttl=60, logger=self.logger)
+        watch.start()
+
+        try:
+            self.assertEqual(watch.exists(), False)
+
+            open(self.offline_file, 'w').close()
+            sleep(0.2)
+            self.assertEqual(watch.exists(), True)
+
+            os.remove(self.offline_file)
+            sleep(0.2)
+            self.assertEqual(watch.exists(), False)
+        finally:
+            watch.stop()
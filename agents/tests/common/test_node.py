@@ -0,0 +1,110 @@
+#--------------------------------------------------------------------------------
+# This file is part of the IDA research data storage service
+#
+# Copyright (C) 2018 Ministry of Education and Culture, Finland
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public
+# License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# @author   CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# @license  GNU Affero General Public License, version 3
+# @link     https://research.csc.fi/
+#--------------------------------------------------------------------------------
+
+from copy import deepcopy
+
+import inspect
+import unittest
+
+from agents.common import Node
+from agents.tests.testdata import ida as ida_test_data
+
+
+class NodeTests(unittest.TestCase):
+
+    """
+    Test the slotted node records used by the agents for frozen files.
+    """
+
+    def setUp(self):
+        self.record = deepcopy(ida_test_data['nodes'][0])
+        self.record['checksum'] = 'SHA256:C20A6D5B03450BBC65FD5CD043E1BC8D7842815EFD4E431A06A7A7B641FC30ED'
+        self.record['metadata'] = '2017-10-27T07:48:45Z'
+
+    def test_node_from_ida_file_record(self):
+        """
+        Ensure fields of the IDA file record are available both as attributes and as items, unused
+        fields are dropped, and missing fields and flags have their defaults.
+        """
+
+        print("   %s" % inspect.currentframe().f_code.co_name)
+
+        node = Node.from_dict(self.record)
+
+        self.assertEqual(node.pid, self.record['pid'])
+        self.assertEqual(node['pathname'], self.record['pathname'])
+        self.assertEqual(node.get('size'), self.record['size'])
+        self.assertEqual(node.replicated, None)
+        self.assertEqual(node.get('replicated', 'default'), 'default')
+        self.assertEqual('replicated' in node, False)
+        self.assertEqual('checksum' in node, True)
+        self.assertEqual(node._updated, False)
+        self.assertEqual('type' in node.to_dict(), False)
+
+        with self.assertRaises(AttributeError):
+            node.type = 'file'
+
+        node['_updated'] = True
+        self.assertEqual(node._updated, True)
+
+    def test_node_to_metax_payloads(self):
+        """
+        Ensure nodes are converted to the Metax v3 and v1 file metadata payloads.
+        """
+
+        print("   %s" % inspect.currentframe().f_code.co_name)
+
+        node = Node.from_dict(self.record)
+        checksum = 'c20a6d5b03450bbc65fd5cd043e1bc8d7842815efd4e431a06a7a7b641fc30ed'
+
+        self.assertEqual(node.to_metax_v3(user='TestUser'), {
+            'storage_service': 'ida',
+            'storage_identifier': 'pidveryuniquefilepidhere',
+            'csc_project': 'Project_X',
+            'pathname': '/Custom_Experiment/test01.dat',
+            'filename': 'test01.dat',
+            'size': 3728,
+            'checksum': 'sha256:%s' % checksum,
+            'modified': '2017-10-16T12:45:08Z',
+            'frozen': '2017-10-26T07:48:45Z',
+            'user': 'TestUser',
+        })
+
+        self.assertEqual(node.to_metax_v1(1, '2017-10-26T07:50:00Z'), {
+            'file_storage': 1,
+            'identifier': 'pidveryuniquefilepidhere',
+            'project_identifier': 'Project_X',
+            'file_path': '/Custom_Experiment/test01.dat',
+            'file_name': 'test01.dat',
+            'file_format': 'dat',
+            'file_frozen': '2017-10-26T07:48:45Z',
+            'file_modified': '2017-10-16T12:45:08Z',
+            'file_uploaded': '2017-10-27T07:48:45Z',
+            'byte_size': 3728,
+            'checksum': {
+                'value': checksum,
+                'algorithm': 'SHA-256',
+                'checked': '2017-10-26T07:50:00Z',
+            },
+            'open_access': True,
+        })
@@ -32,6 +32,7 @@ RABBIT_WORKER_USER="user"
 RABBIT_WORKER_PASS="pass"
 RABBIT_WORKER_LOG_FILE="agents/tests/tests.log"
 RABBIT_MONITORING_DIR="/tmp/rabbitmq_monitoring_tests"
+CHECKSUM_CACHE="/tmp/rabbitmq_monitoring_tests/checksum_cache.db"
 
 # Defining these urls here to make it obvious that these apis are actually mocked
 IDA_API="https://mock.ida-api"
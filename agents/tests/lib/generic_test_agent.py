@@ -171,6 +171,18 @@ class BaseAgentTestCase(TestCase):
                 status=204
             )
 
+        # POST nodes in batch
+        self._prepare_response(
+            responses.POST,
+            'ida',
+            '/files/batch',
+            status=200,
+            body=json_dumps({
+                'updated': 1,
+                'failed': []
+            })
+        )
+
         # GET checksum
         self._prepare_response(
             responses.GET,
@@ -179,6 +191,17 @@ class BaseAgentTestCase(TestCase):
             status=404
         )
 
+        # GET checksums
+        self._prepare_response(
+            responses.GET,
+            'ida',
+            '/retrieveCacheChecksums',
+            status=200,
+            body=json_dumps({
+                'checksums': {}
+            })
+        )
+
         # POST checksum
         self._prepare_response(
             responses.POST,
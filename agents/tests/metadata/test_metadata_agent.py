@@ -22,12 +22,17 @@
 #--------------------------------------------------------------------------------
 
 from copy import deepcopy
+from json import dumps as json_dumps
 from time import sleep
+from urllib.parse import parse_qs, urlparse
 
+import requests
 import responses
+import threading
 import inspect
 import sys
 
+from agents.common import Node
 from agents.metadata import MetadataAgent
 from agents.utils.utils import get_settings
 from agents.tests.lib import BaseAgentTestCase
@@ -90,7 +95,7 @@ class MetadataAgentTestsCommon(BaseAgentTestCase):
 
         # often used test things used for freeze action
         self.TEST_FREEZE_ACTION_WITH_ONE_NODE = deepcopy(ida_test_data['actions'][0])
-        self.TEST_FREEZE_ACTION_NODE = deepcopy(ida_test_data['nodes'][0])
+        self.TEST_FREEZE_ACTION_NODE = Node.from_dict(deepcopy(ida_test_data['nodes'][0]))
         self.TEST_FREEZE_NODE_CHECKSUM = 'c20a6d5b03450bbc65fd5cd043e1bc8d7842815efd4e431a06a7a7b641fc30ed'
 
 
@@ -124,14 +129,92 @@ class MetadataAgentUnitTests(MetadataAgentTestsCommon):
 
         # check node checksum is updated to ida db
         self.assertEqual(self.agent.ida_post_files_called, True)
-        self.assertEqual('checksum' in self.agent.ida_post_files_data, True)
-        self.assertEqual(self.agent.ida_post_files_data['checksum'], self.TEST_FREEZE_NODE_CHECKSUM)
+        self.assertEqual(len(self.agent.ida_post_files_data['files']), 1)
+        self.assertEqual('checksum' in self.agent.ida_post_files_data['files'][0], True)
+        self.assertEqual(self.agent.ida_post_files_data['files'][0]['checksum'], self.TEST_FREEZE_NODE_CHECKSUM)
 
         # check sub-action completion is updated to ida db
         self.assertEqual('checksums' in self.agent.last_completed_sub_action, True)
         self.assertEqual(self.agent.last_completed_sub_action['action_pid'], self.TEST_FREEZE_ACTION_WITH_ONE_NODE['pid'])
         self.assert_messages_ended_in_failed_queue(0)
 
+    @responses.activate
+    def test_process_checksums_detects_cache_checksum_mismatch(self):
+        """
+        When the prefetched Nextcloud cache checksum of a file differs from the generated checksum,
+        checksum processing of a freeze action should fail, and nothing should be saved to ida db.
+        """
+
+        print("   %s" % inspect.currentframe().f_code.co_name)
+
+        action = self.TEST_FREEZE_ACTION_WITH_ONE_NODE
+        node_pathname = self.TEST_FREEZE_ACTION_NODE['pathname']
+
+        self.agent.rabbitmq_message = action
+
+        with responses.RequestsMock() as ida_mock:
+
+            ida_mock.add(
+                responses.GET,
+                '%s/files/action/%s' % (self._uida_conf_vars['IDA_API'], action['pid']),
+                status=200,
+                content_type='application/json',
+                body=json_dumps([ node for node in ida_test_data['nodes'] if node['action'] == action['pid'] ])
+            )
+
+            ida_mock.add(
+                responses.GET,
+                '%s/retrieveCacheChecksums' % self._uida_conf_vars['IDA_API'],
+                status=200,
+                content_type='application/json',
+                body=json_dumps({ 'checksums': { node_pathname: 'sha256:%s' % ('0' * 64) } })
+            )
+
+            with self.assertRaisesRegex(Exception, 'Files on disk do not match their Nextcloud cache checksums'):
+                self.agent._process_checksums(action)
+
+            cache_checksums_requests = [ call.request for call in ida_mock.calls if '/retrieveCacheChecksums' in call.request.url ]
+            self.assertEqual(len(cache_checksums_requests), 1, 'cache checksums should be retrieved with a single request')
+            self.assertEqual(
+                parse_qs(urlparse(cache_checksums_requests[0].url).query)['pathname'],
+                [ 'frozen%s' % action['pathname'] ]
+            )
+
+        self.assertEqual(self.agent.ida_post_files_called, False)
+
+    def test_update_node_checksums_checkpoints_generated_checksums(self):
+        """
+        The checksums generated for the files of an action should be recorded in ida db every
+        checksum_checkpoint_files files, and the nodes recorded should no longer be flagged as updated,
+        so that they are not recorded again with the rest of their page.
+        """
+
+        print("   %s" % inspect.currentframe().f_code.co_name)
+
+        self.agent._settings = dict(self.agent._settings, checksum_checkpoint_files=2)
+
+        checksum_files = []
+        for i in range(5):
+            node = Node.from_dict(deepcopy(ida_test_data['nodes'][0]))
+            node.pid = 'checkpointpid%d' % i
+            node.pathname = '/checkpoint/file%d' % i
+            checksum_files.append((node, '/tmp/file%d' % i, i))
+
+        saved = []
+
+        def save_nodes_to_db(nodes, fields=[], updated_only=False):
+            saved.append([ node.pid for node in nodes if node._updated or not updated_only ])
+
+        self.agent._generate_checksums = lambda files: ((node, path, size, 'checksum%d' % size) for node, path, size in files)
+        self.agent._save_nodes_to_db = save_nodes_to_db
+
+        checksum_mismatch_pids = []
+        self.agent._update_node_checksums(self.TEST_FREEZE_ACTION_WITH_ONE_NODE, checksum_files, {}, checksum_mismatch_pids)
+
+        self.assertEqual(checksum_mismatch_pids, [])
+        self.assertEqual(saved, [ [ 'checkpointpid0', 'checkpointpid1' ], [ 'checkpointpid2', 'checkpointpid3' ] ])
+        self.assertEqual([ node._updated for node, path, size in checksum_files ], [ False, False, False, False, True ])
+        self.assertEqual(checksum_files[4][0].checksum, 'checksum4')
 
     def test_aggregate_technical_metadata(self):
         """
@@ -238,6 +321,72 @@ class MetadataAgentUnitTests(MetadataAgentTestsCommon):
         self.assert_messages_ended_in_failed_queue(0)
 
 
+    def _metax_response(self, status_code, body=None):
+        response = requests.models.Response()
+        response.status_code = status_code
+        response._content = json_dumps(body or {}).encode('utf-8')
+        return response
+
+
+    def test_submit_metax_chunks_splits_rejected_chunks(self):
+        """
+        Chunks rejected by Metax as too large should be split and resubmitted, so that all
+        records end up submitted, and the chunk size should be reduced for the following chunks.
+        """
+
+        print("   %s" % inspect.currentframe().f_code.co_name)
+
+        submitted = []
+        lock = threading.Lock()
+
+        def send_metax_chunk(method, detail_url, data):
+            if len(data) > 2:
+                return self._metax_response(413), 0.0
+            with lock:
+                submitted.extend(data)
+            return self._metax_response(200, { 'success': data, 'failed': [] }), 0.0
+
+        self.agent._chunk_size = 8
+        self.agent._settings = dict(self.agent._settings, metax_chunk_min_size=1)
+        self.agent._send_metax_chunk = send_metax_chunk
+
+        records = list(range(20))
+        self.agent._submit_metax_chunks(self.TEST_FREEZE_ACTION_WITH_ONE_NODE, records, 'post', '/files/put-many', 'publication')
+
+        self.assertEqual(sorted(submitted), records)
+
+
+    def test_submit_metax_chunks_reports_failed_entries_of_all_chunks(self):
+        """
+        Entries reported as failed by Metax should be collected from all chunks, and reported
+        with a single exception once all chunks have been submitted.
+        """
+
+        print("   %s" % inspect.currentframe().f_code.co_name)
+
+        if self._uida_conf_vars['METAX_API_VERSION'] >= 3:
+            identifier_field = 'storage_identifier'
+        else:
+            identifier_field = 'identifier'
+
+        chunks = []
+        lock = threading.Lock()
+
+        def send_metax_chunk(method, detail_url, data):
+            with lock:
+                chunks.append(data)
+            failed = [ { 'object': { identifier_field: record }, 'errors': 'oops' } for record in data if record % 5 == 0 ]
+            return self._metax_response(200, { 'success': [], 'failed': failed }), 0.0
+
+        self.agent._chunk_size = 5
+        self.agent._send_metax_chunk = send_metax_chunk
+
+        with self.assertRaisesRegex(Exception, 'Metax reported 4 failed files'):
+            self.agent._submit_metax_chunks(self.TEST_FREEZE_ACTION_WITH_ONE_NODE, list(range(20)), 'post', '/files/put-many', 'publication')
+
+        self.assertEqual(sum(len(chunk) for chunk in chunks), 20, 'all chunks should have been submitted')
+
+
 class MetadataAgentProcessQueueTests(MetadataAgentTestsCommon):
 
     """
@@ -0,0 +1,100 @@
+#--------------------------------------------------------------------------------
+# This file is part of the IDA research data storage service
+#
+# Copyright (C) 2018 Ministry of Education and Culture, Finland
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public
+# License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# @author   CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# @license  GNU Affero General Public License, version 3
+# @link     https://research.csc.fi/
+#--------------------------------------------------------------------------------
+
+import inspect
+import unittest
+
+from agents.metadata.reconciliation import reconcile
+
+
+class ReconciliationTests(unittest.TestCase):
+
+    """
+    Test reconciliation of repaired files with the files known to Metax.
+    """
+
+    def test_files_are_segregated_to_new_existing_and_removed(self):
+        """
+        Ensure files known to Metax are separated from new files, and files known to Metax which are
+        no longer frozen in IDA are identified as removed, preserving the original order.
+        """
+
+        print("   %s" % inspect.currentframe().f_code.co_name)
+
+        records = [ { 'identifier': pid } for pid in ('pid1', 'pid2', 'pid3', 'pid4') ]
+        frozen_file_pids = [ 'pid1', 'pid2', 'pid3', 'pid4', 'pid5' ]
+        metax_file_pids = [ 'pid6', 'pid4', 'pid2', 'pid5', 'pid7' ]
+
+        reconciliation = reconcile(records, frozen_file_pids, metax_file_pids, 'identifier')
+
+        self.assertEqual([ r['identifier'] for r in reconciliation.new ], [ 'pid1', 'pid3' ])
+        self.assertEqual([ r['identifier'] for r in reconciliation.existing ], [ 'pid2', 'pid4' ])
+        self.assertEqual(reconciliation.removed, [ 'pid6', 'pid7' ])
+
+    def test_reconciliation_scales_linearly(self):
+        """
+        Ensure reconciliation of a large project does not degrade to quadratic membership tests.
+        """
+
+        print("   %s" % inspect.currentframe().f_code.co_name)
+
+        count = 200000
+        records = [ { 'identifier': 'pid%d' % i } for i in range(count) ]
+        frozen_file_pids = [ 'pid%d' % i for i in range(count) ]
+        metax_file_pids = [ 'pid%d' % i for i in range(count // 2, count + 1000) ]
+
+        reconciliation = reconcile(records, frozen_file_pids, metax_file_pids, 'identifier')
+
+        self.assertEqual(len(reconciliation.new), count // 2)
+        self.assertEqual(len(reconciliation.existing), count // 2)
+        self.assertEqual(len(reconciliation.removed), 1000)
+
+    def test_only_changed_existing_files_are_identified_as_changed(self):
+        """
+        Ensure existing files are identified as changed only when their compared fields differ from
+        those of the Metax record, or the fields of the Metax record are not known.
+        """
+
+        print("   %s" % inspect.currentframe().f_code.co_name)
+
+        compared_fields = lambda record: (record['size'], record['checksum'])
+
+        records = [
+            { 'identifier': 'pid1', 'size': 1, 'checksum': 'abc' },
+            { 'identifier': 'pid2', 'size': 2, 'checksum': 'def' },
+            { 'identifier': 'pid3', 'size': 3, 'checksum': 'ghi' },
+            { 'identifier': 'pid4', 'size': 4, 'checksum': 'jkl' },
+        ]
+        frozen_file_pids = [ 'pid1', 'pid2', 'pid3', 'pid4' ]
+        metax_files = {
+            'pid1': (1, 'abc'),
+            'pid2': (2, 'xyz'),
+            'pid3': None,
+        }
+
+        reconciliation = reconcile(records, frozen_file_pids, metax_files, 'identifier', compared_fields=compared_fields)
+
+        self.assertEqual([ r['identifier'] for r in reconciliation.new ], [ 'pid4' ])
+        self.assertEqual([ r['identifier'] for r in reconciliation.existing ], [ 'pid1', 'pid2', 'pid3' ])
+        self.assertEqual([ r['identifier'] for r in reconciliation.changed ], [ 'pid2', 'pid3' ])
+        self.assertEqual(reconciliation.removed, [])
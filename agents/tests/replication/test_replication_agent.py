@@ -22,6 +22,8 @@
 #--------------------------------------------------------------------------------
 
 from copy import deepcopy
+from json import loads as json_loads
+from os import remove
 from os.path import isfile
 from time import sleep
 
@@ -72,6 +74,39 @@ class ReplicationAgentUnitTests(ReplicationAgentTestsCommon):
             file_path = construct_file_path(self.agent._uida_conf_vars, node, replication=True)
             self.assertEqual(isfile(file_path), True, 'copied file does not exist!')
 
+    @responses.activate
+    def test_checksum_mismatch_after_replication_is_detected(self):
+        """
+        Ensure a replicated file whose checksum does not match the frozen checksum is reported,
+        with both replication verification modes.
+        """
+
+        print("   %s" % inspect.currentframe().f_code.co_name)
+
+        test_action = deepcopy(ida_test_data['actions'][5])
+
+        # note - an internal reads project identifier from the rabbitmq message
+        self.agent.rabbitmq_message = test_action
+
+        for verification in ('frozen_checksum', 'readback'):
+
+            with self.subTest(verification=verification):
+
+                self.agent._settings['replication_verification'] = verification
+
+                node = self.agent._get_nodes_associated_with_action(test_action)[0]
+                node['checksum'] = 'sha256:%s' % ('0' * 64)
+
+                # an existing replica of the same size would not be copied again
+                file_path = construct_file_path(self.agent._uida_conf_vars, node, replication=True)
+                if isfile(file_path):
+                    remove(file_path)
+
+                with self.assertRaisesRegex(Exception, 'Checksum mismatch after replication'):
+                    self.agent._copy_to_replication_location(node)
+
+                self.assertEqual(node.get('_copied', False), False)
+
     @responses.activate
     def test_replicated_files_are_not_copied_again(self):
         """
@@ -93,6 +128,30 @@ class ReplicationAgentUnitTests(ReplicationAgentTestsCommon):
         self.assertEqual(self.agent.last_number_of_files_replicated, 2)
 
 
+    @responses.activate
+    def test_replicated_timestamps_are_saved_in_batches(self):
+        """
+        Ensure the replicated timestamps of files copied concurrently are saved to IDA db
+        in batches of at most replication_commit_batch_size files.
+        """
+
+        print("   %s" % inspect.currentframe().f_code.co_name)
+
+        test_action = deepcopy(ida_test_data['actions'][5])
+
+        # note - an internal reads project identifier from the rabbitmq message
+        self.agent.rabbitmq_message = test_action
+        self.agent._settings['replication_commit_batch_size'] = 1
+
+        self.agent._process_replication(test_action)
+        self.assertEqual(self.agent.last_number_of_files_replicated, 2)
+
+        batch_calls = [ call for call in responses.calls if call.request.url.endswith('/files/batch') ]
+        self.assertEqual(len(batch_calls), 2)
+        for call in batch_calls:
+            self.assertEqual(len(json_loads(call.request.body)['files']), 1)
+
+
 class ReplicationAgentProcessQueueTests(ReplicationAgentTestsCommon):
 
     @responses.activate
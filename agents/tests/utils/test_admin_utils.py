@@ -0,0 +1,465 @@
+#--------------------------------------------------------------------------------
+# This file is part of the IDA research data storage service
+#
+# Copyright (C) 2018 Ministry of Education and Culture, Finland
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public
+# License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# @author   CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# @license  GNU Affero General Public License, version 3
+# @link     https://research.csc.fi/
+#--------------------------------------------------------------------------------
+
+from datetime import datetime
+from hashlib import sha256
+from types import SimpleNamespace
+
+import importlib.util
+import inspect
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+
+ADMIN_LIB_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../../../utils/admin/lib')
+
+
+# Admin modules loaded so far, by the top level module names with which the admin utilities import each other
+ADMIN_MODULES = {}
+
+
+def load_admin_module(module_name):
+    """
+    Load a module of the admin utilities, which import each other as top level modules, e.g. 'from utils import ...'
+    """
+    module_spec = importlib.util.spec_from_file_location('admin_%s' % module_name, '%s/%s.py' % (ADMIN_LIB_PATH, module_name))
+    module = importlib.util.module_from_spec(module_spec)
+    admin_modules = dict(ADMIN_MODULES, **{ module_name: module })
+    previous_modules = dict((name, sys.modules.get(name)) for name in admin_modules)
+    sys.modules.update(admin_modules)
+    try:
+        module_spec.loader.exec_module(module)
+    finally:
+        for name, previous_module in previous_modules.items():
+            if previous_module is None:
+                del sys.modules[name]
+            else:
+                sys.modules[name] = previous_module
+    ADMIN_MODULES[module_name] = module
+    return module
+
+
+admin_utils = load_admin_module('utils')
+admin_audit_project = load_admin_module('audit_project')
+admin_audit_projects = load_admin_module('audit_projects')
+
+
+class ScanDirectoryTreeTests(unittest.TestCase):
+
+    """
+    Test the concurrent scanning of the filesystem folders of a project.
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = self.tmp_dir.name
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _path(self, pathname):
+        return '%s/%s' % (self.root, pathname)
+
+    def _touch(self, pathname, mtime):
+        os.utime(self._path(pathname), (mtime, mtime), follow_symlinks=False)
+
+    def test_scan_reports_all_nodes_as_find_does(self):
+        """
+        Ensure every node of a tree is reported with its own size and modification time, that symbolic
+        links are not followed, and that only folders and links to folders are reported as folders, also
+        when the tree contains broken links, symbolic link loops and special files.
+        """
+
+        print("   %s" % inspect.currentframe().f_code.co_name)
+
+        os.makedirs(self._path('sub/nested'))
+        with open(self._path('a.txt'), 'w') as f:
+            f.write('abc')
+        with open(self._path('sub/nested/b.txt'), 'w') as f:
+            f.write('contents of b')
+        os.symlink('sub', self._path('link_to_sub'))
+        os.symlink('missing', self._path('broken'))
+        os.symlink('loop2', self._path('loop1'))
+        os.symlink('loop1', self._path('loop2'))
+        os.mkfifo(self._path('sub/fifo'))
+
+        mtimes = {
+            'a.txt': 1000000001,
+            'sub/nested/b.txt': 1000000002,
+            'link_to_sub': 1000000003,
+            'broken': 1000000004,
+            'loop1': 1000000005,
+            'loop2': 1000000006,
+            'sub/fifo': 1000000007,
+            'sub/nested': 1000000008,
+            'sub': 1000000009
+        }
+
+        for pathname, mtime in mtimes.items():
+            self._touch(pathname, mtime)
+
+        expected_nodes = set([
+            ('a.txt', False, 3, 1000000001),
+            ('sub/nested/b.txt', False, 13, 1000000002),
+            ('link_to_sub', True, len('sub'), 1000000003),
+            ('broken', False, len('missing'), 1000000004),
+            ('loop1', False, len('loop2'), 1000000005),
+            ('loop2', False, len('loop1'), 1000000006),
+            ('sub/fifo', False, 0, 1000000007),
+            ('sub/nested', True, os.lstat(self._path('sub/nested')).st_size, 1000000008),
+            ('sub', True, os.lstat(self._path('sub')).st_size, 1000000009)
+        ])
+
+        for workers in [ 1, 4 ]:
+            nodes = list(admin_utils.scan_directory_tree(self.root, workers=workers))
+            self.assertEqual(len(nodes), len(expected_nodes), 'each node should be reported once')
+            self.assertEqual(set(nodes), expected_nodes)
+
+    def test_scan_of_missing_root_yields_nothing(self):
+        """
+        Ensure a root folder which cannot be scanned is skipped rather than aborting the scan.
+        """
+
+        print("   %s" % inspect.currentframe().f_code.co_name)
+
+        self.assertEqual(list(admin_utils.scan_directory_tree(self._path('missing'))), [])
+
+
+class ChecksumGeneratorTests(unittest.TestCase):
+
+    """
+    Test the concurrent generation of checksums during filesystem audits.
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.config = SimpleNamespace(PROJECT='test_project', AUDIT_CHECKSUM_WORKERS=2,
+                                      CHECKSUM_CACHE_INSTANCE=None, STRICT_CHECKSUMS=False)
+        self.original_generate_checksum = admin_audit_project.generate_checksum
+
+    def tearDown(self):
+        admin_audit_project.generate_checksum = self.original_generate_checksum
+        self.tmp_dir.cleanup()
+
+    def _create_files(self, count):
+        files = []
+        for i in range(count):
+            pathname = '%s/file_%d.dat' % (self.tmp_dir.name, i)
+            contents = ('contents of file %d' % i).encode()
+            with open(pathname, 'wb') as f:
+                f.write(contents)
+            files.append((pathname, sha256(contents).hexdigest()))
+        return files
+
+    def test_checksums_are_recorded_in_node_details(self):
+        """
+        Ensure the checksum of each file is recorded in the node details of that file, and that all
+        checksums have been recorded once the generator is exited.
+        """
+
+        print("   %s" % inspect.currentframe().f_code.co_name)
+
+        files = self._create_files(50)
+        nodes = {}
+
+        with admin_audit_project.ChecksumGenerator(self.config) as checksums:
+            for pathname, _ in files:
+                nodes[pathname] = { 'type': 'file' }
+                checksums.add(nodes[pathname], pathname)
+
+        for pathname, checksum in files:
+            self.assertEqual(nodes[pathname], { 'type': 'file', 'checksum': checksum })
+
+    def test_pending_checksums_are_bounded(self):
+        """
+        Ensure no more than four files per worker are queued while the checksums are being generated.
+        """
+
+        print("   %s" % inspect.currentframe().f_code.co_name)
+
+        released = threading.Event()
+
+        def generate_checksum(filesystem_pathname, cache=None, strict=False):
+            released.wait(timeout=10)
+            return 'sha256:%s' % filesystem_pathname
+
+        admin_audit_project.generate_checksum = generate_checksum
+
+        max_pending = self.config.AUDIT_CHECKSUM_WORKERS * 4
+        pending_counts = []
+        nodes = [ {} for i in range(max_pending * 3) ]
+
+        timer = threading.Timer(0.2, released.set)
+        timer.start()
+
+        try:
+            with admin_audit_project.ChecksumGenerator(self.config) as checksums:
+                for i, node_details in enumerate(nodes):
+                    checksums.add(node_details, 'file_%d' % i)
+                    pending_counts.append(len(checksums._pending))
+        finally:
+            timer.cancel()
+            released.set()
+
+        self.assertEqual(max(pending_counts), max_pending)
+        self.assertEqual([ node_details['checksum'] for node_details in nodes ],
+                         [ 'file_%d' % i for i in range(len(nodes)) ])
+
+    def test_failed_checksum_is_recorded_as_none(self):
+        """
+        Ensure a file whose checksum cannot be generated, e.g. one removed during the audit, does not abort
+        the audit, and is recorded with no checksum.
+        """
+
+        print("   %s" % inspect.currentframe().f_code.co_name)
+
+        files = self._create_files(10)
+        removed_pathname = files[3][0]
+        os.remove(removed_pathname)
+        nodes = {}
+
+        with admin_audit_project.ChecksumGenerator(self.config) as checksums:
+            for pathname, _ in files:
+                nodes[pathname] = {}
+                checksums.add(nodes[pathname], pathname)
+
+        for pathname, checksum in files:
+            if pathname == removed_pathname:
+                self.assertEqual(nodes[pathname], { 'checksum': None })
+            else:
+                self.assertEqual(nodes[pathname], { 'checksum': checksum })
+
+
+class AuditProjectsTests(unittest.TestCase):
+
+    """
+    Test auditing multiple projects in parallel, as done by audit-all-projects and audit-active-projects.
+    """
+
+    START = '2024-05-06T07:08:09Z'
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.log_root = '%s/log' % self.tmp_dir.name
+        os.makedirs(self.log_root)
+        os.makedirs('%s/PSO_test_project' % self.tmp_dir.name)
+        self.original_audit_project = admin_audit_project.audit_project
+        self.original_base_config = admin_audit_projects.BASE_CONFIG
+        self.original_base_constants = admin_audit_projects.BASE_CONSTANTS
+        admin_audit_projects.BASE_CONFIG = SimpleNamespace(
+            IDA_ENVIRONMENT='TEST',
+            ROOT=self.tmp_dir.name,
+            STORAGE_OC_DATA_ROOT=self.tmp_dir.name,
+            LOG='%s/ida.log' % self.log_root,
+            DEBUG=False,
+            SCRIPT='audit_projects.py'
+        )
+        admin_audit_projects.BASE_CONSTANTS = SimpleNamespace(
+            STAGING_FOLDER_SUFFIX='+',
+            PROJECT_USER_PREFIX='PSO_',
+            IDA_MIGRATION='2018-11-01T00:00:00Z',
+            IDA_MIGRATION_TS=1541030400
+        )
+
+    def tearDown(self):
+        admin_audit_project.audit_project = self.original_audit_project
+        admin_audit_projects.BASE_CONFIG = self.original_base_config
+        admin_audit_projects.BASE_CONSTANTS = self.original_base_constants
+        self.tmp_dir.cleanup()
+
+    def _audit_returns(self, invalid_nodes):
+        """
+        Make the audit of a project report the invalid nodes provided, as audit_project.audit_project() would
+        """
+        def audit_project(config):
+            return {
+                'project': config.PROJECT,
+                'start': config.START,
+                'end': '2024-05-06T07:10:00Z',
+                'changedAfter': None,
+                'changedBefore': None,
+                'auditStaging': config.AUDIT_STAGING,
+                'auditFrozen': config.AUDIT_FROZEN,
+                'auditTimestamps': config.AUDIT_TIMESTAMPS,
+                'auditChecksums': config.AUDIT_CHECKSUMS,
+                'filesystemNodeCount': 3,
+                'nextcloudNodeCount': 3,
+                'frozenFileCount': 1,
+                'metaxFileCount': 1,
+                'invalidNodeCount': len(invalid_nodes),
+                'invalidNodes': invalid_nodes
+            }
+        admin_audit_project.audit_project = audit_project
+
+    def _report_pathname(self, status):
+        return '%s/audits/%s/%s_test_project.%s.json' % (self.log_root, datetime.utcnow().strftime('%Y/%m'), self.START, status)
+
+    def _jq(self, expression, pathname):
+        if not shutil.which('jq'):
+            self.skipTest('jq is not installed')
+        return subprocess.run([ 'jq', expression, '--indent', '4', pathname ], stdout=subprocess.PIPE,
+                              check=True, universal_newlines=True).stdout
+
+    def test_arguments_are_parsed_as_by_audit_project(self):
+        """
+        Ensure the audit options are accepted and rejected as by utils/admin/audit-project.
+        """
+
+        print("   %s" % inspect.currentframe().f_code.co_name)
+
+        parse_arguments = admin_audit_projects.parse_arguments
+
+        self.assertEqual(parse_arguments([]), (None, None, [], None, None))
+
+        self.assertEqual(
+            parse_arguments([ '--changed-after', '2024-01-02', '--changed-before', '2024-02-03T04:05:06Z', '--staging', '--checksums' ]),
+            ('2024-01-02T00:00:00Z', '2024-02-03T04:05:06Z', [ '--staging', '--checksums' ], None, None)
+        )
+
+        self.assertEqual(
+            parse_arguments([ '--full', '--report-errors', 'someone@example.com' ]),
+            (None, None, [ '--full' ], '--report-errors', 'someone@example.com')
+        )
+
+        self.assertEqual(
+            parse_arguments([ '--report', '--timestamps' ]),
+            (None, None, [ '--timestamps' ], '--report', None)
+        )
+
+        invalid_arguments = [
+            ([ '--full', '--changed-after', '2024-01-02' ], 'Only one of --full or --changed-after/--changed-before'),
+            ([ '--changed-before', '2024-01-02', '--full' ], 'Only one of --full or --changed-after/--changed-before'),
+            ([ '--changed-after' ], 'Missing date'),
+            ([ '--changed-after', '2024-1-2' ], 'Invalid date'),
+            ([ '--changed-before', '2024-01-02T03:04:05' ], 'Invalid date'),
+            ([ '--report', '--report-errors' ], 'Only one of --report or --report-errors'),
+            ([ 'someone@example.com', '--report' ], 'Invalid argument: someone@example.com'),
+            ([ '--report', 'someone@example.com', 'other@example.com' ], 'Invalid argument: other@example.com'),
+            ([ '--unknown' ], 'Invalid argument: --unknown')
+        ]
+
+        for args, message in invalid_arguments:
+            with self.subTest(args=args):
+                with self.assertRaisesRegex(Exception, message):
+                    parse_arguments(args)
+
+    def test_ok_report_is_saved_with_summary(self):
+        """
+        Ensure the report of a project with no invalid nodes is saved as START_PROJECT.OK.json, with no
+        summary file, and that the summary matches the one generated by audit-project with jq.
+        """
+
+        print("   %s" % inspect.currentframe().f_code.co_name)
+
+        self._audit_returns({})
+
+        report_pathname, summary, ok = admin_audit_projects.audit_one_project(
+            'test_project', self.START, '1970-01-01T00:00:00Z', self.START, [ '--timestamps' ])
+
+        self.assertEqual(ok, True)
+        self.assertEqual(report_pathname, self._report_pathname('OK'))
+        self.assertEqual(os.path.exists('%s.summary' % report_pathname), False)
+
+        with open(report_pathname) as report_file:
+            report = json.load(report_file)
+
+        self.assertEqual(report['project'], 'test_project')
+        self.assertEqual(report['auditTimestamps'], True)
+        self.assertEqual(report['invalidNodeCount'], 0)
+        self.assertEqual(json.loads(summary), dict((key, value) for key, value in report.items()
+                                                   if key not in [ 'invalidNodes', 'errors', 'oldest', 'newest' ]))
+
+        self.assertEqual(summary + '\n', self._jq('del(.invalidNodes, .errors, .oldest, .newest)', report_pathname))
+
+    def test_error_report_is_saved_with_summary_file(self):
+        """
+        Ensure the report of a project with invalid nodes is saved as START_PROJECT.ERR.json, with the summary
+        saved alongside, and that the summary, with the node listings removed at all levels, matches the one
+        generated by audit-project with jq.
+        """
+
+        print("   %s" % inspect.currentframe().f_code.co_name)
+
+        self._audit_returns({
+            'frozen/a/file.dat': {
+                'errors': [ 'Node does not exist in filesystem', 'Node size different for Nextcloud and IDA' ],
+                'nextcloud': { 'type': 'file', 'size': 10, 'checksum': 'abc', 'modified': '2024-01-01T00:00:00Z', 'uploaded': None },
+                'ida': { 'type': 'file', 'size': 11, 'checksum': 'abc', 'modified': '2024-01-01T00:00:00Z',
+                         'frozen': '2024-01-02T00:00:00Z', 'pid': 'pid1', 'replicated': None }
+            },
+            'staging/b': {
+                'errors': [ 'Node does not exist in filesystem' ],
+                'nextcloud': { 'type': 'folder', 'modified': '2024-02-01T00:00:00Z' }
+            }
+        })
+
+        report_pathname, summary, ok = admin_audit_projects.audit_one_project(
+            'test_project', self.START, '1970-01-01T00:00:00Z', self.START, [])
+
+        self.assertEqual(ok, False)
+        self.assertEqual(report_pathname, self._report_pathname('ERR'))
+
+        with open('%s.summary' % report_pathname) as summary_file:
+            self.assertEqual(summary_file.read(), summary + '\n')
+
+        with open(report_pathname) as report_file:
+            report = json.load(report_file)
+
+        self.assertEqual(report['invalidNodeCount'], 2)
+        self.assertEqual(report['errorCount'], 2)
+        self.assertEqual(len(report['invalidNodes']), 2)
+
+        summary = json.loads(summary)
+
+        self.assertEqual('invalidNodes' in summary, False)
+        self.assertEqual(summary['errors']['Node does not exist in filesystem'], {
+            'files': { 'node_count': 1, 'frozen': { 'node_count': 1 } },
+            'folders': { 'node_count': 1, 'staging': { 'node_count': 1 } }
+        })
+        self.assertEqual(summary['errors']['Node size different for Nextcloud and IDA'], {
+            'files': { 'node_count': 1, 'frozen': { 'node_count': 1 } }
+        })
+
+        with open('%s.summary' % report_pathname) as summary_file:
+            self.assertEqual(summary_file.read(), self._jq(
+                'del(.invalidNodes) | walk(if type == "object" then with_entries(select(.key != "nodes")) else . end)',
+                report_pathname
+            ))
+
+    def test_missing_project_is_reported(self):
+        """
+        Ensure auditing a project which does not exist fails, and no report is saved.
+        """
+
+        print("   %s" % inspect.currentframe().f_code.co_name)
+
+        with self.assertRaisesRegex(Exception, 'The specified project no_such_project does not exist'):
+            admin_audit_projects.audit_one_project('no_such_project', self.START, '1970-01-01T00:00:00Z', self.START, [])
+
+        self.assertEqual(os.path.exists('%s/audits' % self.log_root), False)
@@ -0,0 +1,104 @@
+#--------------------------------------------------------------------------------
+# This file is part of the IDA research data storage service
+#
+# Copyright (C) 2018 Ministry of Education and Culture, Finland
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public
+# License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# @author   CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# @license  GNU Affero General Public License, version 3
+# @link     https://research.csc.fi/
+#--------------------------------------------------------------------------------
+
+from hashlib import sha256
+
+import inspect
+import os
+import tempfile
+import unittest
+
+from agents.utils.checksum_cache import ChecksumCache, generate_file_checksum
+
+
+class ChecksumCacheTests(unittest.TestCase):
+
+    """
+    Test the local persistent checksum cache.
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache = ChecksumCache('%s/checksum_cache.db' % self.tmp_dir.name)
+        self.file_path = '%s/test.dat' % self.tmp_dir.name
+        self._write_file(b'original contents', 1000000000)
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmp_dir.cleanup()
+
+    def _write_file(self, contents, mtime_ns):
+        with open(self.file_path, 'wb') as f:
+            f.write(contents)
+        os.utime(self.file_path, ns=(mtime_ns, mtime_ns))
+
+    def test_cached_checksum_is_used_while_file_is_unchanged(self):
+        """
+        Ensure a stored checksum is returned for an unmodified file, and not once the size or
+        modification time of the file changes.
+        """
+
+        print("   %s" % inspect.currentframe().f_code.co_name)
+
+        original_checksum = sha256(b'original contents').hexdigest()
+
+        self.assertEqual(generate_file_checksum(self.file_path, cache=self.cache), original_checksum)
+        self.assertEqual(self.cache.get(os.stat(self.file_path)), original_checksum)
+
+        # contents changed behind the cache's back, with size and modification time preserved
+        self._write_file(b'modified contents', 1000000000)
+        self.assertEqual(generate_file_checksum(self.file_path, cache=self.cache), original_checksum,
+            'unchanged inode, size and modification time should hit the cache')
+
+        # strict mode reads the file, and updates the cache
+        modified_checksum = sha256(b'modified contents').hexdigest()
+        self.assertEqual(generate_file_checksum(self.file_path, cache=self.cache, strict=True), modified_checksum)
+        self.assertEqual(self.cache.get(os.stat(self.file_path)), modified_checksum)
+
+        # a new modification time invalidates the cached checksum
+        self._write_file(b'original contents', 2000000000)
+        self.assertEqual(self.cache.get(os.stat(self.file_path)), None)
+        self.assertEqual(generate_file_checksum(self.file_path, cache=self.cache), original_checksum)
+
+    def test_oldest_checksums_are_evicted(self):
+        """
+        Ensure the cache is kept within its maximum number of entries.
+        """
+
+        print("   %s" % inspect.currentframe().f_code.co_name)
+
+        class Stat():
+            def __init__(self, ino):
+                self.st_dev = 1
+                self.st_ino = ino
+                self.st_size = 1
+                self.st_mtime_ns = 1
+
+        cache = ChecksumCache('%s/evicted.db' % self.tmp_dir.name, max_entries=500)
+
+        for ino in range(2000):
+            cache.put(Stat(ino), 'checksum%d' % ino)
+
+        self.assertEqual(cache.get(Stat(0)), None, 'oldest checksums should have been evicted')
+        self.assertEqual(cache.get(Stat(1999)), 'checksum1999')
+        cache.close()
@@ -0,0 +1,90 @@
+#--------------------------------------------------------------------------------
+# This file is part of the IDA research data storage service
+#
+# Copyright (C) 2018 Ministry of Education and Culture, Finland
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public
+# License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# @author   CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# @license  GNU Affero General Public License, version 3
+# @link     https://research.csc.fi/
+#--------------------------------------------------------------------------------
+
+from hashlib import sha256
+
+import errno
+import inspect
+import os
+import tempfile
+import unittest
+
+from agents.utils.file_copy import FileCopier, READINTO
+
+
+class FileCopierTests(unittest.TestCase):
+
+    """
+    Test copying files with the zero-copy methods and the read loop fallback.
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.contents = os.urandom(300000)
+        self.src_path = '%s/src.dat' % self.tmp_dir.name
+        with open(self.src_path, 'wb') as f:
+            f.write(self.contents)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _copy(self, copier, dest_name, sha=None):
+        dest_path = '%s/%s' % (self.tmp_dir.name, dest_name)
+        with open(self.src_path, 'rb', buffering=0) as src, open(dest_path, 'wb', buffering=0) as dest:
+            method = copier.copy(src, dest, sha)
+        with open(dest_path, 'rb') as f:
+            self.assertEqual(f.read(), self.contents, 'copied contents differ from original, method: %s' % method)
+        return method
+
+    def test_unsupported_method_falls_back_and_is_remembered(self):
+        """
+        Ensure all copy methods copy the file intact, that a method failing as unsupported mid-copy
+        is continued by the next one and not attempted again for the same devices, and that the read
+        loop is used when the copied bytes are to be hashed.
+        """
+
+        print("   %s" % inspect.currentframe().f_code.co_name)
+
+        copier = FileCopier(block_size=65536)
+        calls = []
+
+        def unsupported_copy_file_range(src, dest):
+            calls.append('copy_file_range')
+            # copy part of the file before failing, as may happen on some filesystems
+            dest.write(src.read(100000))
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+        copier._copy_file_range = unsupported_copy_file_range
+
+        if hasattr(os, 'sendfile'):
+            expected_method = 'sendfile'
+        else:
+            expected_method = READINTO
+
+        self.assertEqual(self._copy(copier, 'dest1.dat'), expected_method)
+        self.assertEqual(self._copy(copier, 'dest2.dat'), expected_method)
+        self.assertEqual(len(calls), 1 if hasattr(os, 'copy_file_range') else 0)
+
+        sha = sha256()
+        self.assertEqual(self._copy(copier, 'dest3.dat', sha=sha), READINTO)
+        self.assertEqual(sha.hexdigest(), sha256(self.contents).hexdigest())
@@ -0,0 +1,143 @@
+#--------------------------------------------------------------------------------
+# This file is part of the IDA research data storage service
+#
+# Copyright (C) 2025 Ministry of Education and Culture, Finland
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public
+# License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# @author CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# @license GNU Affero General Public License, version 3
+# @link https://research.csc.fi/
+#--------------------------------------------------------------------------------
+
+# NOTE: this module depends only on the python standard library, since it is also loaded by the
+# admin utilities in utils/admin/lib, which do not have the agents package available.
+
+import os
+import sqlite3
+import threading
+import time
+
+from hashlib import sha256
+
+
+class ChecksumCache():
+
+    """
+    A local persistent cache of SHA-256 checksums of file contents, stored in an SQLite database.
+
+    Checksums are keyed by the device and inode of the file, and are valid only as long as the size
+    and modification time (in nanoseconds) of the file are the same as when the checksum was generated.
+    Since the device is part of the key, a single cache can serve all storage volumes of a host.
+
+    The cache is shared by all processes on the host, and can be used concurrently by multiple threads.
+    The database must be on a host-local filesystem, as SQLite in WAL mode is not safe on network or
+    cluster filesystems, and device and inode numbers are not meaningful on other hosts.
+    When the cache grows past max_entries, the least recently stored checksums are evicted. Errors accessing
+    the cache, e.g. due to a locked or read-only database, are treated as cache misses, so that the cache can
+    never cause generating a checksum to fail.
+    """
+
+    def __init__(self, path, max_entries=10000000):
+        self._path = path
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._inserts = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS checksums ('
+            ' dev INTEGER NOT NULL, ino INTEGER NOT NULL, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL,'
+            ' checksum TEXT NOT NULL, stored REAL NOT NULL, PRIMARY KEY (dev, ino))'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS checksums_stored ON checksums (stored)')
+
+    def get(self, stat):
+        """
+        Return the cached checksum of the file with the specified os.stat() result, or None if the
+        checksum is not cached or the file has been modified since its checksum was stored.
+        """
+        try:
+            with self._lock:
+                row = self._db.execute(
+                    'SELECT checksum FROM checksums WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ?',
+                    (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+                ).fetchone()
+        except sqlite3.Error:
+            return None
+        return row[0] if row else None
+
+    def put(self, stat, checksum):
+        """
+        Store the checksum of the file with the specified os.stat() result, replacing any checksum
+        previously stored for the same inode.
+        """
+        try:
+            with self._lock:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO checksums (dev, ino, size, mtime_ns, checksum, stored) VALUES (?, ?, ?, ?, ?, ?)',
+                    (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, checksum, time.time())
+                )
+                self._inserts += 1
+                # check the need for eviction only now and then, as counting the entries is not free
+                if self._inserts % 1000 == 0:
+                    self._evict()
+        except sqlite3.Error:
+            pass
+
+    def _evict(self):
+        count = self._db.execute('SELECT COUNT(*) FROM checksums').fetchone()[0]
+        if count > self._max_entries:
+            # evict down to 90% of the maximum, so that eviction is not needed again on the next check
+            self._db.execute(
+                'DELETE FROM checksums WHERE rowid IN (SELECT rowid FROM checksums ORDER BY stored ASC LIMIT ?)',
+                (count - int(self._max_entries * 0.9),)
+            )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def generate_file_checksum(file_path, cache=None, strict=False, block_size=65536):
+    """
+    Generate an SHA-256 checksum for the specified file, returned as a lowercase hex string.
+
+    If a checksum cache is given, the checksum is first looked up from the cache, and the file is read only
+    if the checksum is not cached for the current size and modification time of the file. If strict is true,
+    the cache is not consulted, and the file is always read, but the generated checksum is still stored.
+
+    A generated checksum is stored only if the file was not modified while it was being read.
+    """
+    stat = os.stat(file_path) if cache is not None else None
+
+    if stat is not None and not strict:
+        checksum = cache.get(stat)
+        if checksum is not None:
+            return checksum
+
+    sha = sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    checksum = sha.hexdigest().lower()
+
+    if stat is not None:
+        stat_after = os.stat(file_path)
+        if (stat_after.st_ino, stat_after.st_size, stat_after.st_mtime_ns) == (stat.st_ino, stat.st_size, stat.st_mtime_ns):
+            cache.put(stat, checksum)
+
+    return checksum
@@ -0,0 +1,133 @@
+#--------------------------------------------------------------------------------
+# This file is part of the IDA research data storage service
+#
+# Copyright (C) 2025 Ministry of Education and Culture, Finland
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public
+# License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# @author CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# @license GNU Affero General Public License, version 3
+# @link https://research.csc.fi/
+#--------------------------------------------------------------------------------
+
+import errno
+import os
+import threading
+
+
+# Errors with which copy_file_range and sendfile report that they cannot copy between the given files,
+# e.g. across filesystems or on filesystems which do not support them, rather than failing to copy
+UNSUPPORTED_ERRNOS = set([ errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF, errno.EPERM ])
+
+# Max number of bytes requested from the kernel with a single copy_file_range or sendfile call
+MAX_SYSCALL_BYTES = 1 << 30
+
+COPY_FILE_RANGE = 'copy_file_range'
+SENDFILE = 'sendfile'
+READINTO = 'readinto'
+
+
+class FileCopier():
+
+    """
+    Copies file contents using the most efficient method supported between the source and destination
+    filesystems: copy_file_range, which lets the filesystem copy or clone the data without it passing through
+    user space, then sendfile, which copies within the kernel, and finally a loop reading blocks into a
+    reused buffer and writing them out.
+
+    Whether copy_file_range and sendfile are supported is determined on first use for each pair of source
+    and destination devices, and remembered for subsequent copies. If a method fails mid-copy as unsupported,
+    copying continues from the same offset with the next method.
+
+    If a hash object is given, the data must pass through user space to be hashed, so the read loop is used.
+
+    A single instance can be used concurrently by multiple threads; each thread uses its own buffer.
+    """
+
+    def __init__(self, block_size=1048576):
+        self._block_size = block_size
+        self._unsupported = {}
+        self._lock = threading.Lock()
+        self._buffers = threading.local()
+
+    def copy(self, src, dest, sha=None):
+        """
+        Copy the contents of the open file src, from its current position, to the open file dest. Both
+        files must be opened unbuffered, i.e. with buffering=0. If a hash object sha is given, it is updated
+        with the bytes copied. Returns the name of the last method used.
+        """
+        if sha is not None:
+            self._readinto(src, dest, sha)
+            return READINTO
+
+        size = os.fstat(src.fileno()).st_size
+        devices = (os.fstat(src.fileno()).st_dev, os.fstat(dest.fileno()).st_dev)
+
+        for method, copy in ((COPY_FILE_RANGE, self._copy_file_range), (SENDFILE, self._sendfile)):
+            if not self._is_supported(devices, method):
+                continue
+            try:
+                copy(src, dest)
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+                self._set_unsupported(devices, method)
+                continue
+            # Some filesystems report end of file from copy_file_range without copying anything
+            if src.tell() >= size:
+                return method
+            self._set_unsupported(devices, method)
+
+        self._readinto(src, dest)
+
+        return READINTO
+
+    def _is_supported(self, devices, method):
+        if method == COPY_FILE_RANGE and not hasattr(os, 'copy_file_range'):
+            return False
+        if method == SENDFILE and not hasattr(os, 'sendfile'):
+            return False
+        return method not in self._unsupported.get(devices, ())
+
+    def _set_unsupported(self, devices, method):
+        with self._lock:
+            self._unsupported[devices] = self._unsupported.get(devices, frozenset()) | frozenset([ method ])
+
+    def _copy_file_range(self, src, dest):
+        while os.copy_file_range(src.fileno(), dest.fileno(), MAX_SYSCALL_BYTES) > 0:
+            pass
+
+    def _sendfile(self, src, dest):
+        while os.sendfile(dest.fileno(), src.fileno(), None, MAX_SYSCALL_BYTES) > 0:
+            pass
+
+    def _readinto(self, src, dest, sha=None):
+        buffer = self._get_buffer()
+        view = memoryview(buffer)
+        while True:
+            length = src.readinto(buffer)
+            if not length:
+                break
+            block = view[:length]
+            if sha is not None:
+                sha.update(block)
+            while len(block) > 0:
+                block = block[dest.write(block):]
+
+    def _get_buffer(self):
+        buffer = getattr(self._buffers, 'buffer', None)
+        if buffer is None or len(buffer) != self._block_size:
+            buffer = bytearray(self._block_size)
+            self._buffers.buffer = buffer
+        return buffer
@@ -177,6 +177,70 @@ EXCHANGES = [
             },
         ]
     },
+    {
+        'name': 'batch-actions-deferred',
+        'type': 'direct',
+        'arguments': {},
+        'queues': [
+            # queues where batch actions of projects already at their limit of batch actions in flight
+            # are republished to for waiting a period of time, until they are dead-lettered back to the
+            # end of the batch queue they were consumed from, see GenericAgent._defer_batch_message().
+            {
+                'name': 'batch-metadata-deferred',
+                'routing_key': 'batch-metadata-deferred',
+                'arguments': {
+                    'x-message-ttl': settings['batch_project_defer_interval'] * 1000,
+                    'x-dead-letter-exchange': 'batch-actions-deferred',
+                    'x-dead-letter-routing-key': 'batch-metadata'
+                }
+            },
+            {
+                'name': 'batch-metadata-failed-deferred',
+                'routing_key': 'batch-metadata-failed-deferred',
+                'arguments': {
+                    'x-message-ttl': settings['batch_project_defer_interval'] * 1000,
+                    'x-dead-letter-exchange': 'batch-actions-deferred',
+                    'x-dead-letter-routing-key': 'batch-metadata-failed'
+                }
+            },
+            {
+                'name': 'batch-replication-deferred',
+                'routing_key': 'batch-replication-deferred',
+                'arguments': {
+                    'x-message-ttl': settings['batch_project_defer_interval'] * 1000,
+                    'x-dead-letter-exchange': 'batch-actions-deferred',
+                    'x-dead-letter-routing-key': 'batch-replication'
+                }
+            },
+            {
+                'name': 'batch-replication-failed-deferred',
+                'routing_key': 'batch-replication-failed-deferred',
+                'arguments': {
+                    'x-message-ttl': settings['batch_project_defer_interval'] * 1000,
+                    'x-dead-letter-exchange': 'batch-actions-deferred',
+                    'x-dead-letter-routing-key': 'batch-replication-failed'
+                }
+            },
+
+            # the batch queues are bound also to this exchange, to receive the deferred batch actions
+            {
+                'name': 'batch-metadata',
+                'routing_key': 'batch-metadata'
+            },
+            {
+                'name': 'batch-metadata-failed',
+                'routing_key': 'batch-metadata-failed'
+            },
+            {
+                'name': 'batch-replication',
+                'routing_key': 'batch-replication'
+            },
+            {
+                'name': 'batch-replication-failed',
+                'routing_key': 'batch-replication-failed'
+            },
+        ]
+    },
 ]
 
 SUCCESS_CODES = (200, 201, 204)
@@ -72,6 +72,32 @@ def construct_file_path(_uida_conf_vars, node_data, replication=False):
     return full_file_path
 
 
+def get_checksum_value(checksum):
+    """
+    Return a plain checksum value, given either a SHA-256 checksum URI or a plain checksum value
+    Normalize returned string to lowercase
+    """
+    if checksum is not None and isinstance(checksum, str) and checksum.strip() != '':
+        checksum = checksum.lower()
+        if checksum.startswith('sha256:'):
+            return checksum[7:]
+        return checksum
+    return None
+
+
+def get_checksum_uri(checksum):
+    """
+    Return an SHA-256 checksum URI, given either a plain SHA-256 checksum value or a SHA-256 checksum URI
+    Normalize returned string to lowercase
+    """
+    if checksum is not None and isinstance(checksum, str) and checksum.strip() != '':
+        checksum = checksum.lower()
+        if checksum.startswith('sha256:'):
+            return checksum
+        return 'sha256:%s' % checksum
+    return None
+
+
 def normalize_timestamp(timestamp):
     """
     Returns the input timestamp as a normalized ISO 8601 UTC timestamp string YYYY-MM-DDThh:mm:ssZ
@@ -210,6 +236,9 @@ def load_variables_from_uida_conf_files():
     if hasattr(server_conf, 'DMF_STATUS'):
         uida_conf_vars['DMF_STATUS'] = server_conf.DMF_STATUS
 
+    # optional, the local persistent checksum cache is not used if not defined
+    uida_conf_vars['CHECKSUM_CACHE'] = getattr(server_conf, 'CHECKSUM_CACHE', None)
+
     if executing_test_case():
         test_server_conf = _load_module_from_file(
             "server_configuration.variables", test_settings['server_configuration_path']
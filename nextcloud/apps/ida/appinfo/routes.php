@@ -305,6 +305,16 @@ return [
             //     pathname = pathname of the file, beginning with either 'frozen/' or 'staging/'
         ],
 
+        [
+            // Retrieve the Nextcloud file cache checksums for all files within a specific pathname scope
+            'name' => 'Freezing#retrieveCacheChecksums',
+            'url'  => '/api/retrieveCacheChecksums',
+            'verb' => 'GET'
+            // Restricted to PSO user. Project name is derived from PSO username
+            // Required parameters:
+            //     pathname = pathname of the file or folder, beginning with either 'frozen/' or 'staging/'
+        ],
+
         // Scope Intersection Tests
 
         [
@@ -449,6 +459,8 @@ return [
             //     pid = the PID of the action
             // Allowed parameters:
             //     projects = comma separated list of project names with no whitespace
+            //     limit = maximum number of files to return, ordered by record id
+            //     after = id of the file record after which to begin, when limit is specified
         ],
         [
             // Retrieve frozen file details by PID
@@ -459,6 +471,17 @@ return [
             // Required parameters:
             //     pid = the PID of the file
         ],
+        [
+            // Update multiple frozen file records in a single request
+            'name' => 'File#updateFiles',
+            'url'  => '/api/files/batch',
+            'verb' => 'POST'
+            // Restricted to admin or PSO user of project specified for each file
+            // Required parameters:
+            //     files = array of at most MAX_FILE_COUNT objects, each with a required 'pid' field and
+            //             any of the fields allowed by File#updateFile
+            // Returns the number of updated files, and the pid and error of each file which was not updated
+        ],
         [
             // Update frozen file record
             'name' => 'File#updateFile',
@@ -81,23 +81,34 @@ class FileController extends Controller
      *
      * Restricted to the project access scope of the user.
      *
+     * If a limit is specified, the files are returned in pages of at most the specified number of files, ordered
+     * by record id, beginning after the record with the optionally specified id. The id of the last record of a
+     * page is then specified to retrieve the next page.
+     *
      * @param string $pid      the PID of an action
      * @param string $projects a comma separated list of project names, with no whitespace
+     * @param int    $limit    the maximum number of files to return, null = unlimited
+     * @param int    $after    the id of the file record after which to begin, if limit is specified
      *
      * @return DataResponse
      *
      * @NoAdminRequired
      * @NoCSRFRequired
      */
-    public function getFiles($pid = null, $projects = null) {
+    public function getFiles($pid = null, $projects = null, $limit = null, $after = null) {
 
-        Util::writeLog('ida', 'getFiles:' . ' pid=' . $pid . ' projects=' . $projects, \OCP\Util::DEBUG);
+        Util::writeLog('ida', 'getFiles:' . ' pid=' . $pid . ' projects=' . $projects . ' limit=' . $limit . ' after=' . $after, \OCP\Util::DEBUG);
 
         try {
 
             try {
                 API::validateStringParameter('pid', $pid);
                 API::validateStringParameter('projects', $projects);
+                API::validateIntegerParameter('limit', $limit);
+                API::validateIntegerParameter('after', $after);
+                if ($limit !== null && $limit < 1) {
+                    throw new Exception('Input integer parameter "limit" must be greater than zero');
+                }
             }
             catch (Exception $e) {
                 return API::badRequestErrorResponse($e->getMessage());
@@ -151,7 +162,12 @@ class FileController extends Controller
                 return new DataResponse(array());
             }
 
-            $fileEntities = $this->fileMapper->findFiles($pid, $queryProjects);
+            if ($limit !== null) {
+                $fileEntities = $this->fileMapper->findFilesPage($pid, $queryProjects, $limit, $after);
+            }
+            else {
+                $fileEntities = $this->fileMapper->findFiles($pid, $queryProjects);
+            }
 
             if (is_null($fileEntities) || empty($fileEntities)) {
                 return new DataResponse(array());
@@ -486,14 +502,7 @@ class FileController extends Controller
         try {
             try {
                 API::verifyRequiredStringParameter('pid', $pid);
-                API::validateIntegerParameter('size', $size, true);
-                API::validateStringParameter('checksum', $checksum, true);
-                API::validateTimestamp($modified, true);
-                API::validateTimestamp($frozen, true);
-                API::validateTimestamp($metadata, true);
-                API::validateTimestamp($replicated, true);
-                API::validateTimestamp($removed, true);
-                API::validateTimestamp($cleared, true);
+                self::validateFileUpdates($size, $modified, $frozen, $checksum, $metadata, $replicated, $removed, $cleared);
             }
             catch (Exception $e) {
                 return API::badRequestErrorResponse($e->getMessage());
@@ -511,71 +520,194 @@ class FileController extends Controller
                 return API::forbiddenErrorResponse('Session user does not have permission to modify the specified file.');
             }
 
-            // Clear all specified parameter values defined explicitly as the string 'null'
+            self::applyFileUpdates($fileEntity, $size, $modified, $frozen, $checksum, $metadata, $replicated, $removed, $cleared);
 
-            if ($size === 'null') {
-                $fileEntity->setSize(null); $size = null;
-            }
-            if ($modified === 'null') {
-                $fileEntity->setModified(null); $modified = null;
-            }
-            if ($frozen === 'null') {
-                $fileEntity->setFrozen(null); $frozen = null;
-            }
-            if ($checksum === 'null') {
-                $fileEntity->setChecksum(null); $checksum = null;
-            }
-            if ($metadata === 'null') {
-                $fileEntity->setMetadata(null); $metadata = null;
-            }
-            if ($replicated === 'null') {
-                $fileEntity->setReplicated(null); $replicated = null;
-            }
-            if ($removed === 'null') {
-                $fileEntity->setRemoved(null); $removed = null;
+            return new DataResponse($this->fileMapper->update($fileEntity));
+        }
+        catch (Exception $e) {
+            return API::serverErrorResponse('updateFile: ' . $e->getMessage());
+        }
+    }
+
+    /**
+     * Update multiple existing frozen file records in a single request
+     *
+     * Each file is updated as by updateFile(), in the latest existing frozen file record with the specified PID.
+     * A file which cannot be updated is reported in the response, and does not prevent the other files from
+     * being updated.
+     *
+     * Restricted to admin and PSO users for the projects of the files.
+     *
+     * @param array $files at most MAX_FILE_COUNT file objects, each with a required 'pid' field and one or more of
+     *                     the fields 'size', 'modified', 'frozen', 'checksum', 'metadata', 'replicated', 'removed'
+     *                     and 'cleared', with values as allowed by updateFile()
+     *
+     * @return DataResponse
+     *
+     * @NoAdminRequired
+     * @NoCSRFRequired
+     */
+    public function updateFiles($files = null) {
+
+        Util::writeLog('ida', 'updateFiles: count=' . (is_array($files) ? count($files) : 0), \OCP\Util::INFO);
+
+        try {
+
+            if (!is_array($files) || empty($files)) {
+                return API::badRequestErrorResponse('Required array parameter "files" not specified or is empty');
             }
-            if ($cleared === 'null') {
-                $fileEntity->setCleared(null); $cleared = null;
+
+            if (count($files) > Constants::MAX_FILE_COUNT) {
+                return API::badRequestErrorResponse('Number of files ' . count($files) . ' exceeds maximum allowed file count ' . Constants::MAX_FILE_COUNT);
             }
 
-            // Set all allowed specified parameter values and update database record
+            $pids = array();
 
-            if ($size !== null) {
-                $fileEntity->setSize(0 + $size);
+            foreach ($files as $file) {
+                if (is_array($file) && isset($file['pid']) && is_string($file['pid'])) {
+                    $pids[] = $file['pid'];
+                }
             }
-            $checksum = trim($checksum);
-            if ($checksum != null) {
-                // Ensure only the checksum value portion is stored if the checksum was provided as a URI
-                if ($checksum[0] === 's' && substr($checksum, 0, 7) === "sha256:") {
-                    $fileEntity->setChecksum(substr($checksum, 7));
+
+            // Retrieve the latest frozen file records of all files with a single query
+            $fileEntities = $this->fileMapper->findFilesByPids($pids, true);
+
+            $updated = 0;
+            $failed = array();
+
+            foreach ($files as $file) {
+
+                $pid = (is_array($file) && isset($file['pid'])) ? $file['pid'] : null;
+
+                try {
+                    API::verifyRequiredStringParameter('pid', $pid);
+
+                    $size       = $file['size'] ?? null;
+                    $modified   = $file['modified'] ?? null;
+                    $frozen     = $file['frozen'] ?? null;
+                    $checksum   = $file['checksum'] ?? null;
+                    $metadata   = $file['metadata'] ?? null;
+                    $replicated = $file['replicated'] ?? null;
+                    $removed    = $file['removed'] ?? null;
+                    $cleared    = $file['cleared'] ?? null;
+
+                    self::validateFileUpdates($size, $modified, $frozen, $checksum, $metadata, $replicated, $removed, $cleared);
+
+                    if (!isset($fileEntities[$pid])) {
+                        throw new Exception('The specified file was not found.');
+                    }
+
+                    $fileEntity = $fileEntities[$pid];
+
+                    // Restrict to admin and PSO user for the project of the file.
+
+                    if ($this->userId != 'admin' && $this->userId != Constants::PROJECT_USER_PREFIX . $fileEntity->getProject()) {
+                        throw new Exception('Session user does not have permission to modify the specified file.');
+                    }
+
+                    self::applyFileUpdates($fileEntity, $size, $modified, $frozen, $checksum, $metadata, $replicated, $removed, $cleared);
+
+                    $this->fileMapper->update($fileEntity);
+
+                    $updated++;
                 }
-                else {
-                    $fileEntity->setChecksum($checksum);
+                catch (Exception $e) {
+                    $failed[] = array('pid' => $pid, 'error' => $e->getMessage());
                 }
             }
-            if ($modified !== null) {
-                $fileEntity->setModified($modified);
-            }
-            if ($frozen !== null) {
-                $fileEntity->setFrozen($frozen);
-            }
-            if ($metadata !== null) {
-                $fileEntity->setMetadata($metadata);
-            }
-            if ($replicated !== null) {
-                $fileEntity->setReplicated($replicated);
-            }
-            if ($removed !== null) {
-                $fileEntity->setRemoved($removed);
-            }
-            if ($cleared !== null) {
-                $fileEntity->setCleared($cleared);
-            }
 
-            return new DataResponse($this->fileMapper->update($fileEntity));
+            Util::writeLog('ida', 'updateFiles: updated=' . $updated . ' failed=' . count($failed), \OCP\Util::INFO);
+
+            return new DataResponse(array('updated' => $updated, 'failed' => $failed));
         }
         catch (Exception $e) {
-            return API::serverErrorResponse('updateFile: ' . $e->getMessage());
+            return API::serverErrorResponse('updateFiles: ' . $e->getMessage());
+        }
+    }
+
+    /**
+     * Validate the field values of a frozen file record update. Throw exception if any value is invalid.
+     *
+     * @throws Exception
+     */
+    protected static function validateFileUpdates($size, $modified, $frozen, $checksum, $metadata, $replicated, $removed, $cleared) {
+        API::validateIntegerParameter('size', $size, true);
+        API::validateStringParameter('checksum', $checksum, true);
+        API::validateTimestamp($modified, true);
+        API::validateTimestamp($frozen, true);
+        API::validateTimestamp($metadata, true);
+        API::validateTimestamp($replicated, true);
+        API::validateTimestamp($removed, true);
+        API::validateTimestamp($cleared, true);
+    }
+
+    /**
+     * Apply the specified field values to a frozen file record. Fields with a null value are left unchanged,
+     * and fields with the explicit string value 'null' are cleared.
+     *
+     * @param File $fileEntity the frozen file record
+     */
+    protected static function applyFileUpdates($fileEntity, $size, $modified, $frozen, $checksum, $metadata, $replicated, $removed, $cleared) {
+
+        // Clear all specified parameter values defined explicitly as the string 'null'
+
+        if ($size === 'null') {
+            $fileEntity->setSize(null); $size = null;
+        }
+        if ($modified === 'null') {
+            $fileEntity->setModified(null); $modified = null;
+        }
+        if ($frozen === 'null') {
+            $fileEntity->setFrozen(null); $frozen = null;
+        }
+        if ($checksum === 'null') {
+            $fileEntity->setChecksum(null); $checksum = null;
+        }
+        if ($metadata === 'null') {
+            $fileEntity->setMetadata(null); $metadata = null;
+        }
+        if ($replicated === 'null') {
+            $fileEntity->setReplicated(null); $replicated = null;
+        }
+        if ($removed === 'null') {
+            $fileEntity->setRemoved(null); $removed = null;
+        }
+        if ($cleared === 'null') {
+            $fileEntity->setCleared(null); $cleared = null;
+        }
+
+        // Set all allowed specified parameter values
+
+        if ($size !== null) {
+            $fileEntity->setSize(0 + $size);
+        }
+        $checksum = trim($checksum);
+        if ($checksum != null) {
+            // Ensure only the checksum value portion is stored if the checksum was provided as a URI
+            if ($checksum[0] === 's' && substr($checksum, 0, 7) === "sha256:") {
+                $fileEntity->setChecksum(substr($checksum, 7));
+            }
+            else {
+                $fileEntity->setChecksum($checksum);
+            }
+        }
+        if ($modified !== null) {
+            $fileEntity->setModified($modified);
+        }
+        if ($frozen !== null) {
+            $fileEntity->setFrozen($frozen);
+        }
+        if ($metadata !== null) {
+            $fileEntity->setMetadata($metadata);
+        }
+        if ($replicated !== null) {
+            $fileEntity->setReplicated($replicated);
+        }
+        if ($removed !== null) {
+            $fileEntity->setRemoved($removed);
+        }
+        if ($cleared !== null) {
+            $fileEntity->setCleared($cleared);
         }
     }
 
@@ -4514,6 +4514,71 @@ class FreezingController extends Controller
         }
     }
 
+    /**
+     * Retrieve the Nextcloud file cache checksums for all files within a specific pathname scope, beginning
+     * with either the prefix 'staging/' or 'frozen/', with a single database query. The scope may be either
+     * a single file or a folder. Returned pathnames are relative to the staging or frozen area root folder.
+     *
+     * Restricted to PSO user. Project name is derived from PSO username.
+     *
+     * @param string $pathname  pathname of the file or folder, beginning with either 'frozen/' or 'staging/'
+     *
+     * @return DataResponse
+     *
+     * @NoAdminRequired
+     * @NoCSRFRequired
+     */
+    public function retrieveCacheChecksums($pathname)
+    {
+        Util::writeLog('ida', 'retrieveCacheChecksums:'
+            . ' user=' . $this->userId
+            . ' pathname=' . $pathname,
+            \OCP\Util::DEBUG);
+
+        try {
+
+            // Ensure user is PSO user...
+
+            if (strpos($this->userId, Constants::PROJECT_USER_PREFIX) !== 0) {
+                return API::forbiddenErrorResponse();
+            }
+
+            // Extract project name from PSO user name...
+
+            $project = substr($this->userId, strlen(Constants::PROJECT_USER_PREFIX));
+
+            // If pathname starts with 'frozen/' then use action 'unfreeze' to get full pathname,
+            // else pathname starts with 'staging/' so use action 'freeze' to get full pathname;
+            // and remove the prefix from the pathname.
+
+            if (str_starts_with($pathname, 'frozen/')) {
+                $action = 'unfreeze';
+                $relativePathname = substr($pathname, strlen('frozen'));
+            }
+            else {
+                $action = 'freeze';
+                $relativePathname = substr($pathname, strlen('staging'));
+            }
+
+            $fullPathname = $this->buildFullPathname($action, $project, $relativePathname);
+
+            Util::writeLog('ida', 'retrieveCacheChecksums: fullPathname=' . $fullPathname, \OCP\Util::DEBUG);
+
+            $checksums = $this->fileDetailsHelper->getCacheChecksums($project, $fullPathname);
+
+            Util::writeLog('ida', 'retrieveCacheChecksums: count=' . count($checksums), \OCP\Util::DEBUG);
+
+            return new DataResponse(array(
+                'project' => $project,
+                'pathname' => $pathname,
+                'checksums' => (object) $checksums
+            ));
+
+        } catch (Exception $e) {
+            return API::serverErrorResponse('retrieveCacheChecksums: ' . $e->getMessage());
+        }
+    }
+
     /**
      * Test whether RabbitMQ connection can be opened for publication.
      *
@@ -119,6 +119,55 @@ class FileMapper extends Mapper
         return $this->findEntities($sql);
     }
 
+    /**
+     * Retrieve one page of file records associated with the specified action, based on the provided action PID,
+     * optionally restricted to one or more projects. Records are ordered by id, and the page begins after the
+     * record with the optionally specified id, so that consecutive pages can be retrieved efficiently using
+     * the id of the last record of the previous page.
+     *
+     * @param string $pid      the PID of an action
+     * @param string $projects one or more comma separated project names, with no whitespace
+     * @param int    $limit    the maximum number of records in the page
+     * @param int    $after    the id of the record after which the page begins
+     *
+     * @return File[]
+     */
+    public function findFilesPage($pid, $projects, $limit, $after = null) {
+
+        $conditions = array();
+
+        if ($pid != null) {
+            $conditions[] = 'action = \'' . Access::escapeQueryStringComponent($pid) . '\'';
+        }
+
+        if ($projects != null) {
+            $projects = Access::cleanProjectList($projects);
+            $projectList = array();
+            foreach (explode(',', $projects) as $project) {
+                $projectList[] = '\'' . Access::escapeQueryStringComponent($project) . '\'';
+            }
+            if (!empty($projectList)) {
+                $conditions[] = 'project IN (' . implode(', ', $projectList) . ')';
+            }
+        }
+
+        if ($after !== null && is_integer($after)) {
+            $conditions[] = 'id > ' . $after;
+        }
+
+        $sql = 'SELECT * FROM *PREFIX*ida_frozen_file';
+
+        if (!empty($conditions)) {
+            $sql = $sql . ' WHERE ' . implode(' AND ', $conditions);
+        }
+
+        $sql = $sql . ' ORDER BY id ASC LIMIT ' . (int) $limit;
+
+        Util::writeLog('ida', 'findFilesPage: sql=' . $sql, \OCP\Util::DEBUG);
+
+        return $this->findEntities($sql);
+    }
+
     /**
      * Retrieve the PIDs of all frozen file records associated with the specified project.
      *
@@ -273,6 +322,46 @@ class FileMapper extends Mapper
         }
     }
 
+    /**
+     * Return the most recently created frozen file records with the specified PIDs, as an array keyed by PID.
+     * PIDs for which no frozen file record exists are not included in the returned array.
+     *
+     * @param string[] $pids            the PIDs of the frozen files
+     * @param boolean  $includeInactive include removed and cleared file records
+     *
+     * @return File[]
+     */
+    public function findFilesByPids($pids, $includeInactive = false) {
+
+        $fileEntities = array();
+
+        if (empty($pids)) {
+            return $fileEntities;
+        }
+
+        $pidsSql = implode(',', array_map(function ($pid) {
+            return "'" . Access::escapeQueryStringComponent($pid) . "'";
+        }, $pids));
+
+        $sql = 'SELECT * FROM *PREFIX*ida_frozen_file WHERE pid IN (' . $pidsSql . ')';
+
+        if ($includeInactive === false) {
+            $sql = $sql . ' AND removed IS NULL AND cleared IS NULL';
+        }
+
+        // Ordered by id so that the most recently created record of each PID is retained
+
+        $sql = $sql . ' ORDER BY id ASC';
+
+        Util::writeLog('ida', 'findFilesByPids: pids=' . count($pids), \OCP\Util::DEBUG);
+
+        foreach ($this->findEntities($sql) as $fileEntity) {
+            $fileEntities[$fileEntity->getPid()] = $fileEntity;
+        }
+
+        return $fileEntities;
+    }
+
     /**
      * Return the most recently created active frozen file record with the specified Nextcloud node ID, or null if no
      * file record has the specified node ID, optionally limited to one or more projects.
@@ -296,4 +296,86 @@ class FileDetailsHelper
         return $finalResults;
     }
 
+    /**
+     * Fetch the Nextcloud cache checksums of all files within the specified scope in a single query,
+     * returning a dict with the pathname relative to the frozen or staging area root folder as key and
+     * the lowercased cache checksum as value. Files with no cache checksum are included with an empty string
+     * as checksum. The scope may be either a single file or a folder.
+     * 
+     * @param string $project      the project to which the files should belong
+     * @param string $fullPathname the full pathname of a node starting from the frozen or staging area root folder
+     * 
+     * @return array [ pathname => checksum, ... ]
+     */
+    public function getCacheChecksums(string $project, string $fullPathname): array {
+
+        Util::writeLog('ida', 'getCacheChecksums:' . 'project=' . $project . ' fullPathname=' . $fullPathname, \OCP\Util::DEBUG);
+
+        $psoUserId = 'home::' . Constants::PROJECT_USER_PREFIX . $project;
+
+        // Get user's storage numeric ID
+
+        try {
+            $qb = $this->db->getQueryBuilder();
+
+            $qb->select('numeric_id')
+               ->from('storages')
+               ->where($qb->expr()->eq('id', $qb->createNamedParameter($psoUserId, IQueryBuilder::PARAM_STR)));
+
+            // $storageId = $qb->executeQuery()->fetchOne(); // NC30
+            $storageId = $qb->execute()->fetchOne();         // NC21
+
+        } catch (Exception $e) {
+            Util::writeLog('ida', 'getCacheChecksums: Error retrieving storage id for user ' . $psoUserId . ': ' . $e, \OCP\Util::WARN);
+            $storageId = null;
+        }
+
+        Util::writeLog('ida', 'getCacheChecksums: storageId=' . $storageId, \OCP\Util::DEBUG);
+
+        // If project user doesn't exist, return empty results rather than throw exception
+
+        if (is_null($storageId) || !isset($storageId) || !is_int($storageId)) {
+            return [];
+        }
+
+        // The area root folder is the first path component of the full pathname, i.e. either the frozen
+        // or staging folder of the project
+
+        $areaRoot = '/' . explode('/', ltrim($fullPathname, '/'))[0];
+        $prefixLength = strlen('files' . $areaRoot);
+
+        // Query filecache for the file matching the pathname exactly, or all files within the folder matching
+        // the pathname, excluding folders
+
+        $qb = $this->db->getQueryBuilder();
+
+        $qb->select('path', 'checksum')
+            ->from('filecache')
+            ->where($qb->expr()->eq('storage', $qb->createNamedParameter($storageId, IQueryBuilder::PARAM_INT)))
+            ->andWhere($qb->expr()->neq('mimetype', $qb->createNamedParameter(2, IQueryBuilder::PARAM_INT))) // 2 = folder, i.e. not a folder, i.e. a file
+            ->andWhere($qb->expr()->orX(
+                $qb->expr()->eq('path', $qb->createNamedParameter('files' . $fullPathname, IQueryBuilder::PARAM_STR)),
+                $qb->expr()->like('path', $qb->createNamedParameter('files' . $fullPathname . '/%', IQueryBuilder::PARAM_STR))
+            ));
+
+        //Util::writeLog('ida', 'getCacheChecksums: sql=' . Access::getRawSQL($qb), \OCP\Util::DEBUG);
+
+        // Fetch rows one at a time rather than all at once, so that only the final results are held in memory
+
+        $result = $qb->execute();
+
+        $checksums = [];
+
+        while ($row = $result->fetch()) {
+            $pathname = substr($row['path'], $prefixLength);
+            $checksums[$pathname] = strtolower($row['checksum'] ?? '');
+        }
+
+        $result->closeCursor();
+
+        Util::writeLog('ida', 'getCacheChecksums: count=' . count($checksums), \OCP\Util::DEBUG);
+
+        return $checksums;
+    }
+
 }
\ No newline at end of file
@@ -90,6 +90,29 @@ STORAGE_OC_DATA_ROOT="/mnt/storage_vol01/ida"
 
 DATA_REPLICATION_ROOT="/mnt/storage_vol02/ida_replication"
 
+# local persistent cache of file checksums, keyed by device, inode, size and modification time, used by
+# the postprocessing agents and audits to avoid rehashing unchanged files (optional, disabled if not defined).
+# the cache must be on a host-local filesystem, never on the shared storage volumes: it is an sqlite database
+# in WAL mode, which is not safe on network or cluster filesystems, and device and inode numbers are only
+# meaningful on the host which recorded them. the entries of each storage volume of the host are kept apart
+# by their device number
+CHECKSUM_CACHE="/var/lib/ida/checksum_cache.db"
+
+# number of projects audited in parallel by audit-all-projects and audit-active-projects, and the max number
+# of those projects concurrently querying the database or scanning the filesystem (optional)
+AUDIT_PARALLEL_PROJECTS=4
+AUDIT_MAX_DB_STAGES=2
+AUDIT_MAX_IO_STAGES=2
+
+# number of threads generating checksums concurrently during checksum audits of a project (optional)
+AUDIT_CHECKSUM_WORKERS=4
+
+# number of threads scanning the folders of a project concurrently during unrestricted audits (optional)
+AUDIT_SCAN_WORKERS=8
+
+# number of rows fetched per round trip when streaming large query results in admin utilities (optional)
+DB_QUERY_ITERSIZE=10000
+
 PYTHON="/opt/fairdata/python3/bin/python" 
 
 TRASH_DATA_ROOT="/mnt/storage_vol02/ida_trash"
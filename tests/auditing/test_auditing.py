@@ -2756,6 +2756,17 @@ class TestAuditing(unittest.TestCase):
         self.assertEqual(response_data['checksum'], invalid_checksum_uri)
         self.assertIsNotNone(response_data['nodeId'])
 
+        print("(retrieving cache checksums of all files in staging in folder /testdata/2017-08/Experiment_2/baseline)")
+        response = requests.get("%s/retrieveCacheChecksums?pathname=staging/testdata/2017-08/Experiment_2/baseline" % self.config["IDA_API"], auth=pso_user_a, verify=False)
+        self.assertEqual(response.status_code, 200)
+        response_data = response.json()
+        self.assertEqual(response_data['project'], 'test_project_a')
+        checksums = response_data['checksums']
+        for pathname in [ "/testdata/2017-08/Experiment_2/baseline/test01.dat",
+                          "/testdata/2017-08/Experiment_2/baseline/test02.dat",
+                          "/testdata/2017-08/Experiment_2/baseline/test03.dat" ]:
+            self.assertEqual(checksums.get(pathname), invalid_checksum_uri)
+
         print("(freezing folder /testdata/2017-08/Experiment_2/baseline)")
         data = {"project": "test_project_a", "pathname": "/testdata/2017-08/Experiment_2/baseline"}
         response = requests.post("%s/freeze" % self.config["IDA_API"], headers=headers, json=data, auth=test_user_a, verify=False)
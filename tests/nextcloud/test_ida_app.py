@@ -373,6 +373,30 @@ class TestIdaApp(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         file_set_data = response.json()
         self.assertEqual(len(file_set_data), 5)
+        all_file_pids = sorted(file_data["pid"] for file_data in file_set_data)
+
+        print("Retrieve details of all unfrozen files associated with previous action in pages")
+        paged_file_pids = []
+        page_sizes = []
+        after = None
+        while True:
+            url = "%s/files/action/%s?limit=2" % (self.config["IDA_API"], action_data["pid"])
+            if after is not None:
+                url = "%s&after=%d" % (url, after)
+            response = requests.get(url, auth=test_user_a, verify=False)
+            self.assertEqual(response.status_code, 200)
+            file_set_data = response.json()
+            page_sizes.append(len(file_set_data))
+            paged_file_pids.extend(file_data["pid"] for file_data in file_set_data)
+            if len(file_set_data) < 2:
+                break
+            after = file_set_data[-1]["id"]
+        self.assertEqual(page_sizes, [2, 2, 1])
+        self.assertEqual(sorted(paged_file_pids), all_file_pids)
+
+        print("Attempt to retrieve details of files associated with previous action with an invalid page limit")
+        response = requests.get("%s/files/action/%s?limit=0" % (self.config["IDA_API"], action_data["pid"]), auth=test_user_a, verify=False)
+        self.assertEqual(response.status_code, 400)
 
         print("Attempt to retrieve details of all unfrozen files associated with previous action as user without rights to project")
         response = requests.get("%s/files/action/%s" % (self.config["IDA_API"], action_data["pid"]), auth=test_user_c, verify=False)
@@ -989,6 +1013,31 @@ class TestIdaApp(unittest.TestCase):
         self.assertEqual(file_data["pid"], file_pid)
         self.assertEqual(file_data["metadata"], data["metadata"])
 
+        print("Update size and metadata timestamp of multiple files in batch")
+        data = {"files": [
+            {"pid": file_pid, "size": 4321, "metadata": "2099-01-02T00:00:00Z"},
+            {"pid": "no_such_file_pid", "size": 4321}
+        ]}
+        response = requests.post("%s/files/batch" % self.config["IDA_API"], json=data, auth=pso_user_a, verify=False)
+        self.assertEqual(response.status_code, 200)
+        response_data = response.json()
+        self.assertEqual(response_data["updated"], 1)
+        self.assertEqual(len(response_data["failed"]), 1)
+        self.assertEqual(response_data["failed"][0]["pid"], "no_such_file_pid")
+        response = requests.get("%s/files/%s" % (self.config["IDA_API"], file_pid), auth=test_user_a, verify=False)
+        self.assertEqual(response.status_code, 200)
+        file_data = response.json()
+        self.assertEqual(file_data["size"], 4321)
+        self.assertEqual(file_data["metadata"], "2099-01-02T00:00:00Z")
+
+        print("Attempt to update files in batch with invalid timestamp")
+        data = {"files": [{"pid": file_pid, "metadata": "2017-11-12"}]}
+        response = requests.post("%s/files/batch" % self.config["IDA_API"], json=data, auth=pso_user_a, verify=False)
+        self.assertEqual(response.status_code, 200)
+        response_data = response.json()
+        self.assertEqual(response_data["updated"], 0)
+        self.assertEqual(response_data["failed"][0]["error"], "Specified timestamp \"2017-11-12\" is invalid")
+
         print("Clear removed timestamp")
         data = {"removed": "null"}
         response = requests.post("%s/files/%s" % (self.config["IDA_API"], file_pid), json=data, auth=pso_user_a, verify=False)
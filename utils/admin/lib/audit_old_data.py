@@ -36,7 +36,7 @@ from requests.packages.urllib3.exceptions import InsecureRequestWarning
 from sortedcontainers import SortedDict
 from stat import *
 from utils import LOG_ENTRY_FORMAT, TIMESTAMP_FORMAT, NULL_VALUES, load_configuration, normalize_timestamp, \
-                  get_last_add_change_timestamps, log_and_output
+                  get_last_add_change_timestamps, log_and_output, stream_query
 
 # Use UTC
 os.environ['TZ'] = 'UTC'
@@ -282,12 +282,9 @@ def get_old_files(config):
     if config.DEBUG_VERBOSE:
         logging.debug("%s QUERY: %s" % (config.PROJECT, re.sub(r'\s+', ' ', query.strip())))
 
-    cur.execute(query)
-    rows = cur.fetchall()
-
-    log_and_output(config, logging.DEBUG, "%s Retrieved frozen file count: %d" % (config.PROJECT, len(rows)))
+    frozen_files = build_file_details(config, stream_query(config, conn, query))
 
-    frozen_files = build_file_details(config, rows)
+    log_and_output(config, logging.DEBUG, "%s Retrieved frozen file count: %d" % (config.PROJECT, len(frozen_files)))
 
     if config.DEBUG_VERBOSE:
         logging.debug("%s FROZEN FILES: %s" % (config.PROJECT, json.dumps(frozen_files)))
@@ -303,12 +300,9 @@ def get_old_files(config):
     if config.DEBUG_VERBOSE:
         logging.debug("%s QUERY: %s" % (config.PROJECT, re.sub(r'\s+', ' ', query.strip())))
 
-    cur.execute(query)
-    rows = cur.fetchall()
+    staging_files = build_file_details(config, stream_query(config, conn, query))
 
-    log_and_output(config, logging.DEBUG, "%s Retrieved staging file count: %d" % (config.PROJECT, len(rows)))
-
-    staging_files = build_file_details(config, rows)
+    log_and_output(config, logging.DEBUG, "%s Retrieved staging file count: %d" % (config.PROJECT, len(staging_files)))
 
     if config.DEBUG_VERBOSE:
         logging.debug("%s STAGING FILES: %s" % (config.PROJECT, json.dumps(staging_files)))
@@ -326,10 +320,7 @@ def build_file_details(config, rows):
 
     log_and_output(config, logging.DEBUG, "%s Building file details..." % config.PROJECT)
 
-    row_count = len(rows)
-
-    if config.DEBUG_VERBOSE:
-        logging.debug("%s ROW COUNT: %d" % (config.PROJECT, len(rows)))
+    row_count = 0
 
     files = SortedDict({})
 
@@ -339,17 +330,15 @@ def build_file_details(config, rows):
     project_name_frozen_offset = project_name_len + 1
     project_name_staging_offset = project_name_len + 2
 
-    if row_count >= config.LOOP_MIN:
-        loop_count = 0
-        if not config.QUIET:
-            sys.stderr.write(".")
+    # Rows are streamed from the database, so the total count is not known in advance; progress
+    # is reported once for every LOOP_MIN rows processed
 
     for row in rows:
 
-        if row_count >= config.LOOP_MIN:
-            loop_count = loop_count + 1
-            if not config.QUIET and loop_count % config.LOOP_MIN == 0:
-                sys.stderr.write(".")
+        row_count = row_count + 1
+
+        if not config.QUIET and row_count % config.LOOP_MIN == 0:
+            sys.stderr.write(".")
 
         if config.DEBUG_VERBOSE:
             logging.debug("%s ROW: %s" % (config.PROJECT, json.dumps(row)))
@@ -399,6 +388,9 @@ def build_file_details(config, rows):
     if not config.QUIET and row_count >= config.LOOP_MIN:
         sys.stderr.write("\n")
 
+    if config.DEBUG_VERBOSE:
+        logging.debug("%s ROW COUNT: %d" % (config.PROJECT, row_count))
+
     return files
 
 
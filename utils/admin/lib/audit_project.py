@@ -31,14 +31,16 @@ import psycopg2
 import time
 import re
 import dateutil.parser
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, ALL_COMPLETED, wait
+from contextlib import nullcontext
 from datetime import datetime, timezone
 from pathlib import Path
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 from sortedcontainers import SortedList, SortedDict
-from subprocess import Popen, PIPE
 from stat import *
 from utils import LOG_ENTRY_FORMAT, TIMESTAMP_FORMAT, NULL_VALUES, load_configuration, normalize_timestamp, \
-                  generate_timestamp, generate_checksum, get_last_add_change_timestamp
+                  generate_timestamp, generate_checksum, open_checksum_cache, get_last_add_change_timestamps, \
+                  scan_directory_tree, stream_query
 
 # Use UTC
 os.environ['TZ'] = 'UTC'
@@ -46,6 +48,13 @@ time.tzset()
 
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
+# Semaphores limiting the number of projects concurrently in their database ('db') or filesystem ('io')
+# stage, shared by all worker processes when auditing multiple projects in parallel (audit_projects.py)
+STAGE_LIMITS = {}
+
+# Max number of pathnames looked up from the database with a single query
+QUERY_BATCH_SIZE = 10000
+
 # NOTES:
 #
 # Node contexts:
@@ -74,119 +83,10 @@ def main():
 
         #config.DEBUG = True # TEMP HACK
 
-        # If in production, ensure we are not running on the management server
-        hostname = socket.getfqdn()
-        if config.IDA_ENVIRONMENT == 'PRODUCTION' and hostname == 'idaman.fairdata.fi':
-            raise Exception ("Do not run project auditing on %s" % hostname)
-
-        # Copy essential constants to config so they are easily passed to functions
-        config.STAGING_FOLDER_SUFFIX = constants.STAGING_FOLDER_SUFFIX
-        config.PROJECT_USER_PREFIX = constants.PROJECT_USER_PREFIX
-        config.IDA_MIGRATION = constants.IDA_MIGRATION
-        config.IDA_MIGRATION_TS = constants.IDA_MIGRATION_TS
-
         config.SCRIPT = os.path.basename(sys.argv[0])
         config.PID = os.getpid()
-        config.PROJECT = sys.argv[2]
-        config.PROJECT_ROOT = "%s/%s%s" % (config.STORAGE_OC_DATA_ROOT, config.PROJECT_USER_PREFIX, config.PROJECT)
-        config.PROJECT_CREATED = max([normalize_timestamp(os.path.getmtime(config.PROJECT_ROOT)), config.IDA_MIGRATION])
-
-        config.START = sys.argv[3]
-        config.AFTER = sys.argv[4]
-        config.BEFORE = sys.argv[5]
-
-        config.CHANGED_ONLY = ((config.AFTER > config.IDA_MIGRATION) or (config.BEFORE < config.START))
-
-        config.FULL_AUDIT = False
-        config.AUDIT_STAGING = True
-        config.AUDIT_FROZEN = True
-        config.AUDIT_TIMESTAMPS = False
-        config.AUDIT_CHECKSUMS = False
-
-        if argc > 6:
-            for i in range(6,argc):
-                arg = sys.argv[i]
-                if arg == '--full':
-                    if config.AUDIT_STAGING == False:
-                        raise Exception("Only one of --full or --frozen is allowed")
-                    if config.AUDIT_FROZEN == False:
-                        raise Exception("Only one of --full or --staging is allowed")
-                    config.FULL_AUDIT = True
-                    config.CHANGED_ONLY = False
-                    config.AUDIT_FROZEN = True
-                    config.AUDIT_STAGING = True
-                    config.AUDIT_TIMESTAMPS = True
-                    config.AUDIT_CHECKSUMS = True
-                elif arg == '--staging':
-                    if config.FULL_AUDIT:
-                        raise Exception("Only one of --full or --staging is allowed")
-                    if config.AUDIT_STAGING == False:
-                        raise Exception("Only one of --staging or --frozen is allowed")
-                    config.AUDIT_FROZEN = False
-                elif arg == '--frozen':
-                    if config.FULL_AUDIT:
-                        raise Exception("Only one of --full or --frozen is allowed")
-                    if config.AUDIT_FROZEN == False:
-                        raise Exception("Only one of --staging or --frozen is allowed")
-                    config.AUDIT_STAGING = False
-                elif arg == '--timestamps':
-                    config.AUDIT_TIMESTAMPS = True
-                elif arg == '--checksums':
-                    config.AUDIT_CHECKSUMS = True
-                else:
-                    raise Exception("Unrecognized argument: " % arg)
-
-        if config.DEBUG:
-            config.LOG_LEVEL = logging.DEBUG
-        else:
-            config.LOG_LEVEL = logging.INFO
-
-        # Convert START ISO timestamp strings to epoch seconds
 
-        start_datetime = dateutil.parser.isoparse(config.START)
-        config.START_TS = start_datetime.replace(tzinfo=timezone.utc).timestamp()
-
-        after_datetime = dateutil.parser.isoparse(config.AFTER)
-        config.AFTER_TS = after_datetime.replace(tzinfo=timezone.utc).timestamp()
-
-        before_datetime = dateutil.parser.isoparse(config.BEFORE)
-        config.BEFORE_TS = before_datetime.replace(tzinfo=timezone.utc).timestamp()
-
-        if config.DEBUG:
-            sys.stderr.write("--- %s ---\n" % config.SCRIPT)
-            sys.stderr.write("HOSTNAME:           %s\n" % socket.gethostname())
-            sys.stderr.write("ROOT:               %s\n" % config.ROOT)
-            sys.stderr.write("PROJECT:            %s\n" % config.PROJECT)
-            sys.stderr.write("DATA_ROOT:          %s\n" % config.STORAGE_OC_DATA_ROOT)
-            sys.stderr.write("LOG:                %s\n" % config.LOG)
-            sys.stderr.write("LOG_LEVEL:          %s\n" % config.LOG_LEVEL)
-            sys.stderr.write("DBHOST:             %s\n" % config.DBHOST)
-            sys.stderr.write("DBROUSER:           %s\n" % config.DBROUSER)
-            sys.stderr.write("DBNAME:             %s\n" % config.DBNAME)
-            sys.stderr.write("METAX_API:          %s\n" % config.METAX_API)
-            sys.stderr.write("METAX_API_VERSION:  %s\n" % str(config.METAX_API_VERSION))
-            sys.stderr.write("ARGS#:              %d\n" % argc)
-            sys.stderr.write("ARGS:               %s\n" % str(sys.argv))
-            sys.stderr.write("PID:                %s\n" % config.PID)
-            sys.stderr.write("CHANGED_ONLY        %s\n" % config.CHANGED_ONLY)
-            sys.stderr.write("AUDIT_STAGING:      %s\n" % config.AUDIT_STAGING)
-            sys.stderr.write("AUDIT_FROZEN:       %s\n" % config.AUDIT_FROZEN)
-            sys.stderr.write("AUDIT_TIMESTAMPS:   %s\n" % config.AUDIT_TIMESTAMPS)
-            sys.stderr.write("AUDIT_CHECKSUMS:    %s\n" % config.AUDIT_CHECKSUMS)
-            sys.stderr.write("IDA_MIGRATION:      %s\n" % config.IDA_MIGRATION)
-            sys.stderr.write("IDA_MIGRATION_TS:   %s\n" % config.IDA_MIGRATION_TS)
-            sys.stderr.write("AFTER:              %s\n" % config.AFTER)
-            sys.stderr.write("AFTER_TS:           %d\n" % config.AFTER_TS)
-            sys.stderr.write("AFTER_TS_CHK:       %s\n" % normalize_timestamp(datetime.utcfromtimestamp(config.AFTER_TS)))
-            sys.stderr.write("BEFORE:             %s\n" % config.BEFORE)
-            sys.stderr.write("BEFORE_TS:          %d\n" % config.BEFORE_TS)
-            sys.stderr.write("BEFORE_TS_CHK:      %s\n" % normalize_timestamp(datetime.utcfromtimestamp(config.BEFORE_TS)))
-            sys.stderr.write("START:              %s\n" % config.START)
-            sys.stderr.write("START_TS:           %d\n" % config.START_TS)
-            sys.stderr.write("START_TS_CHK:       %s\n" % normalize_timestamp(datetime.utcfromtimestamp(config.START_TS)))
-
-        if (config.AFTER_TS >= config.BEFORE_TS):
-            raise Exception("AFTER timestamp must be earlier than AUDIT_BEFORE adjusted timestamp")
+        configure_audit(config, constants, sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5], sys.argv[6:])
 
         # Initialize logging using UTC timestamps
 
@@ -217,6 +117,140 @@ def main():
         sys.exit(1)
 
 
+def configure_audit(config, constants, project, start, after, before, args):
+    """
+    Add to the loaded service configuration the values needed for auditing the specified project, according
+    to the specified start, after and before timestamps and audit options, raising an exception if any are invalid.
+    Used both when auditing a single project and when auditing multiple projects in parallel (audit_projects.py).
+    """
+
+    # If in production, ensure we are not running on the management server
+    hostname = socket.getfqdn()
+    if config.IDA_ENVIRONMENT == 'PRODUCTION' and hostname == 'idaman.fairdata.fi':
+        raise Exception ("Do not run project auditing on %s" % hostname)
+
+    # Copy essential constants to config so they are easily passed to functions
+    config.STAGING_FOLDER_SUFFIX = constants.STAGING_FOLDER_SUFFIX
+    config.PROJECT_USER_PREFIX = constants.PROJECT_USER_PREFIX
+    config.IDA_MIGRATION = constants.IDA_MIGRATION
+    config.IDA_MIGRATION_TS = constants.IDA_MIGRATION_TS
+
+    config.PROJECT = project
+    config.PROJECT_ROOT = "%s/%s%s" % (config.STORAGE_OC_DATA_ROOT, config.PROJECT_USER_PREFIX, config.PROJECT)
+    config.PROJECT_CREATED = max([normalize_timestamp(os.path.getmtime(config.PROJECT_ROOT)), config.IDA_MIGRATION])
+
+    config.START = start
+    config.AFTER = after
+    config.BEFORE = before
+
+    config.CHANGED_ONLY = ((config.AFTER > config.IDA_MIGRATION) or (config.BEFORE < config.START))
+
+    config.FULL_AUDIT = False
+    config.AUDIT_STAGING = True
+    config.AUDIT_FROZEN = True
+    config.AUDIT_TIMESTAMPS = False
+    config.AUDIT_CHECKSUMS = False
+    config.STRICT_CHECKSUMS = False
+
+    for arg in args:
+        if arg == '--full':
+            if config.AUDIT_STAGING == False:
+                raise Exception("Only one of --full or --frozen is allowed")
+            if config.AUDIT_FROZEN == False:
+                raise Exception("Only one of --full or --staging is allowed")
+            config.FULL_AUDIT = True
+            config.CHANGED_ONLY = False
+            config.AUDIT_FROZEN = True
+            config.AUDIT_STAGING = True
+            config.AUDIT_TIMESTAMPS = True
+            config.AUDIT_CHECKSUMS = True
+        elif arg == '--staging':
+            if config.FULL_AUDIT:
+                raise Exception("Only one of --full or --staging is allowed")
+            if config.AUDIT_STAGING == False:
+                raise Exception("Only one of --staging or --frozen is allowed")
+            config.AUDIT_FROZEN = False
+        elif arg == '--frozen':
+            if config.FULL_AUDIT:
+                raise Exception("Only one of --full or --frozen is allowed")
+            if config.AUDIT_FROZEN == False:
+                raise Exception("Only one of --staging or --frozen is allowed")
+            config.AUDIT_STAGING = False
+        elif arg == '--timestamps':
+            config.AUDIT_TIMESTAMPS = True
+        elif arg == '--checksums':
+            config.AUDIT_CHECKSUMS = True
+        elif arg == '--strict-checksums':
+            config.AUDIT_CHECKSUMS = True
+            config.STRICT_CHECKSUMS = True
+        else:
+            raise Exception("Unrecognized argument: %s" % arg)
+
+    if config.DEBUG:
+        config.LOG_LEVEL = logging.DEBUG
+    else:
+        config.LOG_LEVEL = logging.INFO
+
+    # Convert START ISO timestamp strings to epoch seconds
+
+    start_datetime = dateutil.parser.isoparse(config.START)
+    config.START_TS = start_datetime.replace(tzinfo=timezone.utc).timestamp()
+
+    after_datetime = dateutil.parser.isoparse(config.AFTER)
+    config.AFTER_TS = after_datetime.replace(tzinfo=timezone.utc).timestamp()
+
+    before_datetime = dateutil.parser.isoparse(config.BEFORE)
+    config.BEFORE_TS = before_datetime.replace(tzinfo=timezone.utc).timestamp()
+
+    if config.DEBUG:
+        sys.stderr.write("--- %s ---\n" % config.SCRIPT)
+        sys.stderr.write("HOSTNAME:           %s\n" % socket.gethostname())
+        sys.stderr.write("ROOT:               %s\n" % config.ROOT)
+        sys.stderr.write("PROJECT:            %s\n" % config.PROJECT)
+        sys.stderr.write("DATA_ROOT:          %s\n" % config.STORAGE_OC_DATA_ROOT)
+        sys.stderr.write("LOG:                %s\n" % config.LOG)
+        sys.stderr.write("LOG_LEVEL:          %s\n" % config.LOG_LEVEL)
+        sys.stderr.write("DBHOST:             %s\n" % config.DBHOST)
+        sys.stderr.write("DBROUSER:           %s\n" % config.DBROUSER)
+        sys.stderr.write("DBNAME:             %s\n" % config.DBNAME)
+        sys.stderr.write("METAX_API:          %s\n" % config.METAX_API)
+        sys.stderr.write("METAX_API_VERSION:  %s\n" % str(config.METAX_API_VERSION))
+        sys.stderr.write("ARGS:               %s\n" % str(args))
+        sys.stderr.write("PID:                %s\n" % config.PID)
+        sys.stderr.write("CHANGED_ONLY        %s\n" % config.CHANGED_ONLY)
+        sys.stderr.write("AUDIT_STAGING:      %s\n" % config.AUDIT_STAGING)
+        sys.stderr.write("AUDIT_FROZEN:       %s\n" % config.AUDIT_FROZEN)
+        sys.stderr.write("AUDIT_TIMESTAMPS:   %s\n" % config.AUDIT_TIMESTAMPS)
+        sys.stderr.write("AUDIT_CHECKSUMS:    %s\n" % config.AUDIT_CHECKSUMS)
+        sys.stderr.write("STRICT_CHECKSUMS:   %s\n" % config.STRICT_CHECKSUMS)
+        sys.stderr.write("IDA_MIGRATION:      %s\n" % config.IDA_MIGRATION)
+        sys.stderr.write("IDA_MIGRATION_TS:   %s\n" % config.IDA_MIGRATION_TS)
+        sys.stderr.write("AFTER:              %s\n" % config.AFTER)
+        sys.stderr.write("AFTER_TS:           %d\n" % config.AFTER_TS)
+        sys.stderr.write("AFTER_TS_CHK:       %s\n" % normalize_timestamp(datetime.utcfromtimestamp(config.AFTER_TS)))
+        sys.stderr.write("BEFORE:             %s\n" % config.BEFORE)
+        sys.stderr.write("BEFORE_TS:          %d\n" % config.BEFORE_TS)
+        sys.stderr.write("BEFORE_TS_CHK:      %s\n" % normalize_timestamp(datetime.utcfromtimestamp(config.BEFORE_TS)))
+        sys.stderr.write("START:              %s\n" % config.START)
+        sys.stderr.write("START_TS:           %d\n" % config.START_TS)
+        sys.stderr.write("START_TS_CHK:       %s\n" % normalize_timestamp(datetime.utcfromtimestamp(config.START_TS)))
+
+    if (config.AFTER_TS >= config.BEFORE_TS):
+        raise Exception("AFTER timestamp must be earlier than AUDIT_BEFORE adjusted timestamp")
+
+    # Checksums of files not modified since they were last hashed are taken from the checksum cache, if
+    # configured; strict checksum audits read all files, e.g. to detect silent corruption of file contents
+
+    config.CHECKSUM_CACHE_INSTANCE = open_checksum_cache(config) if config.AUDIT_CHECKSUMS else None
+
+
+def stage_limit(stage):
+    """
+    Return a context manager holding one of the concurrent slots of the specified stage, if limited
+    """
+    return STAGE_LIMITS.get(stage) or nullcontext()
+
+
 def add_frozen_files(nodes, counts, config):
     """
     Query the IDA database and add all relevant frozen file stats to the auditing data objects
@@ -240,8 +274,6 @@ def add_frozen_files(nodes, counts, config):
                             host=config.DBHOST,
                             port=config.DBPORT)
 
-    cur = conn.cursor()
-
     # Select all records for actively frozen files which frozen before the START
     # timestamp and after the AFTER timestamp (we also grab and record the metadata
     # and replicated timestamps, to decide whether we should include those files in
@@ -258,12 +290,9 @@ def add_frozen_files(nodes, counts, config):
     if config.DEBUG:
         sys.stderr.write("QUERY: %s\n" % re.sub(r'\s+', ' ', query.strip()))
 
-    cur.execute(query)
-    rows = cur.fetchall()
-
     # Construct IDA frozen file object for all selected nodes
 
-    for row in rows:
+    for row in stream_query(config, conn, query):
 
         #if config.DEBUG:
         #    sys.stderr.write("ida_frozen: %s\n" % (str(row)))
@@ -305,7 +334,6 @@ def add_frozen_files(nodes, counts, config):
             sys.stderr.write("%s: ida: %d %s\n" % (config.PROJECT, counts['frozenFileCount'], pathname))
 
     # Close database connection
-    cur.close()
     conn.close()
 
 
@@ -514,6 +542,10 @@ def add_nextcloud_nodes(nodes, counts, config):
     if config.DEBUG:
         sys.stderr.write("STORAGE_ID:    %d\n" % (storage_id))
 
+    # The latest 'add' change timestamps of the project, retrieved on first use, see get_add_change_timestamp()
+
+    add_events = []
+
     # If CHANGED_ONLY is true, first populate any Nextcloud node details based on already populated node pathnames
     # from IDA and Metax contexts, if they exist, as frozen file nodes will not have any timestamp updates in the
     # Nextcloud cache by which they can be detected and added if the freeze/unfreeze action was after AFTER and
@@ -522,99 +554,96 @@ def add_nextcloud_nodes(nodes, counts, config):
 
     if config.CHANGED_ONLY:
 
-        for pathname, node in list(nodes.items()):
+        # Map the cache paths of all nodes whose Nextcloud details have not already been recorded to their
+        # pathnames, and retrieve the cache records of those paths in batches
+
+        cache_paths = {}
+
+        for pathname, node in nodes.items():
 
             if config.DEBUG:
                 sys.stderr.write("%s: existing: node pathname: %s\n" % (config.PROJECT, pathname))
 
-            # If the node Nextcloud details have not already been recorded...
             if 'nextcloud' not in node:
-
                 if pathname.startswith('frozen/'):
-                    path = "files/%s/%s" % (config.PROJECT, pathname[7:])
+                    cache_paths["files/%s/%s" % (config.PROJECT, pathname[7:])] = pathname
                 else:
-                    path = "files/%s+/%s" % (config.PROJECT, pathname[8:])
-
-                query = "SELECT cache.path, cache.mimetype, cache.size, cache.mtime, cache.checksum, extended.upload_time \
-                         FROM %sfilecache as cache LEFT JOIN %sfilecache_extended as extended \
-                         ON cache.fileid = extended.fileid \
-                         WHERE cache.storage = %d \
-                         AND cache.path = '%s'" % (
-                             config.DBTABLEPREFIX,
-                             config.DBTABLEPREFIX,
-                             storage_id,
-                             path
-                        )
+                    cache_paths["files/%s+/%s" % (config.PROJECT, pathname[8:])] = pathname
+
+        query = "SELECT cache.path, cache.mimetype, cache.size, cache.mtime, cache.checksum, extended.upload_time \
+                 FROM %sfilecache as cache LEFT JOIN %sfilecache_extended as extended \
+                 ON cache.fileid = extended.fileid \
+                 WHERE cache.storage = %%s \
+                 AND cache.path = ANY(%%s)" % (
+                     config.DBTABLEPREFIX,
+                     config.DBTABLEPREFIX
+                )
 
-                if config.DEBUG:
-                    sys.stderr.write("QUERY: %s\n" % re.sub(r'\s+', ' ', query.strip()))
+        if config.DEBUG:
+            sys.stderr.write("QUERY: %s (%d paths)\n" % (re.sub(r'\s+', ' ', query.strip()), len(cache_paths)))
 
-                cur.execute(query)
-                row = cur.fetchone()
+        for row in fetch_in_batches(cur, query, storage_id, list(cache_paths.keys())):
 
-                if row:
+            if config.DEBUG:
+                sys.stderr.write("filecache: %s\n" % (str(row)))
 
-                    if config.DEBUG:
-                        sys.stderr.write("filecache: %s\n" % (str(row)))
+            pathname = cache_paths[row[0]]
+            node = nodes[pathname]
 
-                    node_type = 'file'
+            node_type = 'file'
 
-                    if row[1] == 2:
-                        node_type = 'folder'
+            if row[1] == 2:
+                node_type = 'folder'
 
-                    size = row[2]
+            size = row[2]
 
-                    modified = normalize_timestamp(datetime.utcfromtimestamp(row[3]))
+            modified = normalize_timestamp(datetime.utcfromtimestamp(row[3]))
 
-                    if node_type == 'file':
+            if node_type == 'file':
 
-                        file_count = file_count + 1
+                file_count = file_count + 1
 
-                        if row[4] in NULL_VALUES:
-                            checksum = None
-                        else:
-                            checksum = row[4].lower()
-                            if checksum.startswith('sha256:'):
-                                checksum = checksum[7:]
+                if row[4] in NULL_VALUES:
+                    checksum = None
+                else:
+                    checksum = row[4].lower()
+                    if checksum.startswith('sha256:'):
+                        checksum = checksum[7:]
 
-                        # Get uploaded timestamp, if any, from row details
+                # Get uploaded timestamp, if any, from row details
 
-                        if row[5] in NULL_VALUES:
-                            uploaded = None
-                        else:
-                            uploaded = normalize_timestamp(datetime.utcfromtimestamp(row[5]))
+                if row[5] in NULL_VALUES:
+                    uploaded = None
+                else:
+                    uploaded = normalize_timestamp(datetime.utcfromtimestamp(row[5]))
 
-                        # If there is no upload timestamp, retrieve the latest 'add' timestamp from the changes table
-                        # for the project and pathname in staging, if any, as the upload timestamp
+                # If there is no upload timestamp, use the latest 'add' timestamp from the changes table
+                # for the project and pathname in staging, if any, as the upload timestamp
 
-                        if not uploaded:
-                            if pathname.startswith('frozen/'):
-                                relative_pathname = pathname[6:]
-                            else:
-                                relative_pathname = pathname[7:]
-                            uploaded = get_last_add_change_timestamp(config, relative_pathname)
+                if not uploaded:
+                    uploaded = get_add_change_timestamp(config, add_events, pathname)
 
-                        node_details = {
-                            'type': node_type,
-                            'size': size,
-                            'modified': modified,
-                            'checksum': checksum,
-                            'uploaded': uploaded
-                        }
+                node_details = {
+                    'type': node_type,
+                    'size': size,
+                    'modified': modified,
+                    'checksum': checksum,
+                    'uploaded': uploaded
+                }
 
-                    else: # node_type == 'folder'
+            else: # node_type == 'folder'
 
-                        node_details = {
-                            'type': node_type,
-                            'modified': modified
-                        }
+                node_details = {
+                    'type': node_type,
+                    'modified': modified
+                }
 
-                    node['nextcloud'] = node_details
+            node['nextcloud'] = node_details
 
-                    counts['nextcloudNodeCount'] = counts['nextcloudNodeCount'] + 1
+            counts['nextcloudNodeCount'] = counts['nextcloudNodeCount'] + 1
 
-                    if config.DEBUG:
-                        sys.stderr.write("%s: nextcloud: %d %s\n" % (config.PROJECT, file_count, pathname))
+            if config.DEBUG:
+                sys.stderr.write("%s: nextcloud: %d %s\n" % (config.PROJECT, file_count, pathname))
 
     # Add all relevant Nexcloud node records
 
@@ -643,12 +672,9 @@ def add_nextcloud_nodes(nodes, counts, config):
     if config.DEBUG:
         sys.stderr.write("QUERY: %s\n" % re.sub(r'\s+', ' ', query.strip()))
 
-    cur.execute(query)
-    rows = cur.fetchall()
-
     # Construct auditing data object for all selected nodes
 
-    for row in rows:
+    for row in stream_query(config, conn, query):
 
         if config.DEBUG:
             sys.stderr.write("filecache: %s\n" % (str(row)))
@@ -687,15 +713,11 @@ def add_nextcloud_nodes(nodes, counts, config):
                 else:
                     uploaded = normalize_timestamp(datetime.utcfromtimestamp(row[5]))
 
-                # If there is no upload timestamp, retrieve the latest 'add' timestamp from the changes table
+                # If there is no upload timestamp, use the latest 'add' timestamp from the changes table
                 # for the project and pathname in staging, if any, as the upload timestamp
 
                 if not uploaded:
-                    if pathname.startswith('frozen/'):
-                        relative_pathname = pathname[6:]
-                    else:
-                        relative_pathname = pathname[7:]
-                    uploaded = get_last_add_change_timestamp(config, relative_pathname)
+                    uploaded = get_add_change_timestamp(config, add_events, pathname)
 
                 node_details = {
                     'type': node_type,
@@ -744,79 +766,96 @@ def add_nextcloud_nodes(nodes, counts, config):
 
     if config.CHANGED_ONLY:
 
-        nextcloud_file_pathnames = []
+        # Collect the distinct ancestor folders of all Nextcloud file nodes whose Nextcloud details have not
+        # already been recorded, and retrieve the cache records of those folders in batches
+
+        cache_paths = {}
 
-        # Extract only pathnames corresponding to Nextcloud file nodes
         for pathname, node in nodes.items():
+
             node_details = node.get('nextcloud')
-            if node_details and node_details.get('type') == 'file':
-                nextcloud_file_pathnames.append(pathname)
 
-        for pathname in nextcloud_file_pathnames:
+            if not (node_details and node_details.get('type') == 'file'):
+                continue
 
             path_levels = pathname.split(os.sep)
             area = path_levels[0]
 
-            # Iterate top-down over pathname ancestor directory levels, adding node at each pathname level as needed...
+            # Iterate over pathname ancestor directory levels...
             for i in range(2, len(path_levels)):
 
                 level_pathname = os.sep.join(path_levels[1:i])
                 node_pathname = "%s/%s" % (area, level_pathname)
-                node = nodes.get(node_pathname)
 
                 if config.DEBUG:
                     sys.stderr.write("%s: nextcloud: ancestor folder pathname: %s\n" % (config.PROJECT, node_pathname))
 
-                # If the node filesystem details have not already been recorded...
-                if (node is None) or ('nextcloud' not in node):
+                ancestor = nodes.get(node_pathname)
 
+                if (ancestor is None) or ('nextcloud' not in ancestor):
                     if area == 'frozen':
-                        path_pattern = "files/%s/%s" % (config.PROJECT, level_pathname)
+                        cache_paths["files/%s/%s" % (config.PROJECT, level_pathname)] = node_pathname
                     else:
-                        path_pattern = "files/%s+/%s" % (config.PROJECT, level_pathname)
-
-                    query = "SELECT path, mtime \
-                             FROM %sfilecache \
-                             WHERE storage = %d \
-                             AND mimetype = 2 \
-                             AND path = '%s' \
-                             ORDER BY mtime DESC LIMIT 1" % (
-                                 config.DBTABLEPREFIX,
-                                 storage_id,
-                                 path_pattern
-                            )
+                        cache_paths["files/%s+/%s" % (config.PROJECT, level_pathname)] = node_pathname
 
-                    if config.DEBUG:
-                        sys.stderr.write("QUERY: %s\n" % re.sub(r'\s+', ' ', query.strip()))
+        query = "SELECT path, MAX(mtime) \
+                 FROM %sfilecache \
+                 WHERE storage = %%s \
+                 AND mimetype = 2 \
+                 AND path = ANY(%%s) \
+                 GROUP BY path" % config.DBTABLEPREFIX
 
-                    cur.execute(query)
-                    row = cur.fetchone()
+        if config.DEBUG:
+            sys.stderr.write("QUERY: %s (%d paths)\n" % (re.sub(r'\s+', ' ', query.strip()), len(cache_paths)))
 
-                    #if config.DEBUG:
-                    #    sys.stderr.write("filecache: %s\n" % (str(row)))
+        for row in fetch_in_batches(cur, query, storage_id, list(cache_paths.keys())):
 
-                    if row:
+            node_pathname = cache_paths[row[0]]
+            node = nodes.get(node_pathname)
 
-                        modified = normalize_timestamp(datetime.utcfromtimestamp(row[1]))
-                        node_details = {'type': 'folder', 'modified': modified}
+            modified = normalize_timestamp(datetime.utcfromtimestamp(row[1]))
+            node_details = {'type': 'folder', 'modified': modified}
 
-                        if node:
-                            node['nextcloud'] = node_details
-                        else:
-                            node = {}
-                            node['nextcloud'] = node_details
-                            nodes[node_pathname] = node
+            if node:
+                node['nextcloud'] = node_details
+            else:
+                node = {}
+                node['nextcloud'] = node_details
+                nodes[node_pathname] = node
 
-                        counts['nextcloudNodeCount'] = counts['nextcloudNodeCount'] + 1
+            counts['nextcloudNodeCount'] = counts['nextcloudNodeCount'] + 1
 
-                        if config.DEBUG:
-                            sys.stderr.write("%s: nextcloud: ancestor folder: %s\n" % (config.PROJECT, node_pathname))
+            if config.DEBUG:
+                sys.stderr.write("%s: nextcloud: ancestor folder: %s\n" % (config.PROJECT, node_pathname))
 
     # Close database connection
     cur.close()
     conn.close()
 
 
+def fetch_in_batches(cur, query, storage_id, values):
+    """
+    Execute the query, with parameters storage id and array of values, for consecutive batches of at most
+    QUERY_BATCH_SIZE of the values provided, and yield all rows returned
+    """
+    for first in range(0, len(values), QUERY_BATCH_SIZE):
+        cur.execute(query, (storage_id, values[first:first + QUERY_BATCH_SIZE]))
+        for row in cur.fetchall():
+            yield row
+
+
+def get_add_change_timestamp(config, add_events, pathname):
+    """
+    Return the latest 'add' change timestamp of the staging pathname corresponding to the node pathname, if
+    any, from the changes database table. The timestamps of all pathnames of the project are retrieved with
+    a single query on first use, and kept in the list add_events provided.
+    """
+    if not add_events:
+        add_events.append(get_last_add_change_timestamps(config))
+    relative_pathname = pathname[6:] if pathname.startswith('frozen/') else pathname[7:]
+    return add_events[0].get("/%s%s%s" % (config.PROJECT, config.STAGING_FOLDER_SUFFIX, relative_pathname))
+
+
 def add_filesystem_nodes(nodes, counts, config):
     """
     Add all relevant filesystem node stats to the auditing data objects provided and according
@@ -827,145 +866,147 @@ def add_filesystem_nodes(nodes, counts, config):
     if config.DEBUG:
         sys.stderr.write("--- Adding filesystem nodes...\n")
 
+    # If CHANGED_ONLY is true, populate filesystem node details based on already populated node pathnames
+    # from all other contexts, else crawl the filesystem. Any checksums are generated concurrently while
+    # the filesystem is examined, and are all recorded in the filesystem node details before returning
+
+    with ChecksumGenerator(config) as checksums:
+        if config.CHANGED_ONLY:
+            add_changed_filesystem_nodes(nodes, counts, config, checksums)
+        else:
+            add_all_filesystem_nodes(nodes, counts, config, checksums)
+
+
+def add_changed_filesystem_nodes(nodes, counts, config, checksums):
+    """
+    Add the filesystem node stats of the already populated node pathnames, and of their ancestor folders
+    """
+
     file_count = 0
 
     pso_root = "%s/%s%s/" % (config.STORAGE_OC_DATA_ROOT, config.PROJECT_USER_PREFIX, config.PROJECT)
 
-    # If CHANGED_ONLY is true, populate filesystem node details based on already populated node pathnames
-    # from all other contexts, else crawl the filesystem
+    # Pathname levels already examined, so that folders shared by many nodes are examined only once
 
-    if config.CHANGED_ONLY:
+    examined = set()
 
-        for pathname in list(nodes.keys()):
+    for pathname in list(nodes.keys()):
 
-            if config.DEBUG:
-                sys.stderr.write("%s: existing: node pathname: %s\n" % (config.PROJECT, pathname))
+        if config.DEBUG:
+            sys.stderr.write("%s: existing: node pathname: %s\n" % (config.PROJECT, pathname))
 
-            path_levels = pathname.split(os.sep)
+        path_levels = pathname.split(os.sep)
 
-            area = path_levels[0]
+        area = path_levels[0]
 
-            # Iterate top-down over pathname levels, adding node at each pathname level as needed...
-            for i in range(2, len(path_levels) + 1):
+        # Iterate top-down over pathname levels, adding node at each pathname level as needed...
+        for i in range(2, len(path_levels) + 1):
 
-                level_pathname = os.sep.join(path_levels[1:i])
-                node_pathname = "%s/%s" % (area, level_pathname)
-                node = nodes.get(node_pathname)
+            level_pathname = os.sep.join(path_levels[1:i])
+            node_pathname = "%s/%s" % (area, level_pathname)
 
-                if config.DEBUG:
-                    sys.stderr.write("%s: filesystem: node pathname: %s\n" % (config.PROJECT, node_pathname))
+            if node_pathname in examined:
+                continue
 
-                # If the node filesystem details have not already been recorded...
-                if (node is None) or ('filesystem' not in node):
+            examined.add(node_pathname)
 
-                    if area == 'frozen':
-                        filesystem_pathname = "%sfiles/%s/%s" % (pso_root, config.PROJECT, level_pathname)
-                    else:
-                        filesystem_pathname = "%sfiles/%s+/%s" % (pso_root, config.PROJECT, level_pathname)
+            node = nodes.get(node_pathname)
 
-                    if config.DEBUG:
-                        sys.stderr.write("%s: filesystem: pathname: %s\n" % (config.PROJECT, filesystem_pathname))
+            if config.DEBUG:
+                sys.stderr.write("%s: filesystem: node pathname: %s\n" % (config.PROJECT, node_pathname))
 
-                    path = Path(filesystem_pathname)
+            # If the node filesystem details have not already been recorded...
+            if (node is None) or ('filesystem' not in node):
 
-                    if path.exists():
+                if area == 'frozen':
+                    filesystem_pathname = "%sfiles/%s/%s" % (pso_root, config.PROJECT, level_pathname)
+                else:
+                    filesystem_pathname = "%sfiles/%s+/%s" % (pso_root, config.PROJECT, level_pathname)
 
-                        node_stats = path.stat()
-                        modified = node_stats.st_mtime
+                if config.DEBUG:
+                    sys.stderr.write("%s: filesystem: pathname: %s\n" % (config.PROJECT, filesystem_pathname))
 
-                        if modified < config.BEFORE_TS:
+                try:
+                    node_stats = os.stat(filesystem_pathname)
+                except (FileNotFoundError, NotADirectoryError):
+                    continue
 
-                            node_type = 'file'
-                            modified = normalize_timestamp(datetime.utcfromtimestamp(modified))
-                            size = node_stats.st_size
+                modified = node_stats.st_mtime
 
-                            if path.is_file():
-                                file_count = file_count + 1
-                                if config.AUDIT_CHECKSUMS:
-                                    checksum = generate_checksum(filesystem_pathname)
-                                    if checksum.startswith('sha256:'):
-                                        checksum = checksum[7:]
-                                    node_details = {'type': node_type, 'size': size, 'modified': modified, 'checksum': checksum}
-                                else:
-                                    node_details = {'type': node_type, 'size': size, 'modified': modified}
-                            else:
-                                node_type = 'folder'
-                                node_details = {'type': node_type, 'modified': modified}
+                if modified < config.BEFORE_TS:
 
-                            if node:
-                                node['filesystem'] = node_details
-                            else:
-                                node = {}
-                                node['filesystem'] = node_details
-                                nodes[node_pathname] = node
+                    node_type = 'file'
+                    modified = normalize_timestamp(datetime.utcfromtimestamp(modified))
+                    size = node_stats.st_size
 
-                            counts['filesystemNodeCount'] = counts['filesystemNodeCount'] + 1
+                    if S_ISREG(node_stats.st_mode):
+                        file_count = file_count + 1
+                        node_details = {'type': node_type, 'size': size, 'modified': modified}
+                        if config.AUDIT_CHECKSUMS:
+                            checksums.add(node_details, filesystem_pathname)
+                    else:
+                        node_type = 'folder'
+                        node_details = {'type': node_type, 'modified': modified}
 
-                            if config.DEBUG:
-                                sys.stderr.write("%s: filesystem: %d %s %s\n" % (config.PROJECT, file_count, node_type, node_pathname))
+                    if node:
+                        node['filesystem'] = node_details
+                    else:
+                        node = {}
+                        node['filesystem'] = node_details
+                        nodes[node_pathname] = node
 
-    else:
+                    counts['filesystemNodeCount'] = counts['filesystemNodeCount'] + 1
 
-        if config.AUDIT_STAGING == False:
-            find_root = "files/%s/" % config.PROJECT     # select file pathnames only in frozen area
-            min_depth = '1'
-        elif config.AUDIT_FROZEN == False:
-            find_root = "files/%s\+/" % config.PROJECT   # select file pathnames only in staging area
-            min_depth = '1'
-        else:
-            find_root = 'files'                          # select file pathnames in both staging and frozen areas
-            min_depth = '2'
+                    if config.DEBUG:
+                        sys.stderr.write("%s: filesystem: %d %s %s\n" % (config.PROJECT, file_count, node_type, node_pathname))
 
-        command = "cd %s; find %s -mindepth %s -printf \"%%Y\\t%%s\\t%%T@\\t%%p\\n\"" % (pso_root, find_root, min_depth)
 
-        if config.DEBUG:
-            sys.stderr.write("COMMAND: %s\n" % command)
+def add_all_filesystem_nodes(nodes, counts, config, checksums):
+    """
+    Add the filesystem node stats of all nodes in the project filesystem within the audited areas
+    """
 
-        pipe = Popen(command, shell=True, stdout=PIPE)
+    file_count = 0
 
-        pattern = re.compile("^(?P<type>[^\t])+\t(?P<size>[^\t]+)\t(?P<modified>[^\t]+)\t(?P<pathname>.+)$")
+    pso_root = "%s/%s%s/" % (config.STORAGE_OC_DATA_ROOT, config.PROJECT_USER_PREFIX, config.PROJECT)
 
-        for line in pipe.stdout:
+    if config.AUDIT_STAGING == False:
+        areas = [ 'frozen' ]             # select file pathnames only in frozen area
+    elif config.AUDIT_FROZEN == False:
+        areas = [ 'staging' ]            # select file pathnames only in staging area
+    else:
+        areas = [ 'frozen', 'staging' ]  # select file pathnames in both staging and frozen areas
 
-            match = pattern.match(line.decode(sys.stdout.encoding))
-            values = match.groupdict()
+    workers = int(getattr(config, 'AUDIT_SCAN_WORKERS', 8))
 
-            if len(values) != 4:
-                raise Exception("Parse error for output from find command: %s" % line.decode(sys.stdout.encoding))
+    for area in areas:
 
-            type = str(values['type'])
-            size = int(values['size'])
-            modified = int(float(values['modified']))
-            pathname = str(values['pathname'])
-            filesystem_pathname = "%s%s" % (pso_root, pathname)
+        if area == 'frozen':
+            area_root = "%sfiles/%s" % (pso_root, config.PROJECT)
+        else:
+            area_root = "%sfiles/%s+" % (pso_root, config.PROJECT)
 
-            if modified < config.BEFORE_TS:
+        if config.DEBUG:
+            sys.stderr.write("SCAN: %s\n" % area_root)
 
-                pathname = pathname[5:]
-                project_name_len = len(config.PROJECT)
-                if pathname[(project_name_len + 1)] == '+':
-                    pathname = "staging/%s" % pathname[(project_name_len + 3):]
-                else:
-                    pathname = "frozen/%s" % pathname[(project_name_len + 2):]
+        for pathname, is_folder, size, modified in scan_directory_tree(area_root, workers):
 
-                node_type = 'file'
+            if modified < config.BEFORE_TS:
+
+                filesystem_pathname = "%s/%s" % (area_root, pathname)
+                pathname = "%s/%s" % (area, pathname)
 
                 modified = normalize_timestamp(datetime.utcfromtimestamp(modified))
 
-                if type == 'd':
+                if is_folder:
                     node_type = 'folder'
-
-                if node_type == 'file':
+                    node_details = {'type': node_type, 'modified': modified}
+                else:
+                    node_type = 'file'
                     file_count = file_count + 1
+                    node_details = {'type': node_type, 'size': size, 'modified': modified}
                     if config.AUDIT_CHECKSUMS:
-                        checksum = generate_checksum(filesystem_pathname)
-                        if checksum.startswith('sha256:'):
-                            checksum = checksum[7:]
-                        node_details = {'type': node_type, 'size': size, 'modified': modified, 'checksum': checksum}
-                    else:
-                        node_details = {'type': node_type, 'size': size, 'modified': modified}
-                else:
-                    node_details = {'type': node_type, 'modified': modified}
+                        checksums.add(node_details, filesystem_pathname)
 
                 try:
                     node = nodes[pathname]
@@ -981,6 +1022,61 @@ def add_filesystem_nodes(nodes, counts, config):
                     sys.stderr.write("%s: filesystem: %d %s %s\n" % (config.PROJECT, file_count, node_type, pathname))
 
 
+class ChecksumGenerator():
+    """
+    Generates checksums for files concurrently in a bounded pool of AUDIT_CHECKSUM_WORKERS threads, while the
+    filesystem is being examined, and records each checksum in the filesystem node details of its file. At most
+    a few files per worker are queued at any time, so that the filesystem examination does not run far ahead.
+    """
+
+    def __init__(self, config):
+        self._config = config
+        self._workers = max(1, int(getattr(config, 'AUDIT_CHECKSUM_WORKERS', 4)))
+        self._executor = None
+        self._pending = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._executor is None:
+            return
+        if exc_type is None:
+            self._record(ALL_COMPLETED)
+        else:
+            for future in self._pending:
+                future.cancel()
+        self._executor.shutdown(wait=True)
+
+    def add(self, node_details, filesystem_pathname):
+        """
+        Queue the generation of a checksum for the specified file, to be recorded in the node details provided
+        """
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self._workers)
+        if len(self._pending) >= self._workers * 4:
+            self._record(FIRST_COMPLETED)
+        future = self._executor.submit(
+            generate_checksum,
+            filesystem_pathname,
+            self._config.CHECKSUM_CACHE_INSTANCE,
+            self._config.STRICT_CHECKSUMS
+        )
+        self._pending[future] = (node_details, filesystem_pathname)
+
+    def _record(self, return_when):
+        done, not_done = wait(self._pending, return_when=return_when)
+        for future in done:
+            node_details, filesystem_pathname = self._pending.pop(future)
+            checksum = future.result()
+            if checksum is None:
+                # E.g. the file was removed during the audit; the error was reported by generate_checksum
+                logging.warning("%s: No checksum generated for %s" % (self._config.PROJECT, filesystem_pathname))
+            elif checksum.startswith('sha256:'):
+                checksum = checksum[7:]
+            node_details['checksum'] = checksum
+
+
 def audit_project(config):
     """
     Audit a project according to the configured values provided and return a report of the results
@@ -992,10 +1088,13 @@ def audit_project(config):
     # Populate auditing data objects for all nodes in scope according to the configured values provided
     # NOTE: Order in which node details is populated is critical
 
-    add_frozen_files(nodes, counts, config)
+    with stage_limit('db'):
+        add_frozen_files(nodes, counts, config)
     add_metax_files(nodes, counts, config)
-    add_nextcloud_nodes(nodes, counts, config)  # must be second to last
-    add_filesystem_nodes(nodes, counts, config) # must be last
+    with stage_limit('db'):
+        add_nextcloud_nodes(nodes, counts, config)  # must be second to last
+    with stage_limit('io'):
+        add_filesystem_nodes(nodes, counts, config) # must be last
 
     if config.DEBUG:
         sys.stderr.write("NODES: %s\n" % json.dumps(nodes, indent=4))
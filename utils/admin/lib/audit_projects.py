@@ -0,0 +1,319 @@
+# --------------------------------------------------------------------------------
+# This file is part of the IDA research data storage service
+#
+# Copyright (C) 2023 Ministry of Education and Culture, Finland
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public
+# License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# @author   CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# @license  GNU Affero General Public License, version 3
+# @link     https://research.csc.fi/
+# --------------------------------------------------------------------------------
+
+import sys
+import os
+import io
+import re
+import socket
+import json
+import logging
+import multiprocessing
+import time
+import audit_project
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stdout
+from datetime import datetime
+from subprocess import run, PIPE
+from types import SimpleNamespace
+from utils import LOG_ENTRY_FORMAT, TIMESTAMP_FORMAT, load_configuration
+
+# Use UTC
+os.environ['TZ'] = 'UTC'
+time.tzset()
+
+# Configuration and constants loaded once by the main process, inherited by the worker processes
+BASE_CONFIG = None
+BASE_CONSTANTS = None
+
+
+def main():
+
+    try:
+
+        # Arguments: ROOT START [ OPTIONS ], with the projects to audit read from stdin, one per line
+        #
+        # OPTIONS: as for utils/admin/audit-project
+
+        argc = len(sys.argv)
+
+        if argc < 3:
+            raise Exception('Invalid number of arguments')
+
+        # Load service configuration and constants once, shared by the audits of all projects
+
+        config = load_configuration("%s/config/config.sh" % sys.argv[1])
+        constants = load_configuration("%s/lib/constants.sh" % sys.argv[1])
+
+        config.SCRIPT = os.path.basename(sys.argv[0])
+        config.PID = os.getpid()
+
+        start = sys.argv[2]
+        after, before, audit_args, report_req, recipients = parse_arguments(sys.argv[3:])
+
+        # If after timestamp not specified, use the unix epoch; if before timestamp not specified, use the start time
+
+        after = after or '1970-01-01T00:00:00Z'
+        before = before or start
+
+        if after >= start:
+            raise Exception("Specified after timestamp %s must be in the past" % after)
+
+        if before != start and after >= before:
+            raise Exception("Specified after timestamp %s must be earlier than the specified before timestamp %s" % (after, before))
+
+        if report_req and not recipients:
+            recipients = config.EMAIL_RECIPIENTS
+
+        projects = [ line.strip() for line in sys.stdin if line.strip() ]
+
+        # Initialize logging using UTC timestamps, inherited by the worker processes
+
+        if config.DEBUG:
+            config.LOG_LEVEL = logging.DEBUG
+        else:
+            config.LOG_LEVEL = logging.INFO
+
+        logging.basicConfig(
+            filename=config.LOG,
+            level=config.LOG_LEVEL,
+            format=LOG_ENTRY_FORMAT,
+            datefmt=TIMESTAMP_FORMAT)
+
+        logging.Formatter.converter = time.gmtime
+
+        # Audit the projects concurrently in a pool of worker processes, limiting how many of them query the
+        # database or scan the filesystem at the same time, and output the report summary of each project as
+        # soon as its audit is done
+
+        workers = max(1, int(getattr(config, 'AUDIT_PARALLEL_PROJECTS', 4)))
+
+        context = multiprocessing.get_context('fork')
+
+        stage_limits = {
+            'db': context.BoundedSemaphore(max(1, int(getattr(config, 'AUDIT_MAX_DB_STAGES', workers)))),
+            'io': context.BoundedSemaphore(max(1, int(getattr(config, 'AUDIT_MAX_IO_STAGES', workers))))
+        }
+
+        logging.info("START %d projects %s workers %d" % (len(projects), start, workers))
+
+        failed_projects = []
+
+        with ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=context,
+                initializer=initialize_worker,
+                initargs=(config, constants, stage_limits)) as executor:
+
+            futures = {}
+            for project in projects:
+                futures[executor.submit(audit_one_project, project, start, after, before, audit_args)] = project
+
+            for future in as_completed(futures):
+                project = futures[future]
+                try:
+                    report_pathname, summary, ok = future.result()
+                    sys.stdout.write("Audit results saved to file %s\n" % report_pathname)
+                    if report_req == '--report' or (report_req == '--report-errors' and not ok):
+                        send_report(config, project, summary, ok, recipients)
+                    sys.stdout.write("%s\n" % summary)
+                    sys.stdout.flush()
+                except Exception as error:
+                    failed_projects.append(project)
+                    logging.error("Auditing of project %s failed: %s" % (project, str(error)))
+                    sys.stderr.write("ERROR: Auditing of project %s failed: %s\n" % (project, str(error)))
+
+        if failed_projects:
+            raise Exception("Auditing of %d projects failed: %s" % (len(failed_projects), " ".join(sorted(failed_projects))))
+
+        logging.info("DONE")
+
+    except Exception as error:
+        try:
+            logging.error(str(error))
+        except Exception as logerror:
+            sys.stderr.write("ERROR: %s\n" % str(logerror))
+        sys.stderr.write("ERROR: %s\n" % str(error))
+        sys.exit(1)
+
+
+def parse_arguments(args):
+    """
+    Parse the audit options accepted by utils/admin/audit-project, returning the after and before timestamps,
+    if any, the options passed on to audit_project.configure_audit(), and any report request and recipients
+    """
+
+    after = None
+    before = None
+    audit_args = []
+    report_req = None
+    recipients = None
+
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg in [ '--changed-after', '--changed-before' ]:
+            if i + 1 >= len(args):
+                raise Exception("Missing date[time] argument")
+            timestamp = normalize_datetime_argument(args[i + 1])
+            if arg == '--changed-after':
+                after = timestamp
+            else:
+                before = timestamp
+            i = i + 1
+        elif arg in [ '--full', '--staging', '--frozen', '--timestamps', '--checksums', '--strict-checksums' ]:
+            audit_args.append(arg)
+        elif arg in [ '--report', '--report-errors' ]:
+            if report_req:
+                raise Exception("Only one of --report or --report-errors is allowed")
+            report_req = arg
+        elif report_req and not recipients:
+            recipients = arg
+        else:
+            raise Exception("Invalid argument: %s" % arg)
+        i = i + 1
+
+    if '--full' in audit_args and (after or before):
+        raise Exception("Only one of --full or --changed-after/--changed-before is allowed")
+
+    return after, before, audit_args, report_req, recipients
+
+
+def normalize_datetime_argument(value):
+    if re.match(r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}Z$', value):
+        return value
+    if re.match(r'^\d{4}-\d{2}-\d{2}$', value):
+        return "%sT00:00:00Z" % value
+    raise Exception("Invalid date[time]: %s" % value)
+
+
+def initialize_worker(config, constants, stage_limits):
+    global BASE_CONFIG, BASE_CONSTANTS
+    BASE_CONFIG = config
+    BASE_CONSTANTS = constants
+    audit_project.STAGE_LIMITS.update(stage_limits)
+
+
+def audit_one_project(project, start, after, before, audit_args):
+    """
+    Audit the specified project in a worker process, saving the report to the audits log folder the same
+    way as utils/admin/audit-project does. Returns the report pathname, the report summary, and whether
+    the project is OK.
+    """
+
+    # Each project is audited with its own copy of the shared configuration
+
+    config = SimpleNamespace(**{ name: value for name, value in vars(BASE_CONFIG).items() if not name.startswith('__') })
+    config.PID = os.getpid()
+
+    project_root = "%s/%s%s" % (config.STORAGE_OC_DATA_ROOT, BASE_CONSTANTS.PROJECT_USER_PREFIX, project)
+
+    if not os.path.isdir(project_root):
+        raise Exception("The specified project %s does not exist" % project)
+
+    audit_project.configure_audit(config, BASE_CONSTANTS, project, start, after, before, audit_args)
+
+    logging.info("START %s %s" % (config.PROJECT, config.START))
+
+    try:
+        report = audit_project.audit_project(config)
+        audit_project.analyze_audit_errors(report)
+        output = io.StringIO()
+        with redirect_stdout(output):
+            audit_project.output_report(report)
+    finally:
+        if config.CHECKSUM_CACHE_INSTANCE is not None:
+            config.CHECKSUM_CACHE_INSTANCE.close()
+
+    report = json.loads(output.getvalue())
+
+    ok = (report.get('invalidNodeCount') == 0)
+
+    report_root = "%s/audits/%s" % (os.path.dirname(os.path.realpath(config.LOG)), datetime.utcnow().strftime('%Y/%m'))
+    report_pathname = "%s/%s_%s.%s.json" % (report_root, start, project, 'OK' if ok else 'ERR')
+
+    os.makedirs(report_root, exist_ok=True)
+
+    with open(report_pathname, 'w') as report_file:
+        report_file.write(json.dumps(report, indent=4, ensure_ascii=False))
+        report_file.write('\n')
+
+    if ok:
+        summary = { key: value for key, value in report.items() if key not in [ 'invalidNodes', 'errors', 'oldest', 'newest' ] }
+    else:
+        summary = remove_nodes({ key: value for key, value in report.items() if key != 'invalidNodes' })
+
+    summary = json.dumps(summary, indent=4, ensure_ascii=False)
+
+    if not ok:
+        with open("%s.summary" % report_pathname, 'w') as summary_file:
+            summary_file.write(summary)
+            summary_file.write('\n')
+
+    logging.info("DONE %s" % config.PROJECT)
+
+    return report_pathname, summary, ok
+
+
+def remove_nodes(value):
+    """
+    Remove the node listings from all levels of the report errors, leaving only the counts
+    """
+    if isinstance(value, dict):
+        return { key: remove_nodes(item) for key, item in value.items() if key != 'nodes' }
+    if isinstance(value, list):
+        return [ remove_nodes(item) for item in value ]
+    return value
+
+
+def send_report(config, project, summary, ok, recipients):
+    """
+    Email the report summary of the specified project, the same way as utils/admin/audit-project does
+    """
+
+    subject = "Auditing report for project %s" % project
+
+    if config.IDA_ENVIRONMENT != 'PRODUCTION':
+        subject = "%s (%s) %s" % (config.IDA_ENVIRONMENT, socket.gethostname(), subject)
+
+    if ok:
+        subject = "%s - OK" % subject
+    else:
+        subject = "%s - Errors Reported" % subject
+
+    version = run([ 'mail', '--version' ], stdout=PIPE, stderr=PIPE, universal_newlines=True)
+
+    if 's-nail' in version.stdout:
+        command = [ 'mail', '-s', subject, '-r', config.EMAIL_SENDER ] + recipients.replace(',', ' ').split()
+    else:
+        command = [ 'mail', '-s', subject, '-r', config.EMAIL_SENDER, '-S', 'replyto=%s' % config.EMAIL_SENDER, recipients ]
+
+    result = run(command, input=summary, stdout=PIPE, stderr=PIPE, universal_newlines=True)
+
+    if result.stderr:
+        logging.error(result.stderr.strip())
+        raise Exception("Failed to send audit summary email")
+
+
+if __name__ == "__main__":
+    main()
@@ -32,7 +32,7 @@ import logging
 import psycopg2
 from sortedcontainers import SortedDict
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
-from utils import LOG_ENTRY_FORMAT, TIMESTAMP_FORMAT, load_configuration
+from utils import LOG_ENTRY_FORMAT, TIMESTAMP_FORMAT, load_configuration, stream_query
 
 # Use UTC
 os.environ['TZ'] = 'UTC'
@@ -139,10 +139,7 @@ def get_files_with_no_checksum(config):
                  config.PROJECT
             )
 
-    cur.execute(query)
-    rows = cur.fetchall()
-
-    for row in rows:
+    for row in stream_query(config, conn, query):
         files[row[1]] = { 'id': row[0], 'size': row[2] }
 
     # Close database connection
@@ -29,8 +29,9 @@ import requests
 import logging
 import psycopg2
 import dateutil.parser
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from datetime import datetime
-from hashlib import sha256
+from stat import S_ISDIR
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 
 # Use UTC
@@ -91,23 +92,103 @@ def load_configuration(filesystem_pathname):
     return config
 
 
-def generate_checksum(filesystem_pathname):
+def _load_checksum_cache_module():
+    """
+    Load the checksum cache implementation shared with the postprocessing agents
+    """
+    filesystem_pathname = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../../../agents/utils/checksum_cache.py')
+    module_spec = importlib.util.spec_from_file_location('checksum_cache', filesystem_pathname)
+    module = importlib.util.module_from_spec(module_spec)
+    module_spec.loader.exec_module(module)
+    return module
+
+
+checksum_cache = _load_checksum_cache_module()
+
+
+def open_checksum_cache(config):
+    """
+    Open the local persistent checksum cache, if one is configured with CHECKSUM_CACHE, else return None
+    """
+    if not getattr(config, 'CHECKSUM_CACHE', None):
+        return None
+    try:
+        return checksum_cache.ChecksumCache(config.CHECKSUM_CACHE, int(getattr(config, 'CHECKSUM_CACHE_MAX_ENTRIES', 10000000)))
+    except Exception as e:
+        sys.stderr.write("WARNING: Failed to open checksum cache %s, generating all checksums: %s\n" % (config.CHECKSUM_CACHE, str(e)))
+        return None
+
+
+def generate_checksum(filesystem_pathname, cache=None, strict=False):
+    """
+    Generate an SHA-256 checksum for the specified file. If a checksum cache is given, the checksum is
+    looked up from the cache unless strict is true, and the file is read only if the checksum is not cached.
+    """
     if not os.path.isfile(filesystem_pathname):
         sys.stderr.write("ERROR: Pathname %s not found or not a file\n" % filesystem_pathname)
         return None
     try:
-        block_size = 65536
-        sha = sha256()
-        with open(filesystem_pathname, 'rb') as f:
-            for block in iter(lambda: f.read(block_size), b''):
-                sha.update(block)
-        checksum = str(sha.hexdigest()).lower()
+        checksum = checksum_cache.generate_file_checksum(filesystem_pathname, cache=cache, strict=strict)
     except Exception as e:
         sys.stderr.write("ERROR: Failed to generate checksum for %s: %s\n" % (filesystem_pathname, str(e)))
         return None
     return checksum
 
 
+def scan_directory_tree(root_pathname, workers=8):
+    """
+    Yield a (pathname, is_folder, size, modified) tuple for every node below the specified root folder, where
+    pathname is relative to the root, size and modified (epoch seconds) are those of the node itself, and is_folder
+    is true if the node is, or is a symbolic link to, a folder (as with find -printf %Y). Symbolic links are not
+    followed. The folders are scanned concurrently with os.scandir by the specified number of threads, using the
+    stats cached by the directory entries, and the nodes of each folder are yielded once it has been scanned.
+    Folders which cannot be scanned, and nodes which cannot be examined, are reported to stderr and skipped,
+    as with find.
+    """
+
+    def scan(relative_pathname):
+        nodes = []
+        subfolders = []
+        folder_pathname = "%s/%s" % (root_pathname, relative_pathname) if relative_pathname else root_pathname
+        try:
+            with os.scandir(folder_pathname) as entries:
+                for entry in entries:
+                    pathname = "%s/%s" % (relative_pathname, entry.name) if relative_pathname else entry.name
+                    try:
+                        stats = entry.stat(follow_symlinks=False)
+                    except FileNotFoundError:
+                        continue
+                    except OSError as e:
+                        sys.stderr.write("ERROR: Failed to examine %s/%s: %s\n" % (folder_pathname, entry.name, str(e)))
+                        continue
+                    try:
+                        is_folder = entry.is_dir()
+                    except OSError:
+                        # Symbolic link loops and links which cannot be resolved are not folders (find %Y L or N)
+                        is_folder = False
+                    if S_ISDIR(stats.st_mode):
+                        subfolders.append(pathname)
+                    nodes.append((pathname, is_folder, stats.st_size, int(stats.st_mtime)))
+        except OSError as e:
+            sys.stderr.write("ERROR: Failed to scan folder %s: %s\n" % (folder_pathname, str(e)))
+        return nodes, subfolders
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        pending = set([ executor.submit(scan, '') ])
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    nodes, subfolders = future.result()
+                    for subfolder in subfolders:
+                        pending.add(executor.submit(scan, subfolder))
+                    for node in nodes:
+                        yield node
+        finally:
+            for future in pending:
+                future.cancel()
+
+
 def normalize_timestamp(timestamp):
     """
     Returns the input timestamp as a normalized Canonical ISO 8601 UTC timestamp string YYYY-MM-DDThh:mm:ssZ
@@ -140,6 +221,32 @@ def get_project_pathname(project, pathname):
 
 
 
+_stream_query_count = 0
+
+
+def stream_query(config, conn, query, params=None):
+    """
+    Execute the query on the database connection provided using a named, server side cursor, and yield the rows
+    as they arrive from the database, DB_QUERY_ITERSIZE rows (default 10000) at a time, so that the full result
+    set is never held in client memory. The cursor is closed once all rows have been yielded, or if the caller
+    stops iterating early.
+    """
+
+    global _stream_query_count
+
+    _stream_query_count = _stream_query_count + 1
+
+    cur = conn.cursor(name="stream_query_%d_%d" % (os.getpid(), _stream_query_count))
+    cur.itersize = int(getattr(config, 'DB_QUERY_ITERSIZE', 10000))
+
+    try:
+        cur.execute(query, params)
+        for row in cur:
+            yield row
+    finally:
+        cur.close()
+
+
 def get_last_add_change_timestamps(config):
     """
     Retrieve all latest 'add' change events for the project + file relative pathname, in staging,
@@ -155,8 +262,6 @@ def get_last_add_change_timestamps(config):
                             host=config.DBHOST,
                             port=config.DBPORT)
 
-    cur = conn.cursor()
-
     staging_pathname_prefix = "/%s%s/%%" % (config.PROJECT, config.STAGING_FOLDER_SUFFIX)
 
     query = "WITH latest_timestamps AS ( \
@@ -173,18 +278,16 @@ def get_last_add_change_timestamps(config):
     
     logging.debug("get_last_add_change_timestamps query = %s" % query)
 
-    cur.execute(query, (config.PROJECT, staging_pathname_prefix))
-
-    rows = cur.fetchall()
-
-    logging.debug("get_last_add_change_timestamps rows = %d" % len(rows))
-
     add_events = {}
 
-    for row in rows:
+    for row in stream_query(config, conn, query, (config.PROJECT, staging_pathname_prefix)):
         logging.debug("get_last_add_change_timestamps timestamp = %s pathname = %s" % (row[1], row[0]))
         add_events[row[0]] = row[1]
 
+    logging.debug("get_last_add_change_timestamps rows = %d" % len(add_events))
+
+    conn.close()
+
     return add_events
 
 